@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the load, validate and insert stages of ingestion on synthetic documents.
+
+For each document size (number of samples and runs), synthetic GT metadata files are
+written to a temporary directory, then each stage is timed on its own. Each stage is run
+a second time under tracemalloc to measure its peak Python memory, since tracing slows
+allocation too much to time the same run. Insertion goes to the in-process fake collection from
+the tests, so no server is needed and the numbers measure the ingester, not the network.
+Run from the top level directory:
+
+    python -m benchmarks.bench_ingestion [--docs N] [--save results.json]
+        [--compare baseline.json --tolerance 0.25]
+
+With --compare, the exit status is 1 if any stage is slower than the baseline by more than
+the tolerance, so the suite can gate a deployment.
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_docs import make_docs, schema_filename
+from metadata_mongo_ingester.JsonLoader import JsonLoader
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+
+
+# (samples, runs) in each document, from a small delivery to a large one.
+SIZES = [(1, 1), (100, 10), (1000, 50)]
+
+
+def measure(make_run):
+
+    """
+
+    Time a stage, then run it again to measure its peak memory.
+
+    Parameters:
+        make_run (callable): Returns a fresh function, taking no arguments, that runs the
+            stage once.
+
+    Returns: (seconds, peak bytes) tuple.
+
+    """
+
+    run = make_run()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+
+    run = make_run()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+def bench_size(count, samples, runs, directory):
+
+    """
+
+    Benchmark the three stages for documents of one size.
+
+    Parameters:
+        count (int): Number of documents.
+        samples (int): Number of sample entries in each document.
+        runs (int): Number of run entries in each document.
+        directory (str): Directory to write the document files to.
+
+    Returns:
+        dict: Maps each stage to {"docs_per_sec": float, "peak_bytes": int}.
+
+    """
+
+    filenames = []
+    for index, doc in enumerate(make_docs(count, samples, runs)):
+        filename = os.path.join(directory, f"doc_{samples}_{runs}_{index}.json")
+        with open(filename, 'w') as f:
+            json.dump(doc, f)
+        filenames.append(filename)
+
+    loaded = []
+    for filename in filenames:
+        with open(filename) as f:
+            loaded.append(json.load(f))
+
+    json_loader = JsonLoader()
+    def make_load():
+        def load():
+            for filename in filenames:
+                json_loader.load_file(filename)
+        return load
+
+    mmi = MetadataMongoIngester()
+    mmi.set_schema(schema_filename)
+    def make_validate():
+        def validate():
+            for doc in loaded:
+                assert mmi.validate(doc) is None
+        return validate
+
+    # Insert without a schema, so only the key correction and write are timed.
+    def make_insert():
+        writer = MetadataMongoIngester()
+        writer.collection = FakeCollection()
+        writer.collection.create_index([("archived_path", 1)], unique=True)
+        docs = [dict(doc) for doc in loaded]
+        def insert():
+            assert writer.ingest_documents(docs) == [None] * count
+        return insert
+
+    results = {}
+    for stage, make_run in [("load", make_load), ("validate", make_validate),
+        ("insert", make_insert)]:
+        seconds, peak = measure(make_run)
+        results[stage] = {"docs_per_sec": count / seconds, "peak_bytes": peak}
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the stages of metadata ingestion.")
+    parser.add_argument("--docs", type=int, default=200, help="Documents per size. Default: %(default)s")
+    parser.add_argument("--save", help="Write the results to this json file.")
+    parser.add_argument("--compare", help="json file of baseline results to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+        help="Allowed fractional slowdown against the baseline. Default: %(default)s")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for samples, runs in SIZES:
+            # Keep the total work similar for each size.
+            count = max(1, args.docs // max(1, samples // 10))
+            size = f"{samples} samples, {runs} runs"
+            results[size] = bench_size(count, samples, runs, directory)
+
+    print(f"json parser: {JsonLoader().backend}")
+    print(f"{'document size':<24}{'stage':<10}{'docs/sec':>12}{'peak MB':>10}")
+    for size, stages in results.items():
+        for stage, numbers in stages.items():
+            print(f"{size:<24}{stage:<10}{numbers['docs_per_sec']:>12.1f}"
+                f"{numbers['peak_bytes'] / 1e6:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for size, stages in baseline.items():
+            for stage, numbers in stages.items():
+                current = results.get(size, {}).get(stage)
+                if current and current["docs_per_sec"] < numbers["docs_per_sec"] * (1 - args.tolerance):
+                    regressions.append(f"{size} {stage}: {current['docs_per_sec']:.1f} docs/sec, "
+                        f"baseline {numbers['docs_per_sec']:.1f}")
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the per-document cost of validating metadata against the GT delivery schema.
+
+Compares calling jsonschema.validate for every document, as validate used to, with
+reusing the validator that set_schema compiles once. Run from the top level directory:
+
+    python -m benchmarks.bench_validation [iterations]
+'''
+
+import json
+import os
+import sys
+import timeit
+
+import jsonschema
+
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+schema_filename = os.path.join(root_dir, "tests", "schemas", "good_gt-schema.json")
+doc_filename = os.path.join(root_dir, "tests", "test_docs", "good_gt_metadata.json")
+
+
+def main():
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    with open(schema_filename) as f:
+        schema = json.load(f)
+    with open(doc_filename) as f:
+        doc = json.load(f)
+
+    mmi = MetadataMongoIngester()
+    mmi.set_schema(schema_filename)
+
+    before = timeit.timeit(lambda: jsonschema.validate(instance=doc, schema=schema),
+        number=iterations) / iterations
+    after = timeit.timeit(lambda: mmi.validate(doc), number=iterations) / iterations
+
+    print(f"jsonschema.validate per doc:  {before * 1e6:10.1f} us")
+    print(f"cached validator per doc:     {after * 1e6:10.1f} us")
+    print(f"speedup:                      {before / after:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
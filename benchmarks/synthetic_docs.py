@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+'''
+Generate synthetic GT delivery metadata documents of any size for benchmarks.
+
+Documents are built from tests/test_docs/good_gt_metadata.json by repeating its sample and
+run entries with new names, so they stay valid against tests/schemas/good_gt-schema.json.
+'''
+
+import copy
+import json
+import os
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+schema_filename = os.path.join(root_dir, "tests", "schemas", "good_gt-schema.json")
+template_filename = os.path.join(root_dir, "tests", "test_docs", "good_gt_metadata.json")
+
+
+def make_doc(index, samples=1, runs=1, template=None):
+
+    """
+
+    Make a synthetic metadata document.
+
+    Parameters:
+        index (int): Number of the document, used to give it a unique archived_path.
+        samples (int): Number of entries in its project's samples list.
+        runs (int): Number of entries in its project's runs list.
+        template (dict): Document to build from. If None, the good test document is loaded.
+
+    Returns: dict. The document.
+
+    """
+
+    if template is None:
+        with open(template_filename) as f:
+            template = json.load(f)
+
+    doc = copy.deepcopy(template)
+    doc["archived_path"] = f"/archive/GT/synthetic/{index:08d}"
+    project = doc["project"]
+    project["GT_Project_Name_ID"] = f"synthetic-{index:08d}"
+
+    sample_template = template["project"]["samples"][0]
+    project["samples"] = []
+    for i in range(samples):
+        sample = copy.deepcopy(sample_template)
+        sample["GT_Sample_Name"] = f"GT{index:08d}-{i:05d}"
+        sample["Customer_Sample_Name"] = f"sample-{i}"
+        sample["Fastq_Filenames"] = [f"sample-{i}_GT{index:08d}-{i:05d}_S{i}_R{read}_001.fastq.gz"
+            for read in (1, 2)]
+        project["samples"].append(sample)
+
+    run_template = template["project"]["runs"][0]
+    project["runs"] = []
+    for i in range(runs):
+        run = copy.deepcopy(run_template)
+        run["Run_ID"] = f"{run_template['Run_ID']}_{index:08d}_{i:04d}"
+        project["runs"].append(run)
+
+    return doc
+
+
+def make_docs(count, samples=1, runs=1):
+
+    """
+
+    Make a list of synthetic metadata documents of the same size.
+
+    Parameters:
+        count (int): Number of documents.
+        samples (int): Number of sample entries in each.
+        runs (int): Number of run entries in each.
+
+    Returns: list of dict.
+
+    """
+
+    with open(template_filename) as f:
+        template = json.load(f)
+    return [make_doc(index, samples, runs, template) for index in range(count)]
@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+
+"""
+    Provide asyncio APIs to validate metadata documents against a schema and ingest them into a MongoDB collection.
+
+"""
+
+import asyncio
+import inspect
+import itertools
+
+import pymongo
+
+from metadata_mongo_ingester.IngestResult import IngestStatus
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+# pymongo 4.9 and later has its own asyncio client. Before that, motor provides one.
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+
+class AsyncMetadataMongoIngester:
+
+    """
+
+    Provide asyncio APIs to validate metadata documents against a schema and ingest them into a MongoDB collection.
+
+    Works like MetadataMongoIngester, and uses one for config and secrets files, schemas,
+    validation and key correction, but connects with an asyncio mongodb client. Loading,
+    key correction and validation are CPU bound, so they run in an executor to keep the
+    event loop free, and the number of writes in flight at once is capped. Close it, or use
+    it with async with, to close its client.
+
+    """
+
+    def __init__(self, max_in_flight=8, executor=None):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            max_in_flight (int): Maximum number of insert calls waiting on the server at once.
+            executor (concurrent.futures.Executor): Executor that loads, key corrects and
+                validates documents. If None, the event loop's default executor is used.
+
+        Returns: None
+
+        """
+
+        self.collection = None
+        self.db_connection = None
+        self.executor = executor
+        self.ingester = MetadataMongoIngester() # Does everything but talk to the database
+        self.max_in_flight = max_in_flight
+        self.write_slots = None # Semaphore, made in the running loop on first use
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    async def close(self):
+
+        """
+
+        Close the asyncio mongodb client, if a connection was opened.
+
+        pymongo's AsyncMongoClient.close is a coroutine and motor's is not, so either is
+        accepted. The ingester can be used as an async context manager, which closes it on
+        exit.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.db_connection is not None:
+            closed = self.db_connection.close()
+            if inspect.isawaitable(closed):
+                await closed
+            self.db_connection = None
+            self.collection = None
+
+
+    def get_collection(self):
+
+        """
+
+        Get the current collection from the database.
+
+        Parameters: None
+
+        Returns: The asyncio mongodb collection named when the connection was opened.
+
+        """
+
+        return self.collection
+
+
+    def get_connection(self):
+
+        """
+
+        Get the current connection from the database.
+
+        Parameters: None
+
+        Returns: The asyncio mongodb connection that was opened.
+
+        """
+
+        return self.db_connection
+
+
+    async def ingest_document(self, doc):
+
+        """
+
+        Ingest a document. Validate before ingestion if schema is set.
+
+        See MetadataMongoIngester.ingest_document, which this mirrors.
+
+        Parameters:
+            doc (str, dict or ValidationResult):
+                If dict, metadata document to be ingested.
+                If str, absolute path to json file containing document.
+                If ValidationResult, a document prepared by prepare_document.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        doc, error = await self.__prepare_document(doc)
+        if error:
+            return error
+
+        # Attempt ingestion
+        try:
+            async with self.__write_slots():
+                result = await self.collection.insert_one(doc)
+            if result.acknowledged:
+                return None
+
+        except pymongo.errors.DuplicateKeyError:
+            return "Duplicate key, skipped"
+
+        except Exception as e:
+            return f"Error: Cannot ingest document, received exception {str(e)}."
+
+        return f"Error: Cannot ingest document, reason unknown."
+
+
+    async def ingest_documents(self, docs, batch_size=1000):
+
+        """
+
+        Ingest many documents, sending them to the database in batches.
+
+        Each batch is prepared in the executor, then inserted with one unordered insert_many
+        call. Batches are inserted concurrently, up to max_in_flight at once; preparing more
+        batches waits while that many are in flight.
+
+        Parameters:
+            docs (iterable of str, dict or ValidationResult):
+                Metadata documents as dicts, absolute paths to json files containing them, or
+                documents already prepared by prepare_document.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+
+        Returns:
+            list: One result per input document, in input order, as in
+                MetadataMongoIngester.ingest_documents.
+            Or
+            str: An error message beginning with "Error:" if batch_size is not valid.
+
+        """
+
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+
+        results = []
+        inserts = []
+        docs = iter(docs)
+        while True:
+            chunk = list(itertools.islice(docs, batch_size))
+            if not chunk:
+                break
+
+            start = len(results)
+            results.extend([None] * len(chunk))
+            prepared = await asyncio.gather(*(self.__prepare_document(doc) for doc in chunk))
+
+            batch = []
+            for index, (doc, error) in enumerate(prepared, start=start):
+                if error:
+                    results[index] = error
+                else:
+                    batch.append((index, doc))
+
+            if batch:
+                # Take a write slot before starting the insert, so that reading and preparing
+                # can't run ahead of the database.
+                await self.__write_slots().acquire()
+                inserts.append(asyncio.ensure_future(self.__insert_batch(batch)))
+
+        for batch_results in await asyncio.gather(*inserts):
+            for index, result in batch_results:
+                results[index] = result
+
+        return results
+
+
+    def is_schema_set(self):
+
+        """
+
+        State whether schema is set.
+
+        Parameters: None
+
+        Returns: bool. True if schema is set, False if not.
+
+        """
+
+        return self.ingester.is_schema_set()
+
+
+    async def open_connection(self, mode="dev", config_filename=None, secrets_filename=None):
+
+        """
+
+        Take a user provided configuration and connect to a mongo DB collection.
+
+        Uses the same config and secrets files as MetadataMongoIngester.open_connection.
+
+        Parameters:
+
+            mode (str) : Either "dev", "test", or "prod" for development, test, or production
+
+            config_filename (str): Absolute path to a config file. If None, it will look in the
+                user's home directory for a file named "ingester_config.cfg".
+
+            secrets_filename (str): Absolute path to a secrets file. If None, it will look in
+                the user's home directory for a file named "ingester_secrets.cfg"
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if AsyncMongoClient is None:
+            return "Error: no asyncio mongodb client, install pymongo 4.9 or later, or motor."
+
+        if mode not in ["dev", "test", "prod"]:
+            return f"Error: mode must be \"dev\", \"test\", or \"prod\", not \"{mode}\"."
+
+        # Get the configuration from the config file or return an error.
+        mongo_section = self.ingester._read_config_file(mode, config_filename)
+        if type(mongo_section) == str and mongo_section.startswith("Error"):
+            return mongo_section
+
+        # Get the password from the secrets file or return an error.
+        password = self.ingester._read_secrets_file(mode, secrets_filename)
+        if password.startswith("Error"):
+            return password
+
+        # Use the archived path aliases from the config file, if it has any.
+        if "archived_path_aliases" in mongo_section or "archived_path_pattern" in mongo_section:
+            error = self.ingester._set_key_aliases_from_config(mongo_section)
+            if error:
+                return error
+
+        # Drop or compress the fields the config file names, if any.
+        if "drop_fields" in mongo_section or "compress_fields" in mongo_section:
+            error = self.ingester._set_field_transform_from_config(mongo_section)
+            if error:
+                return error
+
+        # Get the write concern and client options, if the config file sets any.
+        write_concern = self.ingester._write_concern_from_config(mongo_section)
+        if type(write_concern) is str:
+            return write_concern
+        options = self.ingester._client_options_from_config(mongo_section)
+        if type(options) is str:
+            return options
+
+        # Try to open the connection
+        try:
+            self.db_connection = AsyncMongoClient(mongo_section["address"],
+                int(mongo_section["port"]),
+                username = mongo_section["username"], password = password,
+                authSource = mongo_section["authSource"], **options)
+        except Exception as e:
+            return f"Error: could not open mongodb connection, received exception {str(e)}."
+
+        # Get the collection from the connection.
+        self.collection = self.db_connection[mongo_section["database"]][mongo_section["collection"]]
+        if write_concern:
+            self.collection = self.collection.with_options(write_concern=write_concern)
+
+        # Create an index if its not already present.
+        try:
+            await self.collection.create_index([(mongo_section["index_keys"], pymongo.ASCENDING)],
+                unique=True)
+        except Exception as e:
+            return f"Error: could not create index, received exception {str(e)}."
+
+        return None
+
+
+    async def prepare_document(self, doc):
+
+        """
+
+        Load, key correct and validate a document in the executor, keeping the result for
+        ingestion.
+
+        See MetadataMongoIngester.prepare_document, which this mirrors.
+
+        Parameters:
+            doc (str or dict):
+                If dict, metadata document to be prepared.
+                If str, absolute path to json file containing document.
+
+        Returns:
+            ValidationResult: Holds the prepared document or the error message.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.ingester.prepare_document, doc)
+
+
+    def set_schema(self, schema_filename=None):
+
+        """
+
+        Set or unset the schema file, insure its validity.
+
+        Parameters:
+            schema_filename (str): Absolute path to json schema file. If None, will clear
+            schema. I.e., no schema will be applied.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        return self.ingester.set_schema(schema_filename)
+
+
+    def set_schema_registry(self, schema_registry=None):
+
+        """
+
+        Set or unset a schema registry, to validate each document against the schema its
+        discriminator selects. See MetadataMongoIngester.set_schema_registry.
+
+        Parameters:
+            schema_registry (SchemaRegistry): Registry of the schemas to use, or None.
+
+        Returns: None
+
+        """
+
+        self.ingester.set_schema_registry(schema_registry)
+
+
+    async def validate(self, doc):
+
+        """
+
+        Validate a metadata document against the current schema, in the executor.
+
+        Parameters:
+            doc (str or dict):
+                If dict, metadata document to be validated.
+                If str, absolute path to json file containing document.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.ingester.validate, doc)
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    async def __insert_batch(self, batch):
+
+        """
+
+        Insert a batch of prepared documents with a single unordered insert_many call, and
+        give back the write slot taken for it by ingest_documents.
+
+        Parameters:
+            batch (list): (index, doc) tuples of documents that are ready to be inserted.
+
+        Returns:
+            list: (index, result) tuples, as in MetadataMongoIngester.ingest_documents.
+
+        """
+
+        errors = {}
+        try:
+            result = await self.collection.insert_many([doc for index, doc in batch],
+                ordered=False)
+            if not result.acknowledged:
+                errors = dict.fromkeys(range(len(batch)),
+                    "Error: Cannot ingest document, reason unknown.")
+
+        except pymongo.errors.BulkWriteError as e:
+            errors = {index: failure.message for index, failure in
+                self.ingester._bulk_write_failures(e, len(batch), IngestStatus.DUPLICATE).items()}
+
+        except Exception as e:
+            errors = dict.fromkeys(range(len(batch)),
+                f"Error: Cannot ingest document, received exception {str(e)}.")
+
+        finally:
+            self.__write_slots().release()
+
+        return [(index, errors.get(position)) for position, (index, doc) in enumerate(batch)]
+
+
+    async def __prepare_document(self, doc):
+
+        """
+
+        Load, key correct and validate a document in the executor, then make the document
+        to send from it there, with its fields dropped or compressed by the field transform.
+
+        Parameters:
+            doc (str or dict): Metadata document or absolute path to json file containing it.
+
+        Returns:
+            (doc, error) tuple. On success doc is the document to send as a dict and error
+            is None. On failure doc is None and error is the error message string.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        doc, failure = await loop.run_in_executor(self.executor, self.ingester._prepare, doc)
+        if failure:
+            return None, failure.message
+        return await loop.run_in_executor(self.executor, self.ingester._ready_to_write, doc), None
+
+
+    def __write_slots(self):
+
+        """
+
+        Get the semaphore that caps the number of writes in flight, making it on first use
+        so that it belongs to the running event loop.
+
+        Parameters: None
+
+        Returns: asyncio.Semaphore
+
+        """
+
+        if self.write_slots is None:
+            self.write_slots = asyncio.Semaphore(self.max_in_flight)
+        return self.write_slots
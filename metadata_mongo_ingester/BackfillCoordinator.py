@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+"""
+    Split a backfill into shards that worker processes on several nodes claim, ingest and checkpoint.
+
+"""
+
+import hashlib
+import os
+import socket
+import time
+from pathlib import Path
+
+import pymongo
+
+from metadata_mongo_ingester.IngestResult import IngestStatus
+from metadata_mongo_ingester.MetadataMongoIngester import MAX_ERROR_MESSAGE_LENGTH
+
+
+# Failed files listed in a shard's document, with their messages cut to
+# MAX_ERROR_MESSAGE_LENGTH, so that a shard of failing files stays well under mongodb's
+# 16 MB document limit. The shard's failed count includes the files left out.
+MAX_SHARD_FAILURES = 1000
+
+
+class BackfillCoordinator:
+
+    """
+
+    Split a backfill into shards that worker processes on several nodes claim, ingest and checkpoint.
+
+    plan takes a directory tree, a manifest file listing one json file per line, or a list
+    of files, sorts the files and splits them into shards of shard_size files, so the same
+    input always gives the same shards. The plan and the progress of each shard are kept in
+    a mongodb collection of their own, one document per shard, which every worker reaches
+    through its usual connection. A shard document holds its file names, so shard_size must
+    keep it well under mongodb's 16 MB document limit.
+
+    A worker claims a pending shard, or one whose lease has expired, by taking a lease on it
+    for lease_seconds, with a single find_one_and_update, so two workers can never claim the
+    same shard. It ingests the shard's files in batches and checkpoints after each batch,
+    which also renews the lease; checkpoints only apply while the worker still owns the
+    shard. If a worker dies, its lease runs out and another worker picks the shard up from
+    the last checkpoint, so at most one batch is ingested again, and those documents are
+    skipped as duplicates. lease_seconds must therefore be longer than a batch takes, and
+    the nodes' clocks must agree to within a small part of it.
+
+    """
+
+    def __init__(self, collection, lease_seconds=600.0):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            collection (pymongo.collection.Collection): Collection to keep the backfill's
+                plan and leases in, e.g. one named after the backfill in the metadata
+                database. It is only used for this backfill.
+            lease_seconds (float): Seconds a claim on a shard lasts without a checkpoint.
+
+        Returns: None
+
+        """
+
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def checkpoint(self, shard, worker_id, position, results):
+
+        """
+
+        Record the progress of a claimed shard and renew the lease on it.
+
+        Parameters:
+            shard (int): The shard's id, as returned by claim.
+            worker_id (str): The worker that claimed it.
+            position (int): Number of the shard's files now ingested.
+            results (dict): File name -> IngestResult, as returned by ingest_document with
+                structured=True, for the files ingested since the last checkpoint.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:" if the
+            worker no longer holds the lease, e.g. because it ran out.
+
+        """
+
+        ingested = sum(result.status is IngestStatus.INGESTED for result in results.values())
+        skipped = sum(result.skipped for result in results.values())
+        failures = [[path, result.message[:MAX_ERROR_MESSAGE_LENGTH]]
+            for path, result in results.items() if result.failed]
+
+        return self.__while_holding(shard, worker_id, lambda now: {
+            "$set": {"checkpoint": position, "lease_expires": now + self.lease_seconds},
+            "$inc": {"ingested": ingested, "skipped": skipped, "failed": len(failures)},
+            "$push": {"failures": {"$each": failures, "$slice": MAX_SHARD_FAILURES}}})
+
+
+    def claim(self, worker_id=None):
+
+        """
+
+        Claim a shard to ingest: a pending one, or one whose lease has run out.
+
+        Parameters:
+            worker_id (str): Name of the claiming worker. If None, made from the host name
+                and process id.
+
+        Returns:
+            (shard, files, worker_id) tuple. shard is the shard's id, files the files still
+                to ingest, after the last checkpoint, and worker_id the worker's name.
+            Or
+            None if there are no shards left to claim.
+
+        """
+
+        worker_id = worker_id or self.worker_id()
+        claimed = self.__claim(worker_id)
+        if claimed is None:
+            return None
+        return claimed["_id"], claimed["paths"][claimed["checkpoint"]:], worker_id
+
+
+    def close(self):
+
+        """
+
+        Stop using the state collection. Its client belongs to the caller, who closes it.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.collection = None
+
+
+    def complete(self, shard, worker_id):
+
+        """
+
+        Mark a claimed shard as done.
+
+        Parameters:
+            shard (int): The shard's id, as returned by claim.
+            worker_id (str): The worker that claimed it.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:" if the
+            worker no longer holds the lease.
+
+        """
+
+        return self.__while_holding(shard, worker_id, lambda now: {
+            "$set": {"status": "done", "lease_expires": None}})
+
+
+    def get_failures(self):
+
+        """
+
+        Get the files that failed to ingest, up to MAX_SHARD_FAILURES of them per shard,
+        each with the start of its error message. Use dead letters to keep every rejected
+        document with its full reason.
+
+        Parameters: None
+
+        Returns: list of (path, result) tuples, in path order.
+
+        """
+
+        failures = {}
+        for shard in self.collection.find({"status": {"$exists": True}}, {"failures": 1}):
+            failures.update(shard.get("failures", []))
+        return sorted(failures.items())
+
+
+    def get_status(self):
+
+        """
+
+        Get the progress of the backfill.
+
+        Parameters: None
+
+        Returns:
+            dict: Numbers of "pending", "claimed" and "done" shards, of "files" in all, and
+                of files "ingested", "skipped" and "failed" so far.
+
+        """
+
+        status = dict.fromkeys(["pending", "claimed", "done", "files", "ingested", "skipped",
+            "failed"], 0)
+        totals = ["files", "ingested", "skipped", "failed"]
+        for shard in self.collection.find({"status": {"$exists": True}},
+            dict.fromkeys(["status"] + totals, 1)):
+            status[shard["status"]] += 1
+            for total in totals:
+                status[total] += shard[total]
+        return status
+
+
+    def plan(self, sources, glob="**/*.json", shard_size=1000):
+
+        """
+
+        Split the files to backfill into shards, unless the collection already has the plan.
+
+        Planning the same files again, e.g. from each node, does nothing but finish an
+        interrupted plan, so the backfill resumes where it is.
+
+        Parameters:
+            sources (str or list of str): A directory, whose files matching glob are
+                backfilled, a manifest file listing one file per line, or a list of files.
+            glob (str): Pattern, relative to a directory given as sources, of the files.
+            shard_size (int): Number of files per shard.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if type(shard_size) is not int or shard_size < 1:
+            return f"Error: shard_size must be a positive integer, not {shard_size}."
+
+        paths = self.__manifest(sources, glob)
+        if type(paths) is str:
+            return paths
+
+        digest = hashlib.sha256(f"{shard_size}\n".encode())
+        for path in paths:
+            digest.update(path.encode() + b"\n")
+        digest = digest.hexdigest()
+
+        # The plan document is inserted first, so that only one set of files is ever
+        # planned. If it is already there, the same plan may have been interrupted, so the
+        # shards are inserted again; those already stored are left as they are.
+        try:
+            self.collection.insert_one({"_id": "plan", "digest": digest, "planned": False})
+        except pymongo.errors.DuplicateKeyError:
+            stored = self.collection.find_one({"_id": "plan"})
+            if stored["digest"] != digest:
+                return (f"Error: backfill {self.collection.name} already holds the plan of a "
+                    "different set of files.")
+            if stored["planned"]:
+                return None
+
+        self.collection.create_index([("status", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+        shards = [{"_id": start // shard_size, "paths": paths[start:start + shard_size],
+            "files": len(paths[start:start + shard_size]), "status": "pending", "owner": None,
+            "lease_expires": None, "checkpoint": 0, "ingested": 0, "skipped": 0, "failed": 0,
+            "claims": 0, "failures": []} for start in range(0, len(paths), shard_size)]
+        if shards:
+            try:
+                self.collection.insert_many(shards, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+        self.collection.update_one({"_id": "plan"}, {"$set": {"planned": True}})
+
+        return None
+
+
+    def release(self, shard, worker_id):
+
+        """
+
+        Give up a claimed shard, e.g. when a worker is stopped, so another worker can take
+        it over from its last checkpoint without waiting for the lease to run out.
+
+        Parameters:
+            shard (int): The shard's id, as returned by claim.
+            worker_id (str): The worker that claimed it.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:" if the
+            worker no longer holds the lease.
+
+        """
+
+        return self.__while_holding(shard, worker_id, lambda now: {
+            "$set": {"status": "pending", "owner": None, "lease_expires": None}})
+
+
+    def run_worker(self, ingester, worker_id=None, batch_size=100, dead_letters=None,
+        max_shards=None):
+
+        """
+
+        Claim and ingest shards until there are none left.
+
+        Parameters:
+            ingester (MetadataMongoIngester): Ingester with an open connection, and the
+                schema and settings to use.
+            worker_id (str): Name of this worker. If None, made from the host name and
+                process id.
+            batch_size (int): Number of files ingested between checkpoints.
+            dead_letters (DeadLetters): If given, rejected files are recorded in it.
+            max_shards (int): If given, stop after this many shards.
+
+        Returns:
+            dict: Numbers of "shards" finished and of files "ingested", "skipped" and
+                "failed" by this worker.
+            Or
+            str: An error message beginning with "Error:".
+
+        """
+
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+
+        worker_id = worker_id or self.worker_id()
+        summary = {"shards": 0, "ingested": 0, "skipped": 0, "failed": 0}
+        while max_shards is None or summary["shards"] < max_shards:
+            claimed = self.__claim(worker_id)
+            if claimed is None:
+                break
+            shard = claimed["_id"]
+            position = claimed["checkpoint"]
+            files = claimed["paths"][position:]
+
+            lost = False # Whether the lease ran out and another worker took the shard over
+            try:
+                for start in range(0, len(files), batch_size):
+                    batch = files[start:start + batch_size]
+                    results = ingester.ingest_documents(batch, batch_size,
+                        dead_letters=dead_letters, structured=True)
+                    if type(results) is str:
+                        self.release(shard, worker_id)
+                        return results
+
+                    results = dict(zip(batch, results))
+                    for result in results.values():
+                        if result.failed:
+                            summary["failed"] += 1
+                        elif result.skipped:
+                            summary["skipped"] += 1
+                        else:
+                            summary["ingested"] += 1
+
+                    position += len(batch)
+                    if self.checkpoint(shard, worker_id, position, results):
+                        lost = True
+                        break
+            except BaseException:
+                self.release(shard, worker_id)
+                raise
+
+            if not lost and not self.complete(shard, worker_id):
+                summary["shards"] += 1
+
+        return summary
+
+
+    def worker_id(self):
+
+        """
+
+        Make a name for this worker process, unique across nodes.
+
+        Parameters: None
+
+        Returns: str, e.g. "node1:12345".
+
+        """
+
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __claim(self, worker_id):
+
+        """
+
+        Take the lease on the first pending shard, or the first whose lease has run out, in
+        one atomic update.
+
+        Parameters:
+            worker_id (str): Name of the claiming worker.
+
+        Returns: dict. The claimed shard's document, or None if there are none left.
+
+        """
+
+        now = time.time()
+        return self.collection.find_one_and_update(
+            {"$or": [{"status": "pending"},
+                {"status": "claimed", "lease_expires": {"$lt": now}}]},
+            {"$set": {"status": "claimed", "owner": worker_id,
+                "lease_expires": now + self.lease_seconds}, "$inc": {"claims": 1}},
+            sort=[("_id", pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+
+
+    def __manifest(self, sources, glob):
+
+        """
+
+        List the files to backfill, sorted, without duplicates.
+
+        Parameters:
+            sources (str or list of str): As for plan.
+            glob (str): As for plan.
+
+        Returns:
+            list of str: Absolute paths to the files.
+            Or
+            str: An error message beginning with "Error:".
+
+        """
+
+        if type(sources) is str:
+            if os.path.isdir(sources):
+                paths = [str(path) for path in Path(sources).glob(glob) if path.is_file()]
+            elif os.path.isfile(sources):
+                try:
+                    with open(sources, 'r') as f:
+                        paths = [line.strip() for line in f if line.strip()]
+                except (OSError, UnicodeDecodeError) as e:
+                    return f"Error: could not read manifest {sources}, received exception {str(e)}."
+            else:
+                return f"Error: {sources} is not a directory or manifest file."
+        else:
+            paths = list(sources)
+
+        return sorted({os.path.abspath(path) for path in paths})
+
+
+    def __while_holding(self, shard, worker_id, update):
+
+        """
+
+        Update a shard's state, if the worker still holds the lease on it. The check and
+        the update are one atomic update_one.
+
+        Parameters:
+            shard (int): The shard's id.
+            worker_id (str): The worker that claimed it.
+            update (callable): Called as update(now) to give the update document.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:" if the
+            worker no longer holds the lease.
+
+        """
+
+        result = self.collection.update_one({"_id": shard, "status": "claimed",
+            "owner": worker_id}, update(time.time()))
+        if result.matched_count == 0:
+            return f"Error: worker {worker_id} no longer holds the lease on shard {shard}."
+        return None
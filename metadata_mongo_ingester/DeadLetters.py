@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+    Keep the documents a bulk ingestion rejected, with why and where they failed, so they can be replayed.
+
+"""
+
+import datetime
+import json
+import threading
+
+from metadata_mongo_ingester.ValidationResult import ValidationResult
+
+
+class DeadLetters:
+
+    """
+
+    Keep the documents a bulk ingestion rejected, with why and where they failed, so they can be replayed.
+
+    Records go to an NDJSON file, one per line, or to a MongoDB collection. Each record has:
+        "reason": the result string the ingester returned for the document.
+        "stage": where it failed, "load", "correct", "validate" or "insert".
+        "source": the json file the document came from, or None if given as a dict.
+        "position": the document's index in the list given to ingest_documents, or None.
+        "offset": the document's byte offset in a file given to ingest_stream, or None.
+        "doc": the document, if it was loaded, without its _id.
+        "recorded_at": when the record was made, as an ISO 8601 string.
+    Duplicates and other skipped documents are not recorded. Pass a DeadLetters to
+    MetadataMongoIngester.replay_dead_letters to ingest the recorded documents again.
+
+    """
+
+    STAGES = ("load", "correct", "validate", "insert")
+
+    def __init__(self, filename=None, collection=None):
+
+        """
+
+        Open the dead letters. Give either a file name or a collection.
+
+        Parameters:
+            filename (str): Absolute path to an NDJSON file. Records are appended to it.
+            collection (pymongo.collection.Collection): Collection to insert records into.
+
+        Returns: None
+
+        Raises: ValueError unless exactly one of filename and collection is given.
+
+        """
+
+        if (filename is None) == (collection is None):
+            raise ValueError("give either a dead letter filename or a collection")
+
+        self.collection = collection
+        self.count = 0 # Records made since opening
+        self.file = None # Opened on the first record
+        self.filename = filename
+        self.lock = threading.Lock()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __iter__(self):
+
+        """
+
+        Read the records, in the order they were made.
+
+        Parameters: None
+
+        Yields: dict. Each record, as described in the class help.
+
+        """
+
+        if self.collection is not None:
+            yield from self.collection.find({}, {"_id": 0})
+            return
+
+        self.flush()
+        try:
+            f = open(self.filename, 'r')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def close(self):
+
+        """
+
+        Flush and close the file, if one is open.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+    def flush(self):
+
+        """
+
+        Write any buffered records to the file.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+    def record(self, reason, stage, doc=None, source=None, position=None, offset=None):
+
+        """
+
+        Record a rejected document.
+
+        Parameters:
+            reason (str): The result string the ingester returned for the document.
+            stage (str): One of STAGES.
+            doc (dict, str or ValidationResult): The document, the json file it is in, or
+                the result of preparing it. None if it was not loaded.
+            source (str): The json file the document came from, if not given as doc.
+            position (int): The document's index in its input list.
+            offset (int): The document's byte offset in a streamed file.
+
+        Returns: None
+
+        """
+
+        if type(doc) is ValidationResult:
+            source = source or doc.source
+            doc = doc.doc
+        if type(doc) is str:
+            source = doc
+            doc = None
+        if type(doc) is dict:
+            doc = {key: value for key, value in doc.items() if key != "_id"}
+
+        record = {"reason": reason, "stage": stage, "source": source, "position": position,
+            "offset": offset, "doc": doc,
+            "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+        with self.lock:
+            if self.collection is not None:
+                self.collection.insert_one(record)
+            else:
+                if self.file is None:
+                    self.file = open(self.filename, 'a')
+                self.file.write(json.dumps(record, default=str) + "\n")
+            self.count += 1
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+
+"""
+    Watch directories for new or changed metadata files and ingest them as they appear.
+
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+
+
+class DirectoryWatcher:
+
+    """
+
+    Watch directories for new or changed metadata files and ingest them as they appear.
+
+    On Linux, directories are watched with inotify, so a new file is seen as soon as it is
+    written; elsewhere, or if inotify can't be used, the directories are scanned every
+    poll_interval seconds. A file is only ingested once its size and modification time have
+    stayed the same for settle_time seconds, so files still being written or copied are
+    left alone. Files that are ready are collected for up to batch_window seconds and then
+    ingested together with the ingester's ingest_documents, reusing its connection and
+    schema. Files already ingested are remembered, by size and modification time, and in
+    the ledger if one is given, so only new or changed files are ingested. A changed file
+    replaces its stored document only if the ingester is in upsert mode.
+
+    """
+
+    def __init__(self, ingester, paths, glob="**/*.json", poll_interval=2.0, settle_time=2.0,
+        batch_window=1.0, batch_size=1000, ledger=None, dead_letters=None, ingest_existing=True,
+        use_inotify=True, structured=False):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            ingester (MetadataMongoIngester): Ingester with an open connection, and the
+                schema and settings to use.
+            paths (list of str): Directories to watch, with their subdirectories.
+            glob (str): Pattern, relative to a watched directory, of the files to ingest.
+            poll_interval (float): Seconds between scans, if polling.
+            settle_time (float): Seconds a file must go unchanged before it is ingested.
+            batch_window (float): Seconds to collect ready files for before ingesting them.
+            batch_size (int): Maximum number of files ingested at once.
+            ledger (IngestionLedger): If given, files are recorded in it, and files it
+                records as ingested and unchanged are skipped, e.g. after a restart.
+            dead_letters (DeadLetters): If given, rejected files are recorded in it.
+            ingest_existing (bool): If True, files already in the directories when watching
+                starts are ingested (or skipped by the ledger). If False, only files created
+                or changed afterwards are.
+            use_inotify (bool): If False, always poll.
+            structured (bool): If True, give each file's result as an IngestResult.
+
+        Returns: None
+
+        """
+
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.candidates = {} # File name -> (size, mtime_ns, when it was last seen to change)
+        self.dead_letters = dead_letters
+        self.glob = glob
+        self.ingest_existing = ingest_existing
+        self.ingester = ingester
+        self.inotify = None # _Inotify, if watching with inotify
+        self.ledger = ledger
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.poll_interval = poll_interval
+        self.ready = {} # File name -> (size, mtime_ns), of the files ready to ingest
+        self.seen = None # File name -> (size, mtime_ns) of each file ingested or skipped
+        self.settle_time = settle_time
+        self.structured = structured
+        self.use_inotify = use_inotify
+        self.window_start = None # When the first file in ready became ready
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def close(self):
+
+        """
+
+        Stop watching, closing the inotify instance if there is one.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.seen = None
+
+
+    def run(self, stop=None, on_results=None):
+
+        """
+
+        Watch and ingest until stopped.
+
+        Parameters:
+            stop (threading.Event): Watching stops once this is set. If None, it runs until
+                interrupted.
+            on_results (callable): If given, called as on_results(results) after each batch,
+                with the dict of file name -> result returned by step.
+
+        Returns:
+            None when stopped, or error message string beginning with "Error:".
+
+        """
+
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            results = self.step(stop)
+            if type(results) is str:
+                return results
+            if results and on_results:
+                on_results(results)
+        return None
+
+
+    def step(self, stop=None):
+
+        """
+
+        Wait for changes, for up to poll_interval seconds, and ingest the files that are
+        ready, if their batch window has passed.
+
+        Parameters:
+            stop (threading.Event): If given, waiting ends early once it is set.
+
+        Returns:
+            dict: File name -> result, as returned by ingest_document, or an IngestResult
+                if structured, for each file ingested in this step. Empty if none were.
+            Or
+            str: An error message beginning with "Error:" if a setting is not valid or a
+                directory is missing.
+
+        """
+
+        if self.seen is None:
+            error = self.__start()
+            if error:
+                return error
+        else:
+            for filename in self.__wait_for_changes(stop):
+                self.__note_change(filename)
+
+        self.__settle()
+
+        now = time.monotonic()
+        if not self.ready or (len(self.ready) < self.batch_size and
+            now - self.window_start < self.batch_window):
+            return {}
+
+        filenames = list(self.ready)[:self.batch_size]
+        return self.__ingest(filenames)
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __start(self):
+
+        """
+
+        Check the settings, start watching and find the files already there.
+
+        Parameters: None
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if type(self.batch_size) is not int or self.batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {self.batch_size}."
+        for path in self.paths:
+            if not os.path.isdir(path):
+                return f"Error: {path} is not a directory."
+
+        if self.use_inotify:
+            self.inotify = _Inotify.open()
+            if self.inotify is not None:
+                for path in self.paths:
+                    self.inotify.add_tree(path)
+
+        self.seen = {}
+        for filename in self.__scan():
+            if self.ingest_existing:
+                self.__note_change(filename)
+            else:
+                stat = self.__stat(filename)
+                if stat is not None:
+                    self.seen[filename] = stat
+        return None
+
+
+    def __ingest(self, filenames):
+
+        """
+
+        Ingest ready files, remembering them as seen.
+
+        Parameters:
+            filenames (list of str): Files to ingest.
+
+        Returns:
+            dict: File name -> result.
+
+        """
+
+        for filename in filenames:
+            self.seen[filename] = self.ready.pop(filename)
+        self.window_start = time.monotonic() if self.ready else None
+
+        results = self.ingester.ingest_documents(filenames, self.batch_size, self.ledger,
+            self.dead_letters, structured=self.structured)
+        if type(results) is str:
+            error = IngestResult(IngestStatus.FAILED, None, results) if self.structured else results
+            results = [error] * len(filenames)
+
+        # A file is not ingested again until it changes, whatever the result.
+        return dict(zip(filenames, results))
+
+
+    def __matches(self, filename):
+
+        """
+
+        Tell whether a file beneath a watched directory matches the glob.
+
+        Parameters:
+            filename (str): Absolute path to the file.
+
+        Returns: bool.
+
+        """
+
+        for path in self.paths:
+            if filename.startswith(path + os.sep):
+                relative = filename[len(path) + 1:]
+                if fnmatch.fnmatch(relative, self.glob):
+                    return True
+                # "**/" also matches no directories at all, as in Path.glob.
+                if self.glob.startswith("**/") and fnmatch.fnmatch(relative, self.glob[3:]):
+                    return True
+        return False
+
+
+    def __note_change(self, filename):
+
+        """
+
+        Note that a file may be new or changed, making it a candidate to ingest.
+
+        Parameters:
+            filename (str): Absolute path to the file.
+
+        Returns: None
+
+        """
+
+        if not self.__matches(filename):
+            return
+        stat = self.__stat(filename)
+        if stat is None:
+            self.candidates.pop(filename, None)
+            self.ready.pop(filename, None)
+            return
+        if stat == self.seen.get(filename) or stat == self.ready.get(filename):
+            return
+
+        # A ready file that changes again waits to settle again.
+        self.ready.pop(filename, None)
+        candidate = self.candidates.get(filename)
+        if candidate is None or candidate[:2] != stat:
+            self.candidates[filename] = stat + (time.monotonic(),)
+
+
+    def __scan(self):
+
+        """
+
+        Find every file matching the glob beneath the watched directories.
+
+        Parameters: None
+
+        Returns: list of str. Absolute paths to the files.
+
+        """
+
+        filenames = []
+        for path in self.paths:
+            filenames += [str(filename) for filename in Path(path).glob(self.glob)
+                if filename.is_file()]
+        return filenames
+
+
+    def __settle(self):
+
+        """
+
+        Move the candidates that have stopped changing to the ready list.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        now = time.monotonic()
+        for filename, (size, mtime_ns, changed_at) in list(self.candidates.items()):
+            stat = self.__stat(filename)
+            if stat is None:
+                del self.candidates[filename]
+            elif stat != (size, mtime_ns):
+                self.candidates[filename] = stat + (now,)
+            elif now - changed_at >= self.settle_time:
+                if not self.ready:
+                    self.window_start = now
+                self.ready[filename] = stat
+                del self.candidates[filename]
+
+
+    def __stat(self, filename):
+
+        """
+
+        Get a file's size and modification time.
+
+        Parameters:
+            filename (str): Absolute path to the file.
+
+        Returns: (size, mtime_ns) tuple, or None if it doesn't exist.
+
+        """
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+
+    def __wait_for_changes(self, stop):
+
+        """
+
+        Wait for files to be created or changed.
+
+        Parameters:
+            stop (threading.Event): If given, waiting ends early once it is set.
+
+        Returns: iterable of str. Absolute paths of files that may be new or changed.
+
+        """
+
+        # Don't sleep through a candidate settling or a batch window closing.
+        timeout = self.poll_interval
+        if self.candidates or self.ready:
+            timeout = min(timeout, max(0.05, min(self.settle_time, self.batch_window)))
+
+        if self.inotify is not None:
+            if stop is not None and stop.is_set():
+                return []
+            filenames = self.inotify.read(timeout)
+            if filenames is not None:
+                return filenames
+            # The event queue overflowed, so events were lost. Scan everything.
+            return self.__scan()
+
+        if stop is not None:
+            stop.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return [filename for filename in self.__scan()
+            if self.__stat(filename) != self.seen.get(filename)]
+
+
+class _Inotify:
+
+    """
+
+    Minimal wrapper around Linux inotify, through ctypes, to watch directory trees.
+
+    """
+
+    # Event masks, from <sys/inotify.h>.
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, libc, fd):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            libc (ctypes.CDLL): The C library.
+            fd (int): inotify file descriptor.
+
+        Returns: None
+
+        """
+
+        self.directories = {} # Watch descriptor -> directory
+        self.fd = fd
+        self.libc = libc
+
+
+    @classmethod
+    def open(cls):
+
+        """
+
+        Make an inotify instance.
+
+        Parameters: None
+
+        Returns: _Inotify, or None if inotify is not available.
+
+        """
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+
+    def add_tree(self, path):
+
+        """
+
+        Watch a directory and its subdirectories.
+
+        Parameters:
+            path (str): Absolute path to the directory.
+
+        Returns:
+            list of str: Files already in the directories, which may have been created
+                before they were watched.
+
+        """
+
+        filenames = []
+        for directory, subdirectories, files in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd >= 0:
+                self.directories[wd] = directory
+            filenames += [os.path.join(directory, name) for name in files]
+        return filenames
+
+
+    def close(self):
+
+        """ Close the inotify file descriptor. """
+
+        os.close(self.fd)
+
+
+    def read(self, timeout):
+
+        """
+
+        Wait for events, and read them.
+
+        Parameters:
+            timeout (float): Seconds to wait for the first event.
+
+        Returns:
+            list of str: Absolute paths of the files the events were about, including those
+                in newly created directories, which are watched from now on.
+            Or
+            None if events were lost because the queue overflowed.
+
+        """
+
+        readable, writable, errored = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        filenames = []
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            position = 0
+            while position < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, position)
+                position += self.EVENT.size
+                name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+                position += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflowed = True
+                elif mask & self.IN_IGNORED:
+                    self.directories.pop(wd, None)
+                elif wd in self.directories and name:
+                    filename = os.path.join(self.directories[wd], name)
+                    if mask & self.IN_ISDIR:
+                        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                            filenames += self.add_tree(filename)
+                    else:
+                        filenames.append(filename)
+
+        return None if overflowed else filenames
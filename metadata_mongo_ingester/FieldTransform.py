@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+    Drop or compress bulky fields of metadata documents before they are stored.
+
+"""
+
+import json
+import zlib
+
+import bson
+
+
+class FieldTransform:
+
+    """
+
+    Drop or compress bulky fields of metadata documents before they are stored.
+
+    Metadata documents can hold large, repetitive arrays, e.g. "samples", "runs" or
+    "Fastq_Filenames". Fields listed in drop are removed. Fields listed in compress are
+    replaced, if their json is at least min_bytes long, by a document holding the zlib
+    compressed json:
+        {"compressed": "zlib+json", "data": Binary(...)}
+    expand reverses this. Fields are named by key, or by dotted path to a key in a nested
+    document, e.g. "project.software". Documents are transformed just before they are
+    written, so the schema sees the whole document, and a document that fails to be
+    written is kept as it was.
+
+    """
+
+    ENCODING = "zlib+json" # Value of "compressed" in a compressed field
+
+    def __init__(self, drop=(), compress=(), min_bytes=1024, level=6):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            drop (list of str): Fields to remove.
+            compress (list of str): Fields to compress.
+            min_bytes (int): Fields whose json is shorter than this are left as they are.
+            level (int): zlib compression level, 1 (fastest) to 9 (smallest).
+
+        Returns: None
+
+        Raises: ValueError if level is not a zlib compression level.
+
+        """
+
+        if type(level) is not int or not 1 <= level <= 9:
+            raise ValueError(f"compression level must be an integer from 1 to 9, not {level}")
+
+        self.compress = [tuple(field.split(".")) for field in compress]
+        self.drop = [tuple(field.split(".")) for field in drop]
+        self.level = level
+        self.min_bytes = min_bytes
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def apply(self, doc):
+
+        """
+
+        Drop and compress the fields of a document.
+
+        Parameters:
+            doc (dict): Metadata document. It is not changed; the documents along the paths
+                of the transformed fields are copied, and the rest is shared.
+
+        Returns: dict. The transformed document.
+
+        """
+
+        doc = dict(doc)
+        for path in self.drop:
+            parent = self.__copied_parent(doc, path)
+            if parent is not None:
+                parent.pop(path[-1], None)
+
+        for path in self.compress:
+            parent = self.__copied_parent(doc, path)
+            if parent is None or path[-1] not in parent or self.__is_compressed(parent[path[-1]]):
+                continue
+            data = json.dumps(parent[path[-1]], separators=(",", ":"), default=str).encode()
+            if len(data) >= self.min_bytes:
+                parent[path[-1]] = {"compressed": self.ENCODING,
+                    "data": bson.Binary(zlib.compress(data, self.level))}
+
+        return doc
+
+
+    def expand(self, doc):
+
+        """
+
+        Restore the compressed fields of a stored document. Dropped fields can't be restored.
+
+        Parameters:
+            doc (dict): Document as stored, e.g. from find. It is changed in place.
+
+        Returns: dict. The document.
+
+        """
+
+        for path in self.compress:
+            parent = self.__parent(doc, path)
+            if parent is not None and self.__is_compressed(parent.get(path[-1])):
+                parent[path[-1]] = json.loads(zlib.decompress(parent[path[-1]]["data"]))
+        return doc
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __copied_parent(self, doc, path):
+
+        """
+
+        Find the document holding the last key of a path, copying each nested document on
+        the way so that the field can be changed without changing the document given to
+        apply.
+
+        Parameters:
+            doc (dict): Copy of the metadata document, made by apply.
+            path (tuple of str): Keys leading to the field.
+
+        Returns: dict, or None if the path leads through something that isn't a document.
+
+        """
+
+        parent = doc
+        for key in path[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                return None
+            parent[key] = child = dict(child)
+            parent = child
+        return parent
+
+
+    def __is_compressed(self, value):
+
+        """
+
+        Tell whether a field value is one compressed by apply.
+
+        Parameters:
+            value: The value.
+
+        Returns: bool.
+
+        """
+
+        return (isinstance(value, dict) and value.get("compressed") == self.ENCODING and
+            len(value) == 2 and "data" in value)
+
+
+    def __parent(self, doc, path):
+
+        """
+
+        Find the document holding the last key of a path.
+
+        Parameters:
+            doc (dict): Metadata document.
+            path (tuple of str): Keys leading to the field.
+
+        Returns: dict, or None if the path leads through something that isn't a document.
+
+        """
+
+        parent = doc
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                return None
+        return parent
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+"""
+    Plan the secondary indexes of a metadata collection, from the config file and the schema, and build them.
+
+"""
+
+import json
+import threading
+import time
+
+import pymongo
+
+
+class IndexPlanner:
+
+    """
+
+    Plan the secondary indexes of a metadata collection, from the config file and the schema, and build them.
+
+    Each index is a list of (field, direction) keys, where a field is a key or a dotted
+    path such as "project.PI", and a dict of create_index options, e.g. "unique", "name" or
+    "partialFilterExpression". Indexes can be added one at a time with add, from the lines
+    of the config file's indexes field with add_from_config, or from annotations in a json
+    schema with add_from_schema:
+        "x-index": true, or an object of options, on a property indexes that property.
+        "x-indexes", a list at the top of the schema, holds compound indexes, each a line
+        as in the config file or an object with "keys" and the options.
+
+    build creates the indexes one after another, in a background thread unless told not to,
+    so ingestion can go on meanwhile, and reports how long each took.
+
+    """
+
+    ANNOTATION = "x-index" # Schema keyword on a property to index it
+    ANNOTATIONS = "x-indexes" # Schema keyword listing compound indexes
+
+    def __init__(self, indexes=()):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            indexes (list): (keys, options) tuples to start with, e.g. another planner's
+                indexes.
+
+        Returns: None
+
+        """
+
+        self.indexes = [(list(keys), dict(options)) for keys, options in indexes]
+        self.lock = threading.Lock()
+        self.reports = [] # One dict per index built, see build
+        self.thread = None # Background thread building the indexes
+
+
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle, e.g. when copying an ingester into worker processes. The
+        lock and any background thread can't be pickled, so they are left out.
+
+        Parameters: None
+
+        Returns: dict of data members.
+
+        """
+
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["thread"] = None
+        return state
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore a pickled planner, with a new lock.
+
+        Parameters:
+            state (dict): Data members as returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def add(self, keys, **options):
+
+        """
+
+        Add an index to the plan. Adding the same index again does nothing.
+
+        Parameters:
+            keys (str or list): Comma separated fields, each ascending or, if it begins
+                with "-", descending, e.g. "project.Group, -project.PI". Or a list of such
+                fields, or of (field, direction) tuples.
+            options: create_index options, e.g. unique=True or
+                partialFilterExpression={"project.PI": {"$exists": True}}.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        definition = keys
+        if type(keys) is str:
+            keys = keys.split(",")
+        if not isinstance(keys, (list, tuple)) or not keys:
+            return f"Error: index keys must be a string or a list of fields, not {keys}."
+
+        index_keys = []
+        for key in keys:
+            if type(key) is str:
+                key = key.strip()
+                key = (key[1:].strip(), pymongo.DESCENDING) if key.startswith("-") else \
+                    (key, pymongo.ASCENDING)
+            elif not isinstance(key, (list, tuple)) or len(key) != 2:
+                return f"Error: index key must be a field or a (field, direction) pair, not {key}."
+            field, direction = key
+            if type(field) is not str or not field or field.startswith("$"):
+                return f"Error: invalid field {field!r} in index {definition}."
+            index_keys.append((field, direction))
+
+        for planned_keys, planned_options in self.indexes:
+            if planned_keys == index_keys:
+                if planned_options != options:
+                    return (f"Error: index on {self.__describe(index_keys)} is planned twice "
+                        "with different options.")
+                return None
+        self.indexes.append((index_keys, options))
+        return None
+
+
+    def add_from_config(self, text):
+
+        """
+
+        Add the indexes of the config file's indexes field, one per line. Each line is a
+        comma separated list of fields, as for add, optionally followed by a json object of
+        create_index options, e.g.
+            project.Group, -project.PI
+            project.GT_Project_Name_ID {"partialFilterExpression": {"project.GT_Project_Name_ID": {"$exists": true}}}
+
+        Parameters:
+            text (str): The field's value.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            keys, brace, options = line.partition("{")
+            error = self.__add_with_options(keys, brace + options, line)
+            if error:
+                return error
+        return None
+
+
+    def add_from_schema(self, schema):
+
+        """
+
+        Add the indexes annotated in a json schema.
+
+        Parameters:
+            schema (dict): The json schema.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if not isinstance(schema, dict):
+            return None
+
+        annotations = schema.get(self.ANNOTATIONS, [])
+        if not isinstance(annotations, list):
+            return f"Error: {self.ANNOTATIONS} in schema must be a list, not {annotations}."
+        for annotation in annotations:
+            if type(annotation) is str:
+                error = self.add_from_config(annotation)
+            elif isinstance(annotation, dict) and "keys" in annotation:
+                options = {name: value for name, value in annotation.items() if name != "keys"}
+                error = self.add(annotation["keys"], **options)
+            else:
+                error = f"Error: invalid index {annotation} in schema {self.ANNOTATIONS}."
+            if error:
+                return error
+
+        return self.__add_annotated_properties(schema, "")
+
+
+    def build(self, collection, background=True, on_built=None):
+
+        """
+
+        Create the planned indexes, one after another.
+
+        Each is reported as a dict holding its "name", "keys", the "seconds" its build took
+        and an "error" message, or None if it was built. An index that already exists is
+        reported as built, quickly.
+
+        Parameters:
+            collection (pymongo.collection.Collection): Collection to index.
+            background (bool): If True, build in a background thread and return at once;
+                wait gets the reports. Otherwise return when every index is built.
+            on_built (callable): If given, called with each report as its build ends.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if self.is_building():
+            return "Error: indexes are already being built."
+
+        self.reports = []
+        if not background:
+            self.__build(collection, on_built)
+            return None
+
+        self.thread = threading.Thread(target=self.__build, args=(collection, on_built),
+            name="index-builds", daemon=True)
+        self.thread.start()
+        return None
+
+
+    def is_building(self):
+
+        """
+
+        Tell whether indexes are being built in the background.
+
+        Parameters: None
+
+        Returns: bool.
+
+        """
+
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def wait(self, timeout=None):
+
+        """
+
+        Wait for the background builds to finish.
+
+        Parameters:
+            timeout (float): Seconds to wait at most. If None, wait until they finish.
+
+        Returns:
+            list of dict: The reports of the indexes, as for build. Or None if they are
+                still being built after timeout seconds.
+
+        """
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                return None
+        with self.lock:
+            return list(self.reports)
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __add_with_options(self, keys, options, where):
+
+        """
+
+        Add an index whose options are a json object, or empty.
+
+        Parameters:
+            keys (str): Comma separated fields, as for add.
+            options (str): json object of create_index options, or "".
+            where (str): The definition, for error messages.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if options:
+            try:
+                options = json.loads(options)
+            except ValueError as e:
+                return f"Error: invalid options in index {where}, received exception {str(e)}."
+            if not isinstance(options, dict):
+                return f"Error: options of index {where} must be a json object."
+        return self.add(keys, **(options or {}))
+
+
+    def __add_annotated_properties(self, schema, path):
+
+        """
+
+        Add an index for each property of a schema, or of its subschemas, annotated with
+        ANNOTATION.
+
+        Parameters:
+            schema (dict): The schema, or a subschema.
+            path (str): Dotted path to the documents the subschema describes, "" at the top.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        annotation = schema.get(self.ANNOTATION)
+        if annotation and path:
+            if annotation is True:
+                annotation = {}
+            if not isinstance(annotation, dict):
+                return f"Error: {self.ANNOTATION} on {path} must be true or an object of options."
+            error = self.add([path], **annotation)
+            if error:
+                return error
+
+        subschemas = []
+        properties = schema.get("properties")
+        if isinstance(properties, dict):
+            subschemas += [(subschema, f"{path}.{key}" if path else key)
+                for key, subschema in properties.items()]
+        # Arrays of documents are indexed by the same path, as multikey indexes.
+        if isinstance(schema.get("items"), dict):
+            subschemas.append((schema["items"], path))
+        for keyword in ["allOf", "anyOf", "oneOf"]:
+            if isinstance(schema.get(keyword), list):
+                subschemas += [(subschema, path) for subschema in schema[keyword]]
+
+        for subschema, subpath in subschemas:
+            if isinstance(subschema, dict):
+                error = self.__add_annotated_properties(subschema, subpath)
+                if error:
+                    return error
+        return None
+
+
+    def __build(self, collection, on_built):
+
+        """
+
+        Create the planned indexes one after another, recording a report for each.
+
+        Parameters:
+            collection (pymongo.collection.Collection): Collection to index.
+            on_built (callable): As for build.
+
+        Returns: None
+
+        """
+
+        for keys, options in self.indexes:
+            report = {"name": options.get("name"), "keys": self.__describe(keys),
+                "seconds": 0.0, "error": None}
+            start = time.perf_counter()
+            try:
+                report["name"] = collection.create_index(keys, **options)
+            except Exception as e:
+                report["error"] = (f"Error: could not create index on {report['keys']}, "
+                    f"received exception {str(e)}.")
+            report["seconds"] = time.perf_counter() - start
+
+            with self.lock:
+                self.reports.append(report)
+            if on_built:
+                on_built(report)
+
+
+    def __describe(self, keys):
+
+        """
+
+        Describe index keys the way the config file writes them.
+
+        Parameters:
+            keys (list): (field, direction) tuples.
+
+        Returns: str, e.g. "project.Group, -project.PI".
+
+        """
+
+        return ", ".join(field if direction == pymongo.ASCENDING else "-" + field
+            if direction == pymongo.DESCENDING else f"{field}:{direction}"
+            for field, direction in keys)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+    Hold the outcome of ingesting one metadata document, as a status rather than a message to parse.
+
+"""
+
+import enum
+
+
+class IngestStatus(enum.Enum):
+
+    """ What became of a document. """
+
+    INGESTED = "ingested"
+    DUPLICATE = "duplicate" # Its key is already in the collection
+    UNCHANGED = "unchanged" # Upsert mode, and it is stored with the same content
+    ALREADY_INGESTED = "already_ingested" # The ledger has the file, unchanged
+    NOT_ROUTED = "not_routed" # Routed away from a target, by MultiTargetIngester
+    FAILED = "failed"
+
+
+# Message of each status a document is skipped with, as the string results give it.
+SKIPPED_MESSAGES = {
+    IngestStatus.DUPLICATE: "Duplicate key, skipped",
+    IngestStatus.UNCHANGED: "Unchanged, skipped",
+    IngestStatus.ALREADY_INGESTED: "Already ingested, skipped",
+    IngestStatus.NOT_ROUTED: "Not routed, skipped",
+}
+
+
+class IngestResult:
+
+    """
+
+    Hold the outcome of ingesting one metadata document, as a status rather than a message to parse.
+
+    Returned by the ingest methods of MetadataMongoIngester when called with
+    structured=True. Telling outcomes apart, or counting them, only compares statuses, e.g.
+    collections.Counter(result.status for result in results). The error message of a
+    failed document is only put together, e.g. from a long exception, when message is
+    first read.
+
+    stage is where the document stopped: "ledger", "load", "correct", "validate" or
+    "insert", as in the dead letters. inserted_id is the _id of an inserted document; it is
+    None in upsert mode, as a replaced document keeps its stored _id.
+
+    """
+
+    __slots__ = ("inserted_id", "stage", "status", "_message")
+
+    def __init__(self, status, stage=None, message=None, inserted_id=None):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            status (IngestStatus): What became of the document.
+            stage (str): Where the document stopped, or None.
+            message (str or tuple): The error message, or a tuple of parts whose str
+                values make it up, joined when message is first read. If None, the
+                status's usual message, if it has one.
+            inserted_id: The _id of the inserted document, or None.
+
+        Returns: None
+
+        """
+
+        self.inserted_id = inserted_id
+        self.stage = stage
+        self.status = status
+        self._message = message
+
+
+    def __eq__(self, other):
+        if type(other) is not IngestResult:
+            return NotImplemented
+        return (self.status, self.stage, self.message, self.inserted_id) == \
+            (other.status, other.stage, other.message, other.inserted_id)
+
+
+    __hash__ = None
+
+
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle, e.g. when returning results from worker processes. The
+        message is put together first, as its parts may not pickle.
+
+        Parameters: None
+
+        Returns: tuple of data members.
+
+        """
+
+        return (self.inserted_id, self.stage, self.status, self.message)
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore a pickled result.
+
+        Parameters:
+            state (tuple): Data members as returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.inserted_id, self.stage, self.status, self._message = state
+
+
+    def __repr__(self):
+        stage = f" stage={self.stage}" if self.stage else ""
+        message = f" message={self.message[:80]!r}" if self.status is IngestStatus.FAILED else ""
+        return f"<IngestResult {self.status.value}{stage}{message}>"
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    @classmethod
+    def from_string(cls, result, stage=None):
+
+        """
+
+        Make a result from a string result, as returned by ingest_document.
+
+        Parameters:
+            result (str): None if the document was ingested, or the skip or error message.
+            stage (str): Where the document stopped, if known.
+
+        Returns: IngestResult.
+
+        """
+
+        if result is None:
+            return cls(IngestStatus.INGESTED, stage)
+        for status, message in SKIPPED_MESSAGES.items():
+            if result == message:
+                return cls(status, stage)
+        return cls(IngestStatus.FAILED, stage, result)
+
+
+    @property
+    def failed(self):
+
+        """ bool: True if the document could not be ingested. """
+
+        return self.status is IngestStatus.FAILED
+
+
+    @property
+    def message(self):
+
+        """ str: The skip or error message, or None if the document was ingested. """
+
+        message = self._message
+        if type(message) is tuple:
+            message = self._message = "".join(str(part) for part in message)
+        elif message is None:
+            return SKIPPED_MESSAGES.get(self.status)
+        return message
+
+
+    @property
+    def skipped(self):
+
+        """ bool: True if the document was left out on purpose, e.g. as a duplicate. """
+
+        return self.status in SKIPPED_MESSAGES
+
+
+    def as_string(self):
+
+        """
+
+        Give the result as the string ingest_document returns.
+
+        Parameters: None
+
+        Returns: None if the document was ingested, otherwise the skip or error message.
+
+        """
+
+        if self.status is IngestStatus.INGESTED:
+            return None
+        return self.message
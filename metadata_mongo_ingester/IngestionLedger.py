@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+    Record which metadata files have been ingested, so re-runs can skip them without touching MongoDB.
+
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+from metadata_mongo_ingester.IngestResult import IngestResult
+
+
+class IngestionLedger:
+
+    """
+
+    Record which metadata files have been ingested, so re-runs can skip them without touching MongoDB.
+
+    The ledger is a SQLite file holding the path, modification time, size, content hash and
+    outcome of each file ingested. A file is unchanged if its size and modification time
+    match its record, or, if only its modification time changed, if its content hash does.
+    Unchanged files whose outcome was a success or a skip don't need to be read again.
+    The ingester hashes each file from the bytes it loads it from and passes the hash to
+    record, so recording a file costs no extra read, and is_unchanged only reads a file to
+    hash it when its modification time changed. A file recorded without a hash, e.g. one
+    that could not be read, is taken as changed if it is touched. Records are committed after every batch, so an interrupted run can be resumed by
+    running it again with the same ledger.
+
+    """
+
+    def __init__(self, filename):
+
+        """
+
+        Open the ledger, creating it if needed.
+
+        Parameters:
+            filename (str): Absolute path to the SQLite ledger file.
+
+        Returns: None
+
+        """
+
+        self.filename = filename
+        self.hashes = {} # Path -> (mtime_ns, size, content hash) taken by is_unchanged
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER,
+            content_hash TEXT,
+            outcome TEXT,
+            recorded_at REAL)""")
+        self.db.commit()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def close(self):
+
+        """
+
+        Commit any pending records and close the ledger.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+    def commit(self):
+
+        """
+
+        Commit the records made since the last commit.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.db.commit()
+
+
+    def get_outcome(self, path):
+
+        """
+
+        Get the recorded outcome of a file.
+
+        Parameters:
+            path (str): Absolute path to the file.
+
+        Returns:
+            None if the file was ingested successfully or has no record, otherwise its result
+            string, e.g. "Duplicate key, skipped" or an error message.
+
+        """
+
+        row = self.db.execute("SELECT outcome FROM files WHERE path = ?",
+            (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+
+    def is_unchanged(self, path):
+
+        """
+
+        Tell whether a file was ingested or skipped before and has not changed since.
+
+        Parameters:
+            path (str): Absolute path to the file.
+
+        Returns: bool. True if the file does not need to be ingested again.
+
+        """
+
+        path = os.path.abspath(path)
+        row = self.db.execute("SELECT mtime_ns, size, content_hash, outcome FROM files WHERE path = ?",
+            (path,)).fetchone()
+        if not row:
+            return False
+
+        mtime_ns, size, content_hash, outcome = row
+        if IngestResult.from_string(outcome).failed:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return True
+
+        # The file was touched. If its content is the same, note the new time and skip it.
+        # Otherwise keep the hash for record, as the file is about to be ingested.
+        new_hash = self.__hash_file(path)
+        if new_hash != content_hash:
+            self.hashes[path] = (stat.st_mtime_ns, stat.st_size, new_hash)
+            return False
+        self.db.execute("UPDATE files SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, path))
+        return True
+
+
+    def record(self, path, result, file_hash=None):
+
+        """
+
+        Record the outcome of ingesting a file. Call commit to make it permanent.
+
+        Parameters:
+            path (str): Absolute path to the file.
+            result (IngestResult or str): The file's result, as returned by ingest_document.
+                It is kept as the string result.
+            file_hash (tuple): (mtime_ns, size, content_hash) of the file when it was read
+                for ingesting, as given by JsonLoader.load_file with digest=True. If None, or
+                if the file changed since, the hash taken by is_unchanged is kept if it is
+                still current, otherwise no hash is recorded.
+
+        Returns: None
+
+        """
+
+        if type(result) is IngestResult:
+            result = result.as_string()
+
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+
+        # Keep the hash taken when the file was read, or by is_unchanged, if the file hasn't
+        # changed since.
+        content_hash = None
+        taken = self.hashes.pop(path, None)
+        for candidate in (file_hash, taken):
+            if stat and candidate and candidate[:2] == (stat.st_mtime_ns, stat.st_size):
+                content_hash = candidate[2]
+                break
+
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns if stat else None, stat.st_size if stat else None,
+            content_hash, result, time.time()))
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __hash_file(self, path):
+
+        """
+
+        Compute the sha256 hash of a file's content.
+
+        Parameters:
+            path (str): Absolute path to the file.
+
+        Returns: str. Hex digest of the hash.
+
+        """
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
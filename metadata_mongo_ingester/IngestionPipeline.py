@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+"""
+    Ingest documents through read, prepare and write stages joined by bounded queues, so memory use stays bounded.
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import time
+
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+from metadata_mongo_ingester.MetadataMongoIngester import (_init_pool_worker,
+    _prepare_in_pool_worker)
+
+
+class IngestionPipeline:
+
+    """
+
+    Ingest documents through read, prepare and write stages joined by bounded queues, so memory use stays bounded.
+
+    Read threads load json files. Prepare threads, or processes, key correct and validate
+    the loaded documents. Write threads insert the prepared documents in batches, with the
+    ingester's insert or upsert mode. Between the stages, a queue holds at most
+    max_queued_docs documents and max_queued_bytes bytes of json; a stage that gets ahead
+    waits for the next one to catch up. The documents in memory at once are therefore at
+    most those in the two queues, one per read and prepare worker, and a batch per writer,
+    however many documents there are.
+
+    """
+
+    def __init__(self, ingester, read_threads=2, prepare_threads=1, prepare_processes=0,
+        write_threads=1, batch_size=1000, max_queued_docs=1000, max_queued_bytes=1 << 28):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            ingester (MetadataMongoIngester): Ingester with the connection, schema and
+                settings to use.
+            read_threads (int): Number of threads loading json files.
+            prepare_threads (int): Number of threads key correcting and validating
+                documents. Ignored if prepare_processes is set.
+            prepare_processes (int): If not 0, the number of worker processes key correcting
+                and validating documents instead. Validation is CPU bound, so this is faster
+                than threads on a multicore machine, at the cost of pickling each document.
+            write_threads (int): Number of threads inserting batches.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            max_queued_docs (int): Maximum number of documents in each queue between stages.
+            max_queued_bytes (int): Maximum size, in bytes of json, of the documents in each
+                queue. Documents given as dicts count as 0 bytes. A single document larger
+                than this is still let through, alone.
+
+        Returns: None
+
+        """
+
+        self.batch_size = batch_size
+        self.ingester = ingester
+        self.max_queued_bytes = max_queued_bytes
+        self.max_queued_docs = max_queued_docs
+        self.prepare_processes = prepare_processes
+        self.prepare_threads = prepare_threads
+        self.queues = [] # The queues of the last run, to check their high water marks
+        self.read_threads = read_threads
+        self.write_threads = write_threads
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def run(self, docs, on_result=None):
+
+        """
+
+        Ingest documents through the pipeline.
+
+        Parameters:
+            docs (iterable of str, dict or ValidationResult):
+                Metadata documents as dicts, absolute paths to json files containing them, or
+                documents already prepared by prepare_document. It is read as the pipeline
+                has room, so it can be a generator over any number of documents.
+            on_result (callable): If given, called as on_result(key, result) for each
+                document, from a write thread. key is the file name of a document given as a
+                file, or its position in docs otherwise. result is as returned by
+                ingest_document.
+
+        Returns:
+            dict: "ingested", "duplicates" (including any other skipped documents) and
+                "failed" counts, and "errors", a list of (key, message) tuples for each
+                document that failed.
+            Or
+            str: An error message beginning with "Error:" if a setting is not valid, or if
+                a stage stopped on an unexpected exception.
+
+        """
+
+        for name in ["read_threads", "write_threads", "batch_size", "max_queued_docs",
+            "max_queued_bytes"]:
+            value = getattr(self, name)
+            if type(value) is not int or value < 1:
+                return f"Error: {name} must be a positive integer, not {value}."
+        workers = self.prepare_processes or self.prepare_threads
+        if type(workers) is not int or workers < 1:
+            return f"Error: prepare_threads must be a positive integer, not {workers}."
+
+        loaded = _BoundedQueue(self.max_queued_docs, self.max_queued_bytes, self.read_threads)
+        prepared = _BoundedQueue(self.max_queued_docs, self.max_queued_bytes, workers)
+        self.queues = [loaded, prepared]
+
+        summary = {"ingested": 0, "duplicates": 0, "failed": 0, "errors": []}
+        summary_lock = threading.Lock()
+        failures = [] # Unexpected exceptions that stopped a stage
+
+        def record(key, result):
+            with summary_lock:
+                if result.failed:
+                    summary["failed"] += 1
+                    summary["errors"].append((key, result.message))
+                elif result.skipped:
+                    summary["duplicates"] += 1
+                else:
+                    summary["ingested"] += 1
+            if on_result:
+                on_result(key, result.as_string())
+
+        def stage(work, output):
+            try:
+                work()
+            except Exception as e:
+                failures.append(e)
+                loaded.close()
+                prepared.close()
+            finally:
+                if output is not None:
+                    output.producer_done()
+
+        sources = enumerate(docs)
+        sources_lock = threading.Lock()
+        executor = None
+        if self.prepare_processes:
+            # Each worker gets a pickled copy of the ingester, as in ingest_directory.
+            executor = ProcessPoolExecutor(max_workers=self.prepare_processes,
+                initializer=_init_pool_worker, initargs=(self.ingester,))
+
+        threads = [threading.Thread(target=stage, args=(lambda: self.__read(sources,
+            sources_lock, loaded), loaded)) for _ in range(self.read_threads)]
+        threads += [threading.Thread(target=stage, args=(lambda: self.__prepare(loaded,
+            prepared, executor), prepared)) for _ in range(workers)]
+        threads += [threading.Thread(target=stage, args=(lambda: self.__write(prepared,
+            record), None)) for _ in range(self.write_threads)]
+
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if failures:
+            return f"Error: ingestion pipeline stopped, received exception {str(failures[0])}."
+
+        return summary
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __prepare(self, loaded, prepared, executor):
+
+        """
+
+        Key correct and validate loaded documents until there are no more.
+
+        Parameters:
+            loaded (_BoundedQueue): Queue of (key, doc, failure) tuples to prepare.
+            prepared (_BoundedQueue): Queue to put prepared (key, doc, failure) tuples in.
+            executor (ProcessPoolExecutor): If given, the documents are prepared in it.
+
+        Returns: None
+
+        """
+
+        ingester = self.ingester
+        stats = ingester.stats
+        while True:
+            item, size = loaded.get()
+            if item is None:
+                return
+
+            key, doc, failure = item
+            if failure is None:
+                if executor is not None:
+                    # Documents reach this stage already read, so there is no file hash.
+                    doc, failure, snapshot = executor.submit(_prepare_in_pool_worker,
+                        doc).result()[:3]
+                    if snapshot:
+                        stats.merge(snapshot)
+                else:
+                    doc, failure = ingester._prepare(doc)
+
+            if not prepared.put((key, doc, failure), size):
+                return
+
+
+    def __read(self, sources, sources_lock, loaded):
+
+        """
+
+        Load json files from the sources until there are none left.
+
+        Parameters:
+            sources (iterator): (position, doc) tuples, shared by the read threads.
+            sources_lock (threading.Lock): Lock for taking the next source.
+            loaded (_BoundedQueue): Queue to put (key, doc, failure) tuples in.
+
+        Returns: None
+
+        """
+
+        ingester = self.ingester
+        stats = ingester.stats
+        while True:
+            with sources_lock:
+                index, doc = next(sources, (None, None))
+            if index is None:
+                return
+
+            key = index
+            size = 0
+            failure = None
+            if type(doc) is str:
+                key = doc
+                if stats is not None:
+                    start = time.perf_counter()
+                doc, size, error = ingester._load_json_file(doc)
+                if error:
+                    failure = IngestResult(IngestStatus.FAILED, "load", error)
+                if stats is not None:
+                    if error:
+                        stats.add_count("load_errors")
+                    else:
+                        stats.add_time("load", time.perf_counter() - start)
+                        stats.add_bytes(size)
+
+            if not loaded.put((key, doc, failure), size or 0):
+                return
+
+
+    def __write(self, prepared, record):
+
+        """
+
+        Insert prepared documents in batches until there are no more.
+
+        Parameters:
+            prepared (_BoundedQueue): Queue of prepared (key, doc, failure) tuples.
+            record (callable): Called as record(key, result) for each document, with its
+                IngestResult.
+
+        Returns: None
+
+        """
+
+        def prepared_docs():
+            while True:
+                item, size = prepared.get()
+                if item is None:
+                    return
+                yield item
+
+        results = self.ingester._write_results(prepared_docs(), self.batch_size)
+        for key, result in results:
+            record(key, result)
+
+
+class _BoundedQueue:
+
+    """
+
+    Queue between two pipeline stages, limited both in number of items and in bytes.
+
+    A put waits while the queue is full, unless it is empty, so an item larger than the byte
+    limit still goes through on its own. A get waits for an item, and gives (None, 0) once
+    every producer is done and the queue is empty, or the queue was closed.
+
+    """
+
+    def __init__(self, max_items, max_bytes, producers):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            max_items (int): Maximum number of items in the queue.
+            max_bytes (int): Maximum total size of the items in the queue.
+            producers (int): Number of threads putting items in the queue.
+
+        Returns: None
+
+        """
+
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.items = deque()
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.peak_bytes = 0
+        self.peak_items = 0
+        self.producers = producers
+
+
+    def close(self):
+
+        """ Stop the queue, waking every waiting thread, e.g. because a stage failed. """
+
+        with self.condition:
+            self.closed = True
+            self.items.clear()
+            self.condition.notify_all()
+
+
+    def get(self):
+
+        """ Take the next (item, size) tuple, waiting for one if needed. """
+
+        with self.condition:
+            while not self.items and self.producers and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None, 0
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.condition.notify_all()
+            return item, size
+
+
+    def producer_done(self):
+
+        """ Note that one of the producers will put no more items. """
+
+        with self.condition:
+            self.producers -= 1
+            self.condition.notify_all()
+
+
+    def put(self, item, size):
+
+        """ Add an item of the given size, waiting for room. Returns False if closed. """
+
+        with self.condition:
+            while (self.items and not self.closed and (len(self.items) >= self.max_items or
+                self.bytes + size > self.max_bytes)):
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.items.append((item, size))
+            self.bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.peak_items = max(self.peak_items, len(self.items))
+            self.condition.notify_all()
+            return True
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+    Collect timings, counts and byte throughput for metadata ingestion.
+
+"""
+
+import threading
+import time
+
+
+class IngestionStats:
+
+    """
+
+    Collect timings, counts and byte throughput for metadata ingestion.
+
+    Pass one to MetadataMongoIngester.set_stats to turn instrumentation on. Time spent in
+    each stage (load, correct, validate, insert) is summed, outcomes are counted, and the
+    bytes of json files loaded are totalled. Threads may share one IngestionStats.
+    Documents whose archived path was found under an alias are counted per alias. Hooks,
+    if given, are called as hook(metric, value) for every measurement, e.g.
+    hook("time.validate", 0.004), hook("count.duplicates", 1) or hook("alias.archivedPath",
+    1), so the numbers can be sent on to a metrics system.
+
+    """
+
+    STAGES = ("load", "correct", "validate", "insert")
+    COUNTERS = ("ingested", "duplicates", "unchanged", "skipped", "load_errors",
+        "key_corrections", "correction_errors", "validation_failures", "write_errors")
+
+    def __init__(self, hooks=None):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            hooks (list of callable): Functions called as hook(metric, value) for every
+                measurement.
+
+        Returns: None
+
+        """
+
+        self.aliases = None
+        self.bytes_loaded = 0
+        self.counts = None
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.seconds = None
+        self.started = None
+        self.reset()
+
+
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle. Hooks are left out, as they often can't be pickled; a copy
+        in a worker process only gathers numbers for the original to merge. The lock can't be
+        pickled either, and is made again by __setstate__.
+
+        Parameters: None
+
+        Returns: dict of data members.
+
+        """
+
+        state = self.__dict__.copy()
+        state["hooks"] = []
+        del state["lock"]
+        return state
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore the state of an unpickled copy.
+
+        Parameters:
+            state (dict): As returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def __str__(self):
+
+        """
+
+        Summarize the stats in a few lines of text.
+
+        Parameters: None
+
+        Returns: str.
+
+        """
+
+        lines = [f"{name}: {count}" for name, count in self.counts.items() if count]
+        lines += [f"alias {alias}: {count}" for alias, count in self.aliases.items()]
+        lines += [f"{stage} time: {seconds:.3f} s" for stage, seconds in self.seconds.items()]
+        lines.append(f"loaded: {self.bytes_loaded} bytes, {self.bytes_per_second():.0f} bytes/s")
+        return "\n".join(lines)
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def add_alias(self, alias, count=1):
+
+        """
+
+        Count documents whose archived path was found under an alias, and moved.
+
+        Parameters:
+            alias (str): The alias, as reported by KeyAliases.resolve.
+            count (int): Number of documents.
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            self.aliases[alias] = self.aliases.get(alias, 0) + count
+        self.add_count("key_corrections", count)
+        for hook in self.hooks:
+            hook("alias." + alias, count)
+
+
+    def add_bytes(self, count):
+
+        """
+
+        Add to the number of bytes loaded from json files.
+
+        Parameters:
+            count (int): Number of bytes.
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            self.bytes_loaded += count
+        for hook in self.hooks:
+            hook("bytes.loaded", count)
+
+
+    def add_count(self, name, count=1):
+
+        """
+
+        Add to one of the outcome counters.
+
+        Parameters:
+            name (str): One of COUNTERS.
+            count (int): Amount to add.
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            self.counts[name] += count
+        for hook in self.hooks:
+            hook("count." + name, count)
+
+
+    def add_time(self, stage, seconds):
+
+        """
+
+        Add time spent in one of the stages.
+
+        Parameters:
+            stage (str): One of STAGES.
+            seconds (float): Time spent.
+
+        Returns: None
+
+        """
+
+        with self.lock:
+            self.seconds[stage] += seconds
+        for hook in self.hooks:
+            hook("time." + stage, seconds)
+
+
+    def bytes_per_second(self):
+
+        """
+
+        Get the rate json files have been loaded at since the stats were reset.
+
+        Parameters: None
+
+        Returns: float. Bytes loaded per second of wall time.
+
+        """
+
+        elapsed = time.perf_counter() - self.started
+        return self.bytes_loaded / elapsed if elapsed > 0 else 0.0
+
+
+    def merge(self, snapshot):
+
+        """
+
+        Add numbers gathered elsewhere, e.g. in a worker process, calling the hooks for each.
+
+        Parameters:
+            snapshot (dict): As returned by snapshot.
+
+        Returns: None
+
+        """
+
+        if snapshot["bytes_loaded"]:
+            self.add_bytes(snapshot["bytes_loaded"])
+        # add_alias also adds to the key_corrections count.
+        for alias, count in snapshot["aliases"].items():
+            self.add_alias(alias, count)
+        for name, count in snapshot["counts"].items():
+            if count and name != "key_corrections":
+                self.add_count(name, count)
+        for stage, seconds in snapshot["seconds"].items():
+            if seconds:
+                self.add_time(stage, seconds)
+
+
+    def reset(self):
+
+        """
+
+        Set all numbers back to zero and restart the clock for bytes_per_second.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        self.aliases = {}
+        self.bytes_loaded = 0
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.started = time.perf_counter()
+
+
+    def snapshot(self):
+
+        """
+
+        Get a copy of the numbers.
+
+        Parameters: None
+
+        Returns:
+            dict: "aliases" (alias -> count), "bytes_loaded", "counts" (counter name ->
+                count) and "seconds" (stage -> seconds).
+
+        """
+
+        with self.lock:
+            return {"aliases": dict(self.aliases), "bytes_loaded": self.bytes_loaded,
+                "counts": dict(self.counts), "seconds": dict(self.seconds)}
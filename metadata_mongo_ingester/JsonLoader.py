@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+    Load json metadata files with the fastest json parser available.
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+
+# Optional faster parsers. Either can be installed with the "fast" extra.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+class JsonLoader:
+
+    """
+
+    Load json metadata files with the fastest json parser available.
+
+    Files are read as bytes and handed to orjson or simdjson if installed, or to the
+    standard library's json module otherwise. Large files are memory mapped rather than
+    read, when the parser can use the mapping directly. If the chosen parser rejects a
+    file, it is parsed again with the json module, so anything json accepts (e.g. integers
+    too big for 64 bits) still loads.
+
+    """
+
+    BACKENDS = ("orjson", "simdjson", "json")
+
+    def __init__(self, backend=None, mmap_threshold=1 << 24):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            backend (str or callable): "orjson", "simdjson" or "json", or a function that
+                parses json bytes. If None, the fastest installed parser is used.
+            mmap_threshold (int): Files this many bytes or larger are memory mapped.
+
+        Returns: None
+
+        Raises: ValueError if backend names a parser that is not installed.
+
+        """
+
+        if backend is None:
+            backend = "orjson" if orjson else "simdjson" if simdjson else "json"
+
+        if not callable(backend):
+            if backend not in self.BACKENDS:
+                raise ValueError(f"backend must be one of {self.BACKENDS} or a function, not {backend}")
+            if (backend == "orjson" and not orjson) or (backend == "simdjson" and not simdjson):
+                raise ValueError(f"backend {backend} is not installed")
+
+        self.backend = backend
+        self.mmap_threshold = mmap_threshold
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def load_file(self, filename, digest=False):
+
+        """
+
+        Load a json file.
+
+        Parameters:
+            filename (str): Absolute path to the file.
+            digest (bool): If True, also hash the bytes read, e.g. for an IngestionLedger,
+                so the file doesn't have to be read again to hash it.
+
+        Returns: (doc, size) tuple. doc is the parsed json, size the file size in bytes. If
+            digest, a (doc, size, (mtime_ns, size, content_hash)) tuple, where mtime_ns is
+            the file's modification time when read and content_hash the sha256 hex digest of
+            its content.
+
+        Raises: OSError if the file can't be read, ValueError if it is not json.
+
+        """
+
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+
+            # Only orjson parses a memoryview of the mapping without copying it.
+            if self.backend == "orjson" and size >= self.mmap_threshold:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        doc = self.loads(view)
+                        content_hash = hashlib.sha256(view).hexdigest() if digest else None
+                    finally:
+                        view.release()
+            else:
+                data = f.read()
+                doc = self.loads(data)
+                content_hash = hashlib.sha256(data).hexdigest() if digest else None
+
+        if not digest:
+            return doc, size
+        return doc, size, (stat.st_mtime_ns, size, content_hash)
+
+
+    def loads(self, data):
+
+        """
+
+        Parse json text.
+
+        Parameters:
+            data (bytes, memoryview or str): json text.
+
+        Returns: The parsed json.
+
+        Raises: ValueError if data is not json.
+
+        """
+
+        if self.backend == "json":
+            return json.loads(data)
+
+        try:
+            if self.backend == "orjson":
+                return orjson.loads(data)
+            if self.backend == "simdjson":
+                return simdjson.loads(bytes(data) if type(data) is memoryview else data)
+            return self.backend(data)
+        except Exception:
+            return json.loads(bytes(data) if type(data) is memoryview else data)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+    Read metadata documents one at a time from large NDJSON or JSON array files.
+
+"""
+
+import codecs
+import json
+import re
+
+from metadata_mongo_ingester.JsonLoader import JsonLoader
+
+
+# Matches the json whitespace at a position in the text.
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStreamReader:
+
+    """
+
+    Read metadata documents one at a time from an NDJSON file or a file holding a JSON array.
+
+    Only one document, plus one read chunk, is held in memory at a time, so files of any
+    size can be read in constant memory. Iterating the reader yields (offset, doc, error)
+    tuples, where offset is the byte offset of the document in the file.
+
+    """
+
+    def __init__(self, filename, format=None, chunk_size=1 << 20, max_document_size=1 << 26,
+        json_loader=None):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            filename (str): Absolute path to the file to read.
+            format (str): "ndjson" for one json document per line, "array" for a json array
+                of documents, or None to tell from the first non-whitespace character.
+            chunk_size (int): Number of bytes read from the file at a time.
+            max_document_size (int): Largest document, in bytes, that will be read from a
+                json array. Stops a malformed array from being read into memory whole.
+            json_loader (JsonLoader): Parses the lines of NDJSON files. If None, a JsonLoader
+                with the fastest installed parser is used. json arrays are always parsed
+                incrementally with the json module.
+
+        Returns: None
+
+        """
+
+        self.chunk_size = chunk_size
+        self.filename = filename
+        self.format = format
+        self.json_loader = json_loader or JsonLoader()
+        self.max_document_size = max_document_size
+        self.offset = 0 # Bytes of the file read so far
+
+
+    def __iter__(self):
+
+        """
+
+        Read the documents in the file.
+
+        Parameters: None
+
+        Yields:
+            (offset, doc, error) tuples. If the document could be read, doc is a dict and
+            error is None. Otherwise doc is None and error is a message beginning with "Error".
+
+        """
+
+        try:
+            f = open(self.filename, 'rb')
+        except Exception as e:
+            yield 0, None, f"Error: could not open {self.filename}, received exception {str(e)}."
+            return
+
+        with f:
+            file_format = self.format or self.__detect_format(f)
+            if file_format == "ndjson":
+                yield from self.__read_ndjson(f)
+            elif file_format == "array":
+                yield from self.__read_array(f)
+            else:
+                yield 0, None, f"Error: format must be \"ndjson\" or \"array\", not \"{file_format}\"."
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __detect_format(self, f):
+
+        """
+
+        Tell whether a file holds a json array or NDJSON from its first non-whitespace byte.
+
+        Parameters:
+            f (file): File opened in binary mode. Its position is restored.
+
+        Returns: "array" or "ndjson".
+
+        """
+
+        while True:
+            chunk = f.read(4096)
+            stripped = chunk.lstrip()
+            if stripped or not chunk:
+                break
+        f.seek(0)
+
+        return "array" if stripped.startswith(b"[") else "ndjson"
+
+
+    def __read_ndjson(self, f):
+
+        """
+
+        Read one json document per line. Blank lines are skipped, and a bad line is reported
+        without stopping the read.
+
+        Parameters:
+            f (file): File opened in binary mode.
+
+        Yields: (offset, doc, error) tuples, as in __iter__.
+
+        """
+
+        for line_number, line in enumerate(f, start=1):
+            offset = self.offset
+            self.offset += len(line)
+            if not line.strip():
+                continue
+
+            try:
+                doc = self.json_loader.loads(line)
+            except Exception as e:
+                yield offset, None, (f"Error: could not parse line {line_number} at offset "
+                    f"{offset} as json, received exception {str(e)}.")
+                continue
+
+            error = self.__check_document(doc, offset)
+            yield offset, None if error else doc, error
+
+
+    def __read_array(self, f):
+
+        """
+
+        Read the documents in a json array. The array can't be resynchronized after a
+        malformed document, so reading stops at the first one.
+
+        Parameters:
+            f (file): File opened in binary mode.
+
+        Yields: (offset, doc, error) tuples, as in __iter__.
+
+        """
+
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buffer = "" # Text read from the file but not yet discarded
+        pos = 0 # Position in buffer of the first unparsed character
+        pos_offset = 0 # Byte offset of pos in the file
+        at_eof = False
+        expected = "[" # What is expected next outside of a document
+
+        def read_more(size):
+            # Discard the parsed text before adding more, so the buffer stays small.
+            nonlocal buffer, pos, at_eof
+            chunk = f.read(size)
+            self.offset += len(chunk)
+            at_eof = not chunk
+            buffer = buffer[pos:] + utf8.decode(chunk, final=at_eof)
+            pos = 0
+
+        def advance(end):
+            nonlocal pos, pos_offset
+            pos_offset += len(buffer[pos:end].encode("utf-8"))
+            pos = end
+
+        while True:
+            # Skip whitespace to the next token.
+            advance(WHITESPACE.match(buffer, pos).end())
+            if pos == len(buffer):
+                if at_eof:
+                    if expected != "":
+                        yield pos_offset, None, (f"Error: unexpected end of file at offset "
+                            f"{pos_offset}, expected {expected}.")
+                    return
+                read_more(self.chunk_size)
+                continue
+
+            char = buffer[pos]
+
+            if expected == "":
+                yield pos_offset, None, f"Error: unexpected data after the array at offset {pos_offset}."
+                return
+
+            if expected == "[":
+                if char != "[":
+                    yield pos_offset, None, f"Error: expected a json array at offset {pos_offset}."
+                    return
+                advance(pos + 1)
+                expected = "a document or ]"
+                continue
+
+            if char == "]" and expected != "a document":
+                advance(pos + 1)
+                expected = ""
+                continue
+
+            if expected == ", or ]":
+                if char != ",":
+                    yield pos_offset, None, f"Error: expected , or ] at offset {pos_offset}."
+                    return
+                advance(pos + 1)
+                expected = "a document"
+                continue
+
+            # Decode the next document, reading more of the file until it is complete. The
+            # read size doubles each time so large documents are not re-parsed too often.
+            read_size = self.chunk_size
+            while True:
+                try:
+                    doc, end = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError as e:
+                    if at_eof or len(buffer) - pos > self.max_document_size:
+                        yield pos_offset, None, (f"Error: could not parse document at offset "
+                            f"{pos_offset} as json, received exception {str(e)}.")
+                        return
+                    read_more(read_size)
+                    read_size *= 2
+
+            offset = pos_offset
+            advance(end)
+            expected = ", or ]"
+            error = self.__check_document(doc, offset)
+            yield offset, None if error else doc, error
+
+
+    def __check_document(self, doc, offset):
+
+        """
+
+        Check that a parsed value is a json object.
+
+        Parameters:
+            doc: Parsed json value.
+            offset (int): Byte offset of the value in the file.
+
+        Returns:
+            None if doc is a dict, or an error message beginning with "Error".
+
+        """
+
+        if type(doc) is not dict:
+            return f"Error: document at offset {offset} is not a json object."
+        return None
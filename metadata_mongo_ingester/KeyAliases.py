@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+    Find a metadata document's archived path under an outdated or wrong key and move it to the right one.
+
+"""
+
+import re
+
+
+class KeyAliases:
+
+    """
+
+    Find a metadata document's archived path under an outdated or wrong key and move it to the right one.
+
+    Metadata should have a field named "archived_path", but older data has
+    "archiveFolderPath" or "archivedFolderPath" instead, and faculty (derived) data may have a
+    hyphen, incorrect case, or other error. Known aliases are looked up directly, in order.
+    Aliases may be dotted paths, e.g. "project.archivedPath", to find the value in a nested
+    document. If no alias is found, the top level keys are matched against a pattern. Whether
+    a key name matches is remembered, so each key name is only matched once per process.
+
+    """
+
+    DEFAULT_ALIASES = ("archivedPath", "archiveFolderPath", "archivedFolderPath",
+        "archivePath", "archive_path", "archived-path", "ArchivedPath")
+    DEFAULT_PATTERN = r'archive.*path'
+    MAX_DECISIONS = 1 << 16 # Cached pattern decisions kept before the cache is cleared
+
+    def __init__(self, good_key="archived_path", aliases=None, pattern=DEFAULT_PATTERN):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            good_key (str): The key the archived path belongs under.
+            aliases (list of str): Keys, or dotted paths to nested keys, the archived path
+                may be found under instead, in the order they are tried. If None, uses
+                DEFAULT_ALIASES.
+            pattern (str or re.Pattern): Top level keys matching this, ignoring case, are
+                also aliases. If None, only the listed aliases are used.
+
+        Returns: None
+
+        """
+
+        if aliases is None:
+            aliases = self.DEFAULT_ALIASES
+
+        self.aliases = [(alias, tuple(alias.split("."))) for alias in aliases if alias != good_key]
+        self.decisions = {} # Key name -> whether it matches pattern
+        self.good_key = good_key
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern, re.IGNORECASE)
+        self.pattern = pattern
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def resolve(self, doc):
+
+        """
+
+        Move the archived path to the good key if it is under an alias.
+
+        Parameters:
+            doc (dict): Metadata document as dict. It is changed in place. Any other
+                type is reported as an error rather than raising.
+
+        Returns:
+            (doc, alias) tuple. alias is the alias the value was found under, or None if the
+            document already had the good key.
+            Or
+            str: An error message beginning with "Error" if doc is not a dict or no archived
+            path is found.
+
+        """
+
+        if not isinstance(doc, dict):
+            return "Error: document is not a json object."
+
+        if self.good_key in doc:
+            return doc, None
+
+        for alias, parts in self.aliases:
+            parent = doc
+            for part in parts[:-1]:
+                parent = parent.get(part)
+                if not isinstance(parent, dict):
+                    break
+            else:
+                if parts[-1] in parent:
+                    doc[self.good_key] = parent.pop(parts[-1])
+                    return doc, alias
+
+        if self.pattern is not None:
+            alias = next((key for key in doc if self.__is_alias(key)), None)
+            if alias is not None:
+                doc[self.good_key] = doc.pop(alias)
+                return doc, alias
+
+        return f"Error: no {self.good_key} key in document."
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __is_alias(self, key):
+
+        """
+
+        Tell whether a top level key matches the pattern, remembering the answer.
+
+        Parameters:
+            key (str): Key name.
+
+        Returns: bool.
+
+        """
+
+        decision = self.decisions.get(key)
+        if decision is None:
+            if len(self.decisions) >= self.MAX_DECISIONS:
+                self.decisions.clear()
+            decision = bool(self.pattern.match(key)) and key != self.good_key
+            self.decisions[key] = decision
+        return decision
@@ -5,13 +5,76 @@
 
 """
 
+import bson
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import hashlib
+import importlib.util
+import itertools
 import json
 import jsonschema
 import os
 from pathlib import Path
 import pymongo
 import re
+import threading
+import time
+
+from metadata_mongo_ingester.FieldTransform import FieldTransform
+from metadata_mongo_ingester.IndexPlanner import IndexPlanner
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+from metadata_mongo_ingester.JsonLoader import JsonLoader
+from metadata_mongo_ingester.JsonStreamReader import JsonStreamReader
+from metadata_mongo_ingester.KeyAliases import KeyAliases
+from metadata_mongo_ingester.RetryPolicy import CircuitOpenError, RetryPolicy
+from metadata_mongo_ingester.ValidationResult import ValidationResult
+
+
+# Server error codes that mean a document's index key is already in the collection.
+DUPLICATE_KEY_ERROR_CODES = (11000, 11001, 12582)
+
+# Longest validation error message kept in compact error records. jsonschema messages include
+# the failing value, which may be a large part of the document.
+MAX_ERROR_MESSAGE_LENGTH = 200
+
+# Chunks of files per worker process that ingest_directory keeps submitted but not yet
+# written, enough to keep the workers busy while the writer catches up.
+IN_FLIGHT_CHUNKS = 2
+
+# Number of known keys cached by set_skip_existing before the cache is cleared.
+MAX_KNOWN_KEYS = 1 << 20
+
+# Number of parsed config files kept for reuse; the least recently used is dropped beyond this.
+MAX_PARSED_CONFIG_FILES = 16
+
+# Optional integer settings in a config file's mongodb section that are passed to MongoClient.
+CLIENT_OPTIONS = ("maxPoolSize", "minPoolSize", "maxIdleTimeMS", "waitQueueTimeoutMS",
+    "connectTimeoutMS", "socketTimeoutMS", "serverSelectionTimeoutMS", "zlibCompressionLevel")
+
+# Wire compressors a config file's compressors setting may list, and the module each needs.
+COMPRESSORS = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+# Optional integer settings in a config file's mongodb section for retrying writes. Maps each
+# to the RetryPolicy parameter it sets and the factor it is multiplied by, e.g. ms to seconds.
+RETRY_OPTIONS = {"write_retries": ("retries", 1), "retry_backoff_ms": ("backoff", 0.001),
+    "retry_max_backoff_ms": ("max_backoff", 0.001), "breaker_threshold": ("breaker_threshold", 1),
+    "breaker_reset_ms": ("breaker_reset", 0.001), "breaker_max_pause_ms": ("max_pause", 0.001)}
+
+# MongoClients are shared by every ingester in the process that connects to the same server
+# as the same user, so each client's connection pool is reused instead of handshaking again.
+# Maps (address, port, username, authSource) -> [client, number of ingesters using it].
+_clients = {}
+_clients_lock = threading.Lock()
+
+# (client key, database, collection, index keys) of every index created in this process.
+_created_indexes = set()
+
+# Parsed config files, most recently used last. Maps (file name, modification time) ->
+# ConfigParser. Secrets files are never kept here, so passwords are not held after use.
+_parsed_config_files = OrderedDict()
+_parsed_config_files_lock = threading.Lock()
+
 
 class MetadataMongoIngester:
 
@@ -23,6 +86,10 @@ class MetadataMongoIngester:
     ingest them. Also corrects the archivedPath key if given a wrong one. See help for 
     the __correct_archived_path_key method below.
 
+    Methods named with a single leading underscore are shared with the package's other
+    ingesters, e.g. AsyncMetadataMongoIngester, IngestionPipeline and MultiTargetIngester,
+    which reuse its config handling, loading, preparation, hashing and writing. They are not public API.
+
     """
 
     def __init__(self):
@@ -35,25 +102,163 @@ class MetadataMongoIngester:
         Returns: None
         """
 
+        self.client_key = None # Key of the shared client in use, see open_connection
         self.collection = None
         self.connection = None
         self.curr_schema = None
-        self.good_path_key = None # Used to correct wrong archivedPath keys
+        self.db_connection = None
+        self.field_transform = None # Drops or compresses bulky fields, see set_field_transform
+        self.file_hashes = None # File name -> (mtime_ns, size, hash) of files loaded for a ledger
+        self.hash_key = "content_hash" # Field holding the content hash of upserted documents
+        self.index_keys = None # Unique index field, from the config file
+        self.index_planner = None # Secondary indexes, from the config file, see build_indexes
         self.ingester_config = None
-        self.path_pattern = None # Used to locate wrong archivedPath keys
+        self.json_loader = JsonLoader() # Parses json files, see set_json_loader
+        self.key_aliases = None # Used to correct wrong archivedPath keys
+        self.known_keys = set() # index_keys values known to be in the collection
+        self.max_errors = None # If set, validate reports up to this many compact errors
+        self.precheck_required = False # If True, check required top level keys first
+        self.required_keys = () # Top level keys curr_schema requires
+        self.retry_policy = RetryPolicy() # When to retry failed writes, see set_retry_policy
+        self.schema_registry = None # If set, picks each document's schema instead of curr_schema
+        self.skip_existing = False # If True, bulk methods look up keys before validating
+        self.stats = None # IngestionStats, if instrumentation is on
+        self.upsert = False # If True, replace changed documents instead of skipping them
+        self.validator = None # Compiled from curr_schema by set_schema
 
         # Metadata docs should have a field named "archived_path" but they may have a 
         # different field that needs to be changed. See comments in the  
         # __correct_archived_path_key method, below.
-        self.good_path_key = "archived_path"
-        self.path_pattern = re.compile(r'archive.*path', re.IGNORECASE)
+        self.key_aliases = KeyAliases()
         
 
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle, e.g. when copying the ingester into worker processes.
+
+        The database connection and the compiled validator can't be pickled, so they are
+        left out. The validator is rebuilt from the schema by __setstate__.
+
+        Parameters: None
+
+        Returns: dict of data members.
+
+        """
+
+        state = self.__dict__.copy()
+        for name in ["client_key", "collection", "connection", "db_connection", "validator"]:
+            state[name] = None
+        return state
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore a pickled ingester, recompiling the validator for its schema.
+
+        Parameters:
+            state (dict): Data members as returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.__dict__.update(state)
+        if self.curr_schema:
+            self.validator = self.__validator_class(self.curr_schema)(self.curr_schema)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
     """
     PUBLIC METHODS
     """
 
+
+    def close(self):
+
+        """
+
+        Stop using the database connection.
+
+        The underlying MongoClient is shared with other ingesters in this process that
+        connected to the same server as the same user. It is only closed when the last of
+        them closes. An ingester can also be used as a context manager, which closes it on
+        exit.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        if self.client_key is not None:
+            with _clients_lock:
+                entry = _clients.get(self.client_key)
+                if entry is not None:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del _clients[self.client_key]
+                        entry[0].close()
+
+        self.client_key = None
+        self.collection = None
+        self.db_connection = None
+
     
+    def build_indexes(self, background=True, on_built=None):
+
+        """
+
+        Build the secondary indexes planned from the config file's indexes field, and from
+        the index annotations of the schema, or of every schema in the schema registry.
+
+        The unique index on index_keys is always created by open_connection, as duplicates
+        are found with it. Secondary indexes only speed up queries, so they can be built in
+        the background while documents are ingested, or after a bulk load, which is faster
+        as the documents are then indexed in one pass instead of one insert at a time.
+
+        Parameters:
+            background (bool): If True, build in a background thread and return at once.
+                Otherwise return when every index is built.
+            on_built (callable): If given, called with each index's report, see
+                IndexPlanner.build, as its build ends.
+
+        Returns:
+            IndexPlanner: The plan being built. Its wait method returns how long each
+                index took, and any errors.
+            Or
+            str: An error message beginning with "Error:".
+
+        """
+
+        if self.collection is None:
+            return "Error: no open connection, cannot build indexes."
+
+        index_planner = IndexPlanner(self.index_planner.indexes if self.index_planner else ())
+        schemas = [self.curr_schema]
+        if self.schema_registry:
+            schemas = [compiled.schema for compiled in list(self.schema_registry.schemas.values())]
+        for schema in schemas:
+            error = index_planner.add_from_schema(schema)
+            if error:
+                return error
+
+        error = index_planner.build(self.collection, background, on_built)
+        if error:
+            return error
+        return index_planner
+
+
     def get_collection(self):
 
         """ 
@@ -77,14 +282,15 @@ class MetadataMongoIngester:
 
         Parameters: None
 
-        Returns: The mongodb connection that was opened.
+        Returns: The mongodb connection that was opened. It may be shared with other
+            ingesters, so use this ingester's close method rather than closing it directly.
 
         """
 
         return self.db_connection
         
 
-    def ingest_document(self, doc):
+    def ingest_document(self, doc, structured=False):
 
         """
 
@@ -95,54 +301,379 @@ class MetadataMongoIngester:
             corrcted, but documents with no discernable archived_path key will be
             rejected with an error.
 
+        Note: In upsert mode (see set_upsert), a document whose index key is already in the
+            collection replaces the stored one if its content has changed, and is skipped
+            with "Unchanged, skipped" if not.
+
         Parameters:
-            doc (str or dict):
+            doc (str, dict or ValidationResult):
                 If dict, metadata document to be ingested.
                 If str, absolute path to json file containing document.
+                If ValidationResult, a document prepared by prepare_document. It is not
+                loaded or validated again unless the schema has changed since.
+            structured (bool): If True, return an IngestResult instead of a string.
 
         Returns:
-            None if successful, or error message string beginning with "Error:".
+            None if successful, or error message string beginning with "Error:". Or, if
+            structured, an IngestResult.
 
         """
 
-        # If given a file, try to open and load it as json.
-        if type(doc) is str:
-            try:
-                filename=doc
-                with open(filename) as f:
-                    doc = json.load(f)
-            except Exception as e:
-                return f"Error: could not load {filename} as json"
+        # Load, key correct and validate the document. On failure, doc is None and
+        # failure holds the result.
+        doc, failure = self._prepare(doc)
+        if failure:
+            return failure if structured else failure.as_string()
 
-        # Fix the archivedPath key if needed. doc will be an updated document
-        # or error message
-        doc = self.__correct_archived_path_key(doc)
-        if type(doc) is str and doc.startswith("Error"):
-            return doc
+        write = self.__upsert_document if self.upsert else self.__insert_document
+        if self.stats is None:
+            result = write(doc)
+        else:
+            start = time.perf_counter()
+            result = write(doc)
+            self.stats.add_time("insert", time.perf_counter() - start)
+            self.__count_write_result(result)
+        return result if structured else result.as_string()
+
+
+    def ingest_documents(self, docs, batch_size=1000, ledger=None, dead_letters=None,
+        structured=False):
+
+        """
+
+        Ingest many documents, sending them to the database in batches.
+
+        Each document is loaded, key corrected and validated exactly as in ingest_document,
+        but the valid documents are sent with one unordered insert_many call per batch
+        instead of one insert_one call each.
+
+        Parameters:
+            docs (iterable of str, dict or ValidationResult):
+                Metadata documents as dicts, absolute paths to json files containing them, or
+                documents already prepared by prepare_document.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            ledger (IngestionLedger): If given, files it records as already ingested and
+                unchanged are skipped with "Already ingested, skipped" before being read, and
+                the results of the other files are recorded in it.
+            dead_letters (DeadLetters): If given, documents that fail to load, key correct,
+                validate or insert are recorded in it, to replay later with
+                replay_dead_letters.
+            structured (bool): If True, give each result as an IngestResult, which is
+                cheaper to tell apart and count than a message.
+
+        Returns:
+            list: One result per input document, in input order. Each result is None if
+                successful, "Duplicate key, skipped" if the key is already in the collection,
+                or another error message string. Or, if structured, an IngestResult.
+            Or
+            str: An error message beginning with "Error:" if batch_size is not valid.
 
+        """
+
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+
+        results = {}
+        paths = {} # Index -> file name, of the documents given as files
+        if ledger:
+            self.file_hashes = {}
+
+        def unskipped_docs():
+            for index, doc in enumerate(docs):
+                if type(doc) is str:
+                    if ledger and ledger.is_unchanged(doc):
+                        results[index] = IngestResult(IngestStatus.ALREADY_INGESTED, "ledger")
+                        if self.stats is not None:
+                            self.stats.add_count("skipped")
+                        continue
+                    paths[index] = doc
+                yield index, doc
 
-        # Validation returns None on success, error message otherwise.
         try:
-            val = self.validate(doc)
-            if val:
-                return f"Could not valiate doc, error was {val}"
-        except Exception as e:
-            return f"Could not valiate doc, received exception {str(e)}"
+            ingested = self.__ingest_batches(unskipped_docs(), batch_size, dead_letters,
+                lambda index: {"source": paths.get(index), "position": index})
+            if ledger:
+                ingested = self.__record_in_ledger(ingested, ledger, paths.get, batch_size)
+            for index, result in ingested:
+                results[index] = result
+        finally:
+            self.file_hashes = None
 
+        if structured:
+            return [results[index] for index in range(len(results))]
+        return [results[index].as_string() for index in range(len(results))]
 
-        # Attempt ingestion
+
+    def ingest_directory(self, path, glob="**/*.json", workers=None, batch_size=1000, ledger=None,
+        dead_letters=None, structured=False):
+
+        """
+
+        Ingest every matching json file beneath a directory, using a pool of processes.
+
+        Reading, key correcting and validating the files is spread across the worker
+        processes. This process is the single writer: it collects the prepared documents and
+        inserts them in batches, as in ingest_documents. Files are handed to the workers in
+        chunks, with at most IN_FLIGHT_CHUNKS chunks per worker queued or prepared but not
+        yet written, so memory use does not grow with the size of the directory.
+
+        Parameters:
+            path (str): Absolute path to the directory to search.
+            glob (str): Pattern, relative to path, of the files to ingest. The default finds
+                json files in path and all of its subdirectories.
+            workers (int): Number of worker processes. If None, one per CPU. If 1, files are
+                prepared in this process and no pool is started.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            ledger (IngestionLedger): If given, files it records as already ingested and
+                unchanged are skipped with "Already ingested, skipped" before being read, and
+                the results of the other files are recorded in it. Running again with the same
+                ledger resumes an interrupted run.
+            dead_letters (DeadLetters): If given, files that fail to load, key correct,
+                validate or insert are recorded in it, to replay later with
+                replay_dead_letters.
+            structured (bool): If True, give each result as an IngestResult.
+
+        Returns:
+            dict: Maps each file name to its result, as returned by ingest_document, in
+                sorted file name order.
+            Or
+            str: An error message beginning with "Error:".
+
+        """
+
+        if not os.path.isdir(path):
+            return f"Error: {path} is not a directory."
+
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if type(workers) is not int or workers < 1:
+            return f"Error: workers must be a positive integer, not {workers}."
+
+        filenames = sorted(str(filename) for filename in Path(path).glob(glob)
+            if filename.is_file())
+
+        # Skip the files the ledger has seen, before any reading or network I/O.
+        results = {}
+        if ledger:
+            for filename in filenames:
+                if ledger.is_unchanged(filename):
+                    results[filename] = IngestResult(IngestStatus.ALREADY_INGESTED, "ledger")
+                    if self.stats is not None:
+                        self.stats.add_count("skipped")
+        pending = [filename for filename in filenames if filename not in results]
+        if ledger:
+            self.file_hashes = {}
         try:
-            result = self.collection.insert_one(doc)
-            if result.acknowledged:
-                return None
+            if workers == 1 or not pending:
+                ingested = self.__ingest_batches(((filename, filename) for filename in pending),
+                    batch_size, dead_letters, lambda filename: {"source": filename})
+                if ledger:
+                    ingested = self.__record_in_ledger(ingested, ledger, str, batch_size)
+                results.update(ingested)
+
+            else:
+                # Each worker gets a pickled copy of this ingester, i.e. its schema and key
+                # correction settings, but no connection.
+                chunksize = max(1, min(64, len(pending) // (workers * 4)))
+                skipping = self.skip_existing and not self.upsert and self.collection is not None
+                pending_keys = {} # File name -> index key value, of the files to be written
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker,
+                    initargs=(self,)) as executor:
+                    def collect(chunk, future):
+                        for filename, (doc, failure, stats, file_hash) in zip(chunk,
+                            future.result()):
+                            if stats:
+                                self.stats.merge(stats)
+                            if file_hash:
+                                self.file_hashes[filename] = file_hash
+                            yield filename, filename if failure else doc, failure
+
+                    def prepared_in_pool():
+                        in_flight = deque()
+                        for start in range(0, len(pending), chunksize):
+                            chunk = pending[start:start + chunksize]
+                            docs = chunk
+                            if skipping:
+                                # Look the chunk's keys up here, and only hand the documents
+                                # not in the collection to the workers to validate.
+                                chunk, docs = [], []
+                                for filename, given, doc, failure in self.__look_up_chunk(
+                                    [(filename, filename) for filename in pending[start:
+                                    start + chunksize]]):
+                                    if failure:
+                                        yield filename, filename, failure
+                                        continue
+                                    value = doc.get(self.index_keys)
+                                    if self.__is_key(value):
+                                        pending_keys[filename] = value
+                                    chunk.append(filename)
+                                    docs.append(doc)
+                                if not chunk:
+                                    continue
+                            in_flight.append((chunk,
+                                executor.submit(_prepare_chunk_in_pool_worker, docs)))
+                            if len(in_flight) >= workers * IN_FLIGHT_CHUNKS:
+                                yield from collect(*in_flight.popleft())
+                        while in_flight:
+                            yield from collect(*in_flight.popleft())
+
+                    prepared = prepared_in_pool()
+                    ingested = self._write_results(prepared, batch_size, dead_letters,
+                        lambda filename: {"source": filename})
+                    if skipping:
+                        ingested = self.__remember_written_keys(ingested, pending_keys)
+                    if ledger:
+                        ingested = self.__record_in_ledger(ingested, ledger, str, batch_size)
+                    results.update(ingested)
+        finally:
+            self.file_hashes = None
+
+        if structured:
+            return {filename: results[filename] for filename in filenames}
+        return {filename: results[filename].as_string() for filename in filenames}
+
+
+    def ingest_stream(self, filename, format=None, batch_size=1000, progress=None,
+        progress_interval=10000, dead_letters=None):
+
+        """
 
-        except pymongo.errors.DuplicateKeyError:
-            return "Duplicate key, skipped"
+        Ingest the documents in an NDJSON file or a json array file, reading one at a time.
 
-        except Exception as e:
-            return f"Error: Cannot ingest document, received exception {str(e)}."
+        Documents stream through key correction, validation and batched insertion, so memory
+        use does not grow with the size of the file. Only the errors are kept.
+
+        Parameters:
+            filename (str): Absolute path to the file to ingest.
+            format (str): "ndjson", "array", or None to tell from the file contents.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            progress (callable): If given, called as progress(documents, bytes_read) every
+                progress_interval documents and once at the end.
+            progress_interval (int): Number of documents between calls to progress.
+            dead_letters (DeadLetters): If given, documents that fail are recorded in it with
+                their byte offset, to replay later with replay_dead_letters. Documents that
+                could not be parsed are recorded without the document.
+
+        Returns:
+            dict: "ingested", "duplicates" (including unchanged documents in upsert mode)
+                and "failed" counts, and "errors", a list of
+                (offset, message) tuples giving the byte offset in the file of each document
+                that failed and its error message.
+            Or
+            str: An error message beginning with "Error:" if batch_size is not valid.
+
+        """
+
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+
+        reader = JsonStreamReader(filename, format, json_loader=self.json_loader)
+        summary = {"ingested": 0, "duplicates": 0, "failed": 0, "errors": []}
+
+        def record(offset, result):
+            if result.status is IngestStatus.INGESTED:
+                summary["ingested"] += 1
+            elif result.skipped:
+                summary["duplicates"] += 1
+            else:
+                summary["failed"] += 1
+                summary["errors"].append((offset, result.message))
+
+        # Documents the reader could not parse are recorded here, the rest are passed on to
+        # be prepared and inserted.
+        documents = 0
+        def parsed_docs():
+            nonlocal documents
+            for offset, doc, error in reader:
+                documents += 1
+                if progress and documents % progress_interval == 0:
+                    progress(documents, reader.offset)
+                if error:
+                    record(offset, IngestResult(IngestStatus.FAILED, "load", error))
+                    if self.stats is not None:
+                        self.stats.add_count("load_errors")
+                    if dead_letters is not None:
+                        dead_letters.record(error, "load", None, filename, offset=offset)
+                else:
+                    yield offset, doc
+
+        for offset, result in self.__ingest_batches(parsed_docs(), batch_size, dead_letters,
+            lambda offset: {"source": filename, "offset": offset}):
+            record(offset, result)
+
+        if progress:
+            progress(documents, reader.offset)
+        if self.stats is not None:
+            self.stats.add_bytes(reader.offset)
+
+        summary["errors"].sort()
+        return summary
+
+
+    def replay_dead_letters(self, dead_letters, batch_size=1000, new_dead_letters=None,
+        structured=False):
+
+        """
 
-        return f"Error: Cannot ingest document, reason unknown."
+        Ingest the documents recorded in dead letters again, e.g. after fixing the schema or
+        the data.
+
+        A document that came from a json file holding only it is read from the file again,
+        so fixes to the file are picked up. Other documents, including those from streamed
+        files, are ingested as recorded. Documents of a streamed file that could not be
+        parsed were not recorded, and fail.
+
+        Parameters:
+            dead_letters (DeadLetters): Dead letters recorded by an earlier run.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            new_dead_letters (DeadLetters): If given, documents that fail again are recorded
+                in it. It must not be dead_letters.
+            structured (bool): If True, give each result as an IngestResult.
+
+        Returns:
+            list: (record, result) tuples, one per dead letter record, where result is as
+                returned by ingest_document.
+            Or
+            str: An error message beginning with "Error:" if batch_size is not valid.
+
+        """
+
+        records = list(dead_letters)
+
+        docs = []
+        for record in records:
+            if record.get("source") and record.get("offset") is None:
+                docs.append(record["source"])
+            elif record.get("doc") is not None:
+                docs.append(record["doc"])
+            else:
+                docs.append(None)
+
+        # Leave out the records with nothing to replay.
+        replayable = [index for index, doc in enumerate(docs) if doc is not None]
+        results = self.ingest_documents([docs[index] for index in replayable], batch_size,
+            structured=True)
+        if type(results) is str:
+            return results
+
+        replayed = dict(zip(replayable, results))
+        results = [(record, replayed.get(index) or IngestResult(IngestStatus.FAILED,
+            record.get("stage"), "Error: nothing to replay, the document was not recorded."))
+            for index, record in enumerate(records)]
+
+        # Record failures with their original source and position.
+        if new_dead_letters is not None:
+            for record, result in results:
+                if result.failed:
+                    new_dead_letters.record(result.message, result.stage, record.get("doc"),
+                        record.get("source"), record.get("position"), record.get("offset"))
+
+        if structured:
+            return results
+        return [(record, result.as_string()) for record, result in results]
 
 
     def is_schema_set(self): 
@@ -153,19 +684,28 @@ class MetadataMongoIngester:
 
         Parameters: None
 
-        Returns: bool. True if schema is set, False if not.
+        Returns: bool. True if schema or a schema registry is set, False if not.
 
         """
 
-        return self.curr_schema is not None
+        return self.curr_schema is not None or self.schema_registry is not None
 
 
-    def open_connection(self, mode="dev", config_filename=None, secrets_filename=None):
+    def open_connection(self, mode="dev", config_filename=None, secrets_filename=None,
+        collection_name=None):
 
         """
 
         Take a user provided configuration and connect to a mongo DB collection.
 
+        Ingesters in the same process that connect to the same server as the same user share
+        one MongoClient and its connection pool. The pool can be tuned with the optional
+        settings in CLIENT_OPTIONS, e.g. maxPoolSize or serverSelectionTimeoutMS, in the
+        config file's mongodb section, which may also list wire compressors. The unique
+        index is only created the first time a collection is opened in the process.
+        Secondary indexes listed in the section's indexes field are only planned;
+        build_indexes builds them.
+
         Parameters:
 
             mode (str) : Either "dev", "test", or "prod" for development, test, or production
@@ -176,6 +716,9 @@ class MetadataMongoIngester:
             secrets_filename (str): Absolute path to a secrets file. If None, it will look in 
                 the user's home directory for a file named "ingester_secrets.cfg"
 
+            collection_name (str): Collection to use instead of the one in the config file,
+                in the same database, e.g. one per group.
+
         Returns:
             None if successful, or error message string beginning with "Error:".
 
@@ -185,221 +728,2037 @@ class MetadataMongoIngester:
             return f"Error: mode must be \"dev\", \"test\", or \"prod\", not \"{mode}\"."
 
         # Get the configuration from the config file or return an error.
-        mongo_section = self.__read_config_file(mode, config_filename)
+        mongo_section = self._read_config_file(mode, config_filename)
         if type(mongo_section) == str and mongo_section.startswith("Error"):
             return mongo_section
 
         # Get the password from the secrets file or return an error.
-        password = self.__read_secrets_file(mode, secrets_filename)
+        password = self._read_secrets_file(mode, secrets_filename)
         if password.startswith("Error"):
             return password
 
-        # Try to open the connection
+        # Use the archived path aliases from the config file, if it has any.
+        if "archived_path_aliases" in mongo_section or "archived_path_pattern" in mongo_section:
+            error = self._set_key_aliases_from_config(mongo_section)
+            if error:
+                return error
+
+        # Plan the secondary indexes the config file lists, if any.
+        if "indexes" in mongo_section:
+            index_planner = IndexPlanner()
+            error = index_planner.add_from_config(mongo_section["indexes"])
+            if error:
+                return error
+            self.index_planner = index_planner
+
+        # Drop or compress the fields the config file names, if any.
+        if "drop_fields" in mongo_section or "compress_fields" in mongo_section:
+            error = self._set_field_transform_from_config(mongo_section)
+            if error:
+                return error
+
+        # Get the retry and write concern settings, if the config file has any.
+        error = self.__set_retry_policy_from_config(mongo_section)
+        if error:
+            return error
+        write_concern = self._write_concern_from_config(mongo_section)
+        if type(write_concern) is str:
+            return write_concern
+
+        collection_name = collection_name or mongo_section["collection"]
+
+        # Stop using any connection opened before.
+        self.close()
+
+        # Get the shared connection, opening it if needed.
+        client_key = (mongo_section["address"], int(mongo_section["port"]),
+            mongo_section["username"], mongo_section["authSource"])
+        options = self._client_options_from_config(mongo_section)
+        if type(options) is str:
+            return options
         try:
-            self.db_connection = pymongo.MongoClient(mongo_section["address"],
-                int(mongo_section["port"]),
-                username = mongo_section["username"], password = password,
-                authSource = mongo_section["authSource"])
+            with _clients_lock:
+                if client_key not in _clients:
+                    client = pymongo.MongoClient(mongo_section["address"],
+                        int(mongo_section["port"]),
+                        username = mongo_section["username"], password = password,
+                        authSource = mongo_section["authSource"], **options)
+                    _clients[client_key] = [client, 0]
+                _clients[client_key][1] += 1
+                self.db_connection = _clients[client_key][0]
+                self.client_key = client_key
         except Exception as e:
             return f"Error: could not open mongodb connection, received exception {str(e)}."
 
         # Get the collection from the connection.
-        self.collection = self.db_connection[mongo_section["database"]][mongo_section["collection"]]
-
-        # Create an index if its not already present.
-        try:
-            self.collection.create_index([(mongo_section["index_keys"], pymongo.ASCENDING)], unique=True)
-        except Exception as e:
-            return f"Error: could not create index, received exception {str(e)}."
+        self.collection = self.db_connection[mongo_section["database"]][collection_name]
+        if write_concern:
+            self.collection = self.collection.with_options(write_concern=write_concern)
+        self.index_keys = mongo_section["index_keys"]
+        self.known_keys = set()
+
+        # Create an index if its not already present, once per collection per process.
+        index = (client_key, mongo_section["database"], collection_name,
+            mongo_section["index_keys"])
+        if index not in _created_indexes:
+            try:
+                self.collection.create_index([(mongo_section["index_keys"], pymongo.ASCENDING)], unique=True)
+            except Exception as e:
+                return f"Error: could not create index, received exception {str(e)}."
+            _created_indexes.add(index)
 
         return None
 
 
-    def set_schema(self, schema_filename=None):
+    def get_stats(self):
 
         """
 
-        Set or unset the schema file, insure its validity.
+        Get the ingestion stats.
 
-        Parameters:
-            schema_filename (str): Absolute path to json schema file. If None, will clear
-            schema. I.e., no schema will be applied.
+        Parameters: None
 
+        Returns: The IngestionStats given to set_stats, or None if instrumentation is off.
 
-        Returns:
-            None if successful, or error message string beginning with "Error:".
+        """
+
+        return self.stats
+
+
+    def set_validation_mode(self, max_errors=None, precheck_required=False):
 
         """
 
+        Choose how validate checks documents and reports what is wrong with them.
 
-        # Clear schema if given an empty filename.
-        if not schema_filename:
-            self.curr_schema = None
-            return None
+        By default validate reports the most relevant error, formatted by jsonschema, which
+        quotes the schema and the failing part of the document and can be slow and long for
+        big documents. With max_errors set, validate instead stops after that many errors
+        and reports each in one short line, as in validate_errors.
 
-        # Attempt to load the schema file as JSON and validate it.
-        try:
-            with open(schema_filename, 'r') as f:
-                self.curr_schema = json.load(f)
-            # Test that the schema itself is valid by using one of the validators in the
-            # jsonschema package. 
-            jsonschema.Draft7Validator.check_schema(self.curr_schema)
+        Parameters:
+            max_errors (int): Maximum number of errors to find and report. If None, report
+                the most relevant error in full.
+            precheck_required (bool): If True, a document missing any of the schema's
+                required top level keys is rejected before full validation.
 
-        except Exception as e:
-            return f"Error: could not set schema {schema_filename}, received exception {str(e)}." 
+        Returns:
+            None if successful, or error message string beginning with "Error:".
 
+        """
+
+        if max_errors is not None and (type(max_errors) is not int or max_errors < 1):
+            return f"Error: max_errors must be a positive integer or None, not {max_errors}."
+
+        self.max_errors = max_errors
+        self.precheck_required = precheck_required
         return None
 
 
-    def validate(self, doc):
+    def set_skip_existing(self, skip_existing=True):
 
         """
 
-        Validate a metadata document against the current schema. 
+        Turn on or off looking up documents' keys before validating them, in the bulk
+        methods, ingest_documents, ingest_directory and ingest_stream.
+
+        Each batch of documents is loaded and key corrected, then its index_keys values are
+        looked up with a single query. Documents already in the collection are skipped with
+        "Duplicate key, skipped" without being validated or sent. Keys found, or inserted,
+        are remembered for the rest of the run, so they are not looked up again. This makes
+        re-running a mostly ingested delivery much cheaper. ingest_directory loads the files
+        and looks them up in the calling process, and only hands the documents not found to
+        its worker processes to validate. It has no effect in upsert mode, where stored
+        documents may need replacing.
 
         Parameters:
-            doc (str or dict):
-                If dict, metadata document to be validated.
-                If str, absolute path to json file containing document.
+            skip_existing (bool): If True, look up keys first. Turning it on or off clears
+                the remembered keys.
 
-        Returns:
-            None if successful, or error message string beginning with "Error:".
+        Returns: None
 
         """
 
-        # If no schema is currently set, there's nothing to do.
-        if not self.curr_schema:
-            return None
+        self.known_keys = set()
+        self.skip_existing = skip_existing
 
-        if type(doc) not in [str, dict]:
-            return f"Error: doc must be a str or dict"
 
-        # Try to open and load json file
-        if type(doc) is str:      
-            try:
-                filename=doc
-                with open(filename) as f:
-                    doc = json.load(f)
-            except Exception as e:
-                return f"Error: could not load {filename} as json"
+    def set_stats(self, stats=None):
 
-        # Attempt to validate doc against shcema
-        try:
-            jsonschema.validate(instance=doc, schema=self.curr_schema)
-        except Exception as e:
-            return f"Error: document validation failed, received exception {str(e)}"
+        """
 
-        return None     
-    
-    """
-    PRIVATE METHODS
-    """
+        Turn instrumentation on or off.
 
+        With an IngestionStats set, the time spent loading, key correcting, validating and
+        inserting documents is recorded, along with outcome counts and bytes loaded. With
+        none set, the only cost is a check of self.stats at each stage.
 
-    def __correct_archived_path_key(self, doc): 
+        Parameters:
+            stats (IngestionStats): Stats to record into. If None, turns instrumentation off.
+
+        Returns: None
 
         """
-        Correct outdated or wrong archived_path key.
 
-        We want metadata to have a field named 'archived_path', but in some older data it is 
-        instead written as 'archiveFolderPath' or 'archivedFolderPath' (note the letter 'd').
-        In faculty (derived) data, it might also have a hyphen, incorrect case, or other error. 
-        This method will insert the correct key and delete the old one. If the document has
-        no field for the archived path, an error is returned.
+        self.stats = stats
 
-        Parameters:
-            doc (dict): Metadata document as dict.
 
-        Returns: Updated metadata document as dict, or string beginning with "Error" if no
-            archived_path is found.
+    def set_upsert(self, upsert=True):
+
         """
 
-        # If the metadata has one of the older or incorrect archivedPath keys, change it to the 
-        # correct one by copying its value to the correct key and deleting the bad key.
+        Turn upsert mode on or off.
 
-        if self.good_path_key in doc:
-            return doc
+        In upsert mode, documents are matched to stored ones by the index_keys field from the
+        config file. A content hash is stored with each document, so a document is only
+        written if it is new or its content has changed. Documents are skipped with
+        "Unchanged, skipped" otherwise. The stored hashes of each batch are looked up with
+        one query, so a re-run over corrected metadata updates the collection while only
+        sending the documents that changed.
 
-        for curr_key in doc:
-            if (re.match(self.path_pattern, curr_key) and
-                curr_key != self.good_path_key):
-                doc[self.good_path_key] = doc[curr_key]
-                del doc[curr_key]
+        Parameters:
+            upsert (bool): True to turn upsert mode on, False to turn it off.
 
-        if self.good_path_key not in doc:
-            return "Error: no archived_path key in document."
+        Returns: None
+
+        """
+
+        self.upsert = upsert
 
-        return doc
-     
 
-    def __read_config_file(self, mode, config_filename):
+    def prepare_document(self, doc):
 
         """
 
-        Read either a given config file or look for one in the user's home directory.
+        Load, key correct and validate a document, keeping the result for ingestion.
+
+        Use this instead of validate when the document will be ingested afterwards, e.g. to
+        check a whole delivery before loading any of it. Passing the result to
+        ingest_document or ingest_documents skips loading and validating the document again.
 
         Parameters:
-            config_filename (str) : Absolute path to config file. If None, will look in home dir.
+            doc (str or dict):
+                If dict, metadata document to be prepared.
+                If str, absolute path to json file containing document.
 
         Returns:
-            mongo_config (dict) : dict with config values
-            Or
-            mongo_config (str) : An error message beginning with "Error"
+            ValidationResult: Holds the prepared document, or the error message if the
+                document could not be loaded, key corrected or validated. It is true if the
+                document is valid.
 
         """
 
-        # If no config given, use default in user's home directory
-        if not config_filename:
-            # Use the default config file that should be located in this directory
-            src_dir = str(Path.home())
-            config_filename = os.path.join(src_dir, "ingester_config.cfg")
-
-        # Open config file
-        try:
-            user_config = configparser.ConfigParser()
-            user_config.read(config_filename)
-        except Exception as e:
-            return f"Error: cannot read config file {config_filename}, received exception {str(e)}."
-
-        # Confirm it has the rquested dev, test, or prod "mongodb" section
-        mode = "mongodb" + '_' + mode
-        try:
-            mongo_config = user_config[mode]
-        except Exception as e:
-            return f"Error: no {mode} section in config file {config_filename}."
-
-        # Get the index_keys or return an error if not found.
-        if "index_keys" not in mongo_config:
-            return f"Error: no index_keys in {mode} section of config file {config_filename}."
+        source = doc if type(doc) is str else None
+        prepared, failure = self._prepare(doc)
+        error = failure.message if failure else None
+        validator = self.__validator_for(prepared) if prepared is not None else None
+        return ValidationResult(prepared, error, source, validator)
 
-        return mongo_config
 
-        
-    def __read_secrets_file(self, mode, secrets_filename):
+    def set_key_aliases(self, aliases=None, pattern=KeyAliases.DEFAULT_PATTERN):
 
         """
 
-        Read either a given secrets file or look for one in the user's home directory.
+        Set the keys a document's archived path may be found under instead of archived_path.
 
         Parameters:
-            secrets_filename (str) : Absolute path to config file. If None, will look in home dir.
+            aliases (list of str): Keys, or dotted paths to nested keys, tried in order. If
+                None, uses KeyAliases.DEFAULT_ALIASES.
+            pattern (str): Top level keys matching this regular expression, ignoring case,
+                are also aliases. If None, only the listed aliases are used.
 
         Returns:
-            password (str) : The password if successful, or an error message beginning with "Error".
+            None if successful, or error message string beginning with "Error:".
 
         """
 
-        # If no secrets file was given, use the default in the user's home directory
-        if not secrets_filename:
-            home_dir = str(Path.home())
-            secrets_filename = os.path.join(home_dir, "ingester_secrets.cfg")
+        try:
+            self.key_aliases = KeyAliases(aliases=aliases, pattern=pattern)
+        except re.error as e:
+            return f"Error: archived path pattern is not a valid regular expression, received exception {str(e)}."
+
+        return None
+
+
+    def set_field_transform(self, field_transform=None):
+
+        """
+
+        Set or unset the fields dropped or compressed before documents are stored. Documents
+        are transformed as they are written, so the schema sees the whole document, and
+        prepare_document's results and dead letters hold it whole.
+
+        Parameters:
+            field_transform (FieldTransform): Fields to drop and compress. If None, documents
+                are stored as they are.
+
+        Returns: None
+
+        """
+
+        self.field_transform = field_transform
+
+
+    def set_index_planner(self, index_planner=None):
+
+        """
+
+        Set or unset the secondary indexes build_indexes builds, besides those annotated in
+        the schema. Replaces the ones listed in the config file.
+
+        Parameters:
+            index_planner (IndexPlanner): Planned indexes. If None, only the schema's
+                annotations are used.
+
+        Returns: None
+
+        """
+
+        self.index_planner = index_planner
+
+
+    def set_json_loader(self, json_loader=None):
+
+        """
+
+        Set the loader used to parse json files.
+
+        Parameters:
+            json_loader (JsonLoader): Loader to use. If None, a JsonLoader with the fastest
+                installed parser is used.
+
+        Returns: None
+
+        """
+
+        self.json_loader = json_loader or JsonLoader()
+
+
+    def set_retry_policy(self, retry_policy=None):
+
+        """
+
+        Set when failed writes are retried, and how long writes wait while the server is down.
+
+        Parameters:
+            retry_policy (RetryPolicy): Policy to use. If None, writes are not retried and
+                never wait.
+
+        Returns: None
+
+        """
+
+        self.retry_policy = retry_policy or RetryPolicy(retries=0, breaker_threshold=0)
+
+
+    def set_schema_registry(self, schema_registry=None):
+
+        """
+
+        Set or unset a schema registry, to validate each document against the schema its
+        discriminator selects. While a registry is set, the schema set by set_schema is not
+        used.
+
+        Parameters:
+            schema_registry (SchemaRegistry): Registry of the schemas to use. If None,
+                documents are validated against the schema set by set_schema.
+
+        Returns: None
+
+        """
+
+        self.schema_registry = schema_registry
+
+
+    def set_schema(self, schema_filename=None):
+
+        """
+
+        Set or unset the schema file, insure its validity.
+
+        Parameters:
+            schema_filename (str): Absolute path to json schema file. If None, will clear
+            schema. I.e., no schema will be applied.
+
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+
+        # Clear schema if given an empty filename.
+        if not schema_filename:
+            self.curr_schema = None
+            self.required_keys = ()
+            self.validator = None
+            return None
+
+        # Attempt to load the schema file as JSON and validate it.
+        try:
+            with open(schema_filename, 'r') as f:
+                schema = json.load(f)
+            # Test that the schema itself is valid, using the validator class for the draft
+            # named in its "$schema" keyword, or Draft 7 if it names none.
+            validator_class = self.__validator_class(schema)
+            validator_class.check_schema(schema)
+
+        except Exception as e:
+            return f"Error: could not set schema {schema_filename}, received exception {str(e)}." 
+
+        # Build the validator once here, so validate doesn't recheck the schema and rebuild
+        # the validator and its $ref resolver for every document.
+        self.curr_schema = schema
+        self.validator = validator_class(schema)
+        required = schema.get("required", []) if isinstance(schema, dict) else []
+        self.required_keys = tuple(key for key in required if type(key) is str)
+
+        return None
+
+
+    def validate(self, doc):
+
+        """
+
+        Validate a metadata document against the current schema. 
+
+        Parameters:
+            doc (str or dict):
+                If dict, metadata document to be validated.
+                If str, absolute path to json file containing document.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        # If no schema is currently set, there's nothing to do.
+        if not self.is_schema_set():
+            return None
+
+        if type(doc) not in [str, dict]:
+            return f"Error: doc must be a str or dict"
+
+        # Try to open and load json file
+        if type(doc) is str:
+            doc, size, error = self._load_json_file(doc)
+            if error:
+                return error
+
+        failure = self.__validation_failure(doc)
+        if failure:
+            return "".join(str(part) for part in failure)
+
+        return None
+
+
+    def validate_errors(self, doc, max_errors=10):
+
+        """
+
+        Validate a metadata document against the current schema, listing what is wrong.
+
+        Only the first max_errors errors are looked for, so a very bad document costs no
+        more to check than a slightly bad one. If precheck_required is set with
+        set_validation_mode, a document missing required top level keys is reported
+        without full validation.
+
+        Parameters:
+            doc (str or dict):
+                If dict, metadata document to be validated.
+                If str, absolute path to json file containing document.
+            max_errors (int): Maximum number of errors to report.
+
+        Returns:
+            list: One dict per error, with "path", the JSON path of the failing value, e.g.
+                "$.project.PI", "validator", the schema keyword that failed, e.g. "required",
+                and "message", a short description. Empty if the document is valid or no
+                schema is set.
+            Or
+            str: An error message beginning with "Error:" if the document can't be loaded.
+
+        """
+
+        if not self.is_schema_set():
+            return []
+
+        if type(doc) not in [str, dict]:
+            return f"Error: doc must be a str or dict"
+
+        if type(doc) is str:
+            doc, size, error = self._load_json_file(doc)
+            if error:
+                return error
+
+        schema = self.__select_schema(doc)
+        if type(schema) is str:
+            return schema
+
+        return self.__compact_errors(doc, max_errors, schema)
+    
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __ingest_batches(self, items, batch_size, dead_letters=None, where=None):
+
+        """
+
+        Prepare documents and insert the valid ones in batches.
+
+        Parameters:
+            items (iterable): (key, doc) tuples. The key is any caller chosen value used to
+                identify the document in the results, e.g. its position or file offset.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            dead_letters (DeadLetters): If given, rejected documents are recorded in it.
+            where (callable): Gives the dead letter location fields of a document for its
+                key, as a dict of DeadLetters.record's source, position and offset.
+
+        Yields:
+            (key, result) tuples, where result is an IngestResult. Documents that fail
+            before insertion are yielded immediately, so results are not necessarily in
+            input order.
+
+        """
+
+        if self.skip_existing and not self.upsert and self.collection is not None:
+            return self.__ingest_batches_skipping_existing(items, batch_size, dead_letters, where)
+
+        # On failure, pass on the document as given, so it can be dead lettered.
+        def prepared():
+            for key, doc in items:
+                prepared_doc, failure = self._prepare(doc)
+                yield key, doc if failure else prepared_doc, failure
+
+        return self._write_results(prepared(), batch_size, dead_letters, where)
+
+
+    def __ingest_batches_skipping_existing(self, items, batch_size, dead_letters=None, where=None):
+
+        """
+
+        Prepare documents and insert the valid ones in batches, as __ingest_batches does, but
+        skip the documents whose keys are already in the collection before validating them.
+        See set_skip_existing.
+
+        Parameters:
+            As for __ingest_batches.
+
+        Yields:
+            (key, result) tuples, as for __ingest_batches.
+
+        """
+
+        pending = {} # Key -> index key value, of the documents passed on to be inserted
+
+        def prepared():
+            items_iter = iter(items)
+            while True:
+                chunk = list(itertools.islice(items_iter, batch_size))
+                if not chunk:
+                    return
+
+                # Documents prepared by prepare_document are only validated again if needed.
+                for key, doc, prepared_doc, failure in self.__look_up_chunk(chunk):
+                    if not failure and type(doc) is not ValidationResult:
+                        prepared_doc, failure = self.__validate(prepared_doc)
+                    if failure:
+                        yield key, doc, failure
+                        continue
+                    value = prepared_doc.get(self.index_keys)
+                    if self.__is_key(value):
+                        pending[key] = value
+                    yield key, prepared_doc, None
+
+        return self.__remember_written_keys(self._write_results(prepared(), batch_size,
+            dead_letters, where), pending)
+
+
+    def __look_up_chunk(self, chunk):
+
+        """
+
+        Load and key correct a chunk of documents, and look their index_keys values up in
+        the collection with a single query, the first steps of set_skip_existing's check.
+
+        Parameters:
+            chunk (list): (key, doc) tuples, with the documents as given to the ingest
+                methods.
+
+        Returns:
+            list: A (key, doc, prepared_doc, failure) tuple for each document, where doc is
+                the document as given. If failure is set, the document failed to load or key
+                correct, or is already in the collection, and prepared_doc is None.
+                Otherwise prepared_doc is the loaded and key corrected document, which still
+                needs validating unless doc is a ValidationResult.
+
+        """
+
+        loaded = [(key, doc) + (self._prepare(doc) if type(doc) is ValidationResult
+            else self.__load_and_correct(doc)) for key, doc in chunk]
+        existing = self.__existing_keys([prepared_doc.get(self.index_keys)
+            for key, doc, prepared_doc, failure in loaded if not failure])
+
+        looked_up = []
+        for key, doc, prepared_doc, failure in loaded:
+            if not failure:
+                value = prepared_doc.get(self.index_keys)
+                if self.__is_key(value) and value in existing:
+                    prepared_doc, failure = None, IngestResult(IngestStatus.DUPLICATE, "insert")
+            looked_up.append((key, doc, prepared_doc, failure))
+        return looked_up
+
+
+    def __remember_written_keys(self, results, pending):
+
+        """
+
+        Pass write results through, remembering the index_keys values of the documents
+        written, or found to be in the collection already, for set_skip_existing's check.
+
+        Parameters:
+            results (iterable): (key, result) tuples, where result is an IngestResult.
+            pending (dict): Key -> index_keys value, of the documents passed on to be
+                written. Each is removed when its result comes.
+
+        Yields: The (key, result) tuples, unchanged.
+
+        """
+
+        for key, result in results:
+            value = pending.pop(key, None)
+            if value is not None and result.status in (IngestStatus.INGESTED,
+                IngestStatus.DUPLICATE):
+                self.__remember_keys([value])
+            yield key, result
+
+
+    def _write_results(self, prepared, batch_size, dead_letters=None, where=None):
+
+        """
+
+        Insert already prepared documents in batches.
+
+        Parameters:
+            prepared (iterable): (key, doc, failure) tuples, as returned by _prepare with
+                the key of the document in front. If failure is set, doc may be the
+                document or file name as given, to dead letter, or None.
+            batch_size (int): Maximum number of documents sent in a single insert_many call.
+            dead_letters (DeadLetters): If given, rejected documents are recorded in it.
+            where (callable): Gives the dead letter location fields of a document for its
+                key, as in __ingest_batches. If None, no locations are recorded.
+
+        Yields:
+            (key, result) tuples, as in __ingest_batches.
+
+        """
+
+        write_batch = self.__upsert_batch if self.upsert else self.__insert_batch
+        if where is None:
+            where = lambda key: {}
+
+        def written(batch):
+            results = self.__timed_write_batch(write_batch, batch)
+            if dead_letters is None:
+                return results
+            return self.__dead_letter_write_failures(results, batch, dead_letters, where)
+
+        batch = []
+        for key, doc, failure in prepared:
+            if failure is not None and failure.skipped:
+                if self.stats is not None:
+                    self.__count_write_result(failure)
+                yield key, failure
+                continue
+            if failure is not None:
+                if dead_letters is not None:
+                    dead_letters.record(failure.message, failure.stage, doc, **where(key))
+                yield key, failure
+                continue
+
+            batch.append((key, doc))
+            if len(batch) >= batch_size:
+                yield from written(batch)
+                batch = []
+
+        if batch:
+            yield from written(batch)
+
+
+    def __dead_letter_write_failures(self, results, batch, dead_letters, where):
+
+        """
+
+        Pass the results of writing a batch through, recording the documents that failed
+        in the dead letters. Duplicates and other skipped documents are not recorded.
+
+        Parameters:
+            results (iterable): (key, result) tuples, in the order of batch.
+            batch (list): (key, doc) tuples of the documents written.
+            dead_letters (DeadLetters): Where to record failed documents.
+            where (callable): Gives the dead letter location fields of a document for its key.
+
+        Yields: The (key, result) tuples, unchanged.
+
+        """
+
+        for (key, result), (batch_key, doc) in zip(results, batch):
+            if result.failed:
+                dead_letters.record(result.message, result.stage, doc, **where(key))
+            yield key, result
+
+
+    def __as_result(self, error):
+
+        """
+
+        Make an IngestResult from the error message of a ValidationResult.
+
+        Parameters:
+            error (str or IngestResult): The error message, or None. An IngestResult is
+                returned as it is.
+
+        Returns: IngestResult, or None if error is None.
+
+        """
+
+        if error is None or type(error) is IngestResult:
+            return error
+        return IngestResult.from_string(error, self.__failed_stage(error))
+
+
+    def __failed_stage(self, error):
+
+        """
+
+        Tell which stage of preparing a document an error came from.
+
+        Parameters:
+            error (str): Error message of a ValidationResult.
+
+        Returns: str. "load", "correct" or "validate".
+
+        """
+
+        if error.startswith("Error: could not load"):
+            return "load"
+        if error.startswith("Could not valiate"):
+            return "validate"
+        return "correct"
+
+
+    def __timed_write_batch(self, write_batch, batch):
+
+        """
+
+        Write a batch, recording its time and outcomes if instrumentation is on.
+
+        Parameters:
+            write_batch (callable): __insert_batch or __upsert_batch.
+            batch (list): (key, doc) tuples of documents that are ready to be written.
+
+        Returns: iterable of (key, result) tuples, as yielded by write_batch.
+
+        """
+
+        if self.stats is None:
+            return write_batch(batch)
+
+        start = time.perf_counter()
+        results = list(write_batch(batch))
+        self.stats.add_time("insert", time.perf_counter() - start)
+        for key, result in results:
+            self.__count_write_result(result)
+        return results
+
+
+    def __count_write_result(self, result):
+
+        """
+
+        Count the result of writing a document in the stats.
+
+        Parameters:
+            result (IngestResult): Result of the write.
+
+        Returns: None
+
+        """
+
+        if result.status is IngestStatus.INGESTED:
+            self.stats.add_count("ingested")
+        elif result.status is IngestStatus.DUPLICATE:
+            self.stats.add_count("duplicates")
+        elif result.status is IngestStatus.UNCHANGED:
+            self.stats.add_count("unchanged")
+        else:
+            self.stats.add_count("write_errors")
+
+
+    def __insert_document(self, doc):
+
+        """
+
+        Insert a single prepared document.
+
+        Parameters:
+            doc (dict): Document that is ready to be inserted.
+
+        Returns:
+            IngestResult. Ingested, a duplicate if the key is already in the collection,
+            or failed.
+
+        """
+
+        # Give the document its _id now, so that a retry can tell whether an earlier attempt
+        # wrote it.
+        doc = self._ready_to_write(doc)
+        doc.setdefault("_id", bson.ObjectId())
+
+        # Attempt ingestion
+        result, e, attempts = self.__call_with_retries(self.collection.insert_one, doc)
+        if e is None:
+            if result.acknowledged:
+                return IngestResult(IngestStatus.INGESTED, "insert", inserted_id=doc["_id"])
+
+        elif isinstance(e, pymongo.errors.DuplicateKeyError):
+            if attempts > 1 and self.__written_earlier([doc["_id"]]):
+                return IngestResult(IngestStatus.INGESTED, "insert", inserted_id=doc["_id"])
+            return IngestResult(IngestStatus.DUPLICATE, "insert")
+
+        else:
+            return IngestResult(IngestStatus.FAILED, "insert",
+                ("Error: Cannot ingest document, received exception ", e, "."))
+
+        return IngestResult(IngestStatus.FAILED, "insert",
+            "Error: Cannot ingest document, reason unknown.")
+
+
+    def __insert_batch(self, batch):
+
+        """
+
+        Insert a batch of prepared documents with a single unordered insert_many call.
+
+        Write errors reported by the server are mapped back to the document that caused
+        them, so every document gets the same result it would get from ingest_document.
+
+        Parameters:
+            batch (list): (key, doc) tuples of documents that are ready to be inserted.
+
+        Yields:
+            (key, result) tuples, where result is an IngestResult: ingested, a duplicate if
+            the key is already in the collection, or failed.
+
+        """
+
+        # Give the documents their _ids now, so that a retry can tell whether an earlier
+        # attempt wrote them.
+        docs = [self._ready_to_write(doc) for key, doc in batch]
+        for doc in docs:
+            doc.setdefault("_id", bson.ObjectId())
+
+        def send(positions):
+            return self.collection.insert_many([docs[index] for index in positions],
+                ordered=False)
+
+        # Index of the document in the batch -> result for that document, if not ingested.
+        failures = self.__bulk_write_with_retries(send, len(batch), IngestStatus.DUPLICATE,
+            [doc["_id"] for doc in docs])
+
+        for index, (key, doc) in enumerate(batch):
+            if index in failures:
+                yield key, failures[index]
+            else:
+                yield key, IngestResult(IngestStatus.INGESTED, "insert",
+                    inserted_id=docs[index]["_id"])
+
+
+    def __record_in_ledger(self, results, ledger, path_of, commit_interval):
+
+        """
+
+        Pass results through, recording those of files in a ledger, with the content hashes
+        taken as they were loaded, and committing it regularly, so that an interrupted run
+        loses at most commit_interval records.
+
+        Parameters:
+            results (iterable): (key, result) tuples, where result is an IngestResult.
+            ledger (IngestionLedger): Ledger to record the results in.
+            path_of (callable): Gives the file name for a key, or None if the document
+                did not come from a file.
+            commit_interval (int): Number of records between commits.
+
+        Yields: The (key, result) tuples, unchanged.
+
+        """
+
+        recorded = 0
+        for key, result in results:
+            path = path_of(key)
+            if path is not None:
+                file_hash = self.file_hashes.pop(path, None) if self.file_hashes else None
+                ledger.record(path, result, file_hash)
+                recorded += 1
+                if recorded % commit_interval == 0:
+                    ledger.commit()
+            yield key, result
+
+        ledger.commit()
+
+
+    def __upsert_batch(self, batch):
+
+        """
+
+        Upsert a batch of prepared documents with a single unordered bulk_write call.
+
+        The stored content hashes of the batch are fetched first, with one query, and
+        documents whose hash matches are not sent at all.
+
+        Parameters:
+            batch (list): (key, doc) tuples of documents that are ready to be upserted.
+
+        Yields:
+            (key, result) tuples, where result is an IngestResult: ingested if the document
+            was written, unchanged if it is stored with the same content, or failed.
+
+        """
+
+        # Index of the document in the batch -> result for that document, if not written.
+        failures = {}
+
+        docs = [self._ready_to_write(doc) for key, doc in batch]
+        stored_hashes = self.__stored_hashes([doc.get(self.index_keys) for doc in docs])
+        requests = []
+        for index, doc in enumerate(docs):
+            request = self.__upsert_request(doc)
+            if type(request) is str:
+                failures[index] = IngestResult(IngestStatus.FAILED, "insert", request)
+            elif self.__is_stored(doc, stored_hashes):
+                failures[index] = IngestResult(IngestStatus.UNCHANGED, "insert")
+            else:
+                requests.append((index, pymongo.ReplaceOne(*request, upsert=True)))
+
+        def send(positions):
+            return self.collection.bulk_write([requests[position][1] for position in positions],
+                ordered=False)
+
+        # Error positions refer to positions in requests, not in batch. Replacing is
+        # idempotent, so a retry of a write that was made only finds it unchanged.
+        if requests:
+            for position, result in self.__bulk_write_with_retries(send, len(requests),
+                IngestStatus.UNCHANGED).items():
+                failures[requests[position][0]] = result
+
+        for index, (key, doc) in enumerate(batch):
+            if index in failures:
+                yield key, failures[index]
+            else:
+                yield key, IngestResult(IngestStatus.INGESTED, "insert")
+
+
+    def __upsert_document(self, doc):
+
+        """
+
+        Upsert a single prepared document.
+
+        Parameters:
+            doc (dict): Document that is ready to be upserted.
+
+        Returns:
+            IngestResult. Ingested if the document was written, unchanged if it is stored
+            with the same content, or failed.
+
+        """
+
+        doc = self._ready_to_write(doc)
+        request = self.__upsert_request(doc)
+        if type(request) is str:
+            return IngestResult(IngestStatus.FAILED, "insert", request)
+        if self.__is_stored(doc, self.__stored_hashes([doc[self.index_keys]])):
+            return IngestResult(IngestStatus.UNCHANGED, "insert")
+
+        result, e, attempts = self.__call_with_retries(self.collection.replace_one, *request,
+            upsert=True)
+        if e is None:
+            if result.acknowledged:
+                return IngestResult(IngestStatus.INGESTED, "insert")
+
+        elif isinstance(e, pymongo.errors.DuplicateKeyError):
+            return IngestResult(IngestStatus.UNCHANGED, "insert")
+
+        else:
+            return IngestResult(IngestStatus.FAILED, "insert",
+                ("Error: Cannot ingest document, received exception ", e, "."))
+
+        return IngestResult(IngestStatus.FAILED, "insert",
+            "Error: Cannot ingest document, reason unknown.")
+
+
+    def __upsert_request(self, doc):
+
+        """
+
+        Build the filter and replacement document to upsert a prepared document.
+
+        The filter matches the stored document with the same index key only if its content
+        hash differs. Unchanged documents are normally found by __stored_hashes and never
+        sent, but if one is, e.g. because it was stored after the hashes were fetched or the
+        lookup failed, nothing matches, the upsert tries to insert a new document, and the
+        unique index rejects it with a duplicate key error, so no data is written.
+
+        Parameters:
+            doc (dict): Document to send, with its content hash set, see _ready_to_write.
+
+        Returns:
+            (filter, replacement) tuple, or an error message string beginning with "Error:"
+            if the document has no value for the index key.
+
+        """
+
+        if self.index_keys not in doc:
+            return f"Error: no {self.index_keys} key in document, cannot upsert."
+
+        # A stored document keeps its _id when replaced, so don't send one.
+        replacement = {key: value for key, value in doc.items() if key != "_id"}
+        return ({self.index_keys: doc[self.index_keys],
+            self.hash_key: {"$ne": doc[self.hash_key]}}, replacement)
+
+
+    def __validation_failure(self, doc):
+
+        """
+
+        Validate a loaded metadata document against its schema, as validate does, without
+        turning the error into a message yet.
+
+        Parameters:
+            doc (dict): Metadata document.
+
+        Returns:
+            None if the document is valid, or a tuple of parts whose str values make up
+            the error message, as validate returns it.
+
+        """
+
+        schema = self.__select_schema(doc)
+        if type(schema) is str:
+            return (schema,)
+
+        # Report compact errors, if that mode is set.
+        errors = self.__missing_required(doc, schema) if self.precheck_required else []
+        if not errors and self.max_errors:
+            errors = self.__compact_errors(doc, self.max_errors, schema)
+        if type(errors) is str:
+            return (errors,)
+        if errors:
+            count = f"{len(errors)} error" + ("s" if len(errors) > 1 else "")
+            if len(errors) == self.max_errors:
+                count = "at least " + count
+            return (f"Error: document validation failed, {count}: " + "; ".join(
+                f"{error['path']}: {error['message']} ({error['validator']})" for error in errors),)
+        if self.max_errors:
+            return None
+
+        # Attempt to validate doc against shcema. Like jsonschema.validate, report the most
+        # relevant error if there are several. Its message, which quotes the schema and
+        # the document, is only made if asked for.
+        try:
+            error = jsonschema.exceptions.best_match(schema.validator.iter_errors(doc))
+        except Exception as e:
+            error = e
+        if error is not None:
+            return ("Error: document validation failed, received exception ", error)
+
+        return None
+
+
+    def __compact_errors(self, doc, max_errors, schema):
+
+        """
+
+        Find up to max_errors validation errors in a loaded document, as compact records.
+
+        Parameters:
+            doc (dict): Metadata document.
+            max_errors (int): Maximum number of errors to find.
+            schema: The document's schema, as returned by __select_schema.
+
+        Returns:
+            list: Error records, as returned by validate_errors.
+            Or
+            str: An error message beginning with "Error:" if validation raised an exception.
+
+        """
+
+        if self.precheck_required:
+            missing = self.__missing_required(doc, schema)
+            if missing:
+                return missing[:max_errors]
+
+        try:
+            errors = itertools.islice(schema.validator.iter_errors(doc), max_errors)
+            return [{"path": self.__json_path(error.absolute_path), "validator": error.validator,
+                "message": error.message[:MAX_ERROR_MESSAGE_LENGTH]} for error in errors]
+        except Exception as e:
+            return f"Error: document validation failed, received exception {str(e)[:MAX_ERROR_MESSAGE_LENGTH]}"
+
+
+    def __missing_required(self, doc, schema):
+
+        """
+
+        Check that a document has the schema's required top level keys. This is a few dict
+        lookups, against full validation walking the whole document.
+
+        Parameters:
+            doc (dict): Metadata document.
+            schema: The document's schema, as returned by __select_schema.
+
+        Returns:
+            list: An error record, as returned by validate_errors, for each missing key.
+
+        """
+
+        if not isinstance(doc, dict):
+            return []
+        return [{"path": "$", "validator": "required", "message": f"{key!r} is a required property"}
+            for key in schema.required_keys if key not in doc]
+
+
+    def __select_schema(self, doc):
+
+        """
+
+        Get the schema to validate a document against: the one the schema registry selects,
+        if one is set, or the one set by set_schema.
+
+        Parameters:
+            doc (dict): Metadata document.
+
+        Returns:
+            The schema, with "validator" and "required_keys" attributes.
+            Or
+            str: An error message beginning with "Error:" if the registry has no schema for
+                the document.
+
+        """
+
+        if self.schema_registry is not None:
+            if not isinstance(doc, dict):
+                return "Error: document validation failed, document is not a json object."
+            return self.schema_registry.select(doc)
+        return self
+
+
+    def __validator_for(self, doc):
+
+        """
+
+        Get the compiled validator a document would be validated with now.
+
+        Parameters:
+            doc (dict): Metadata document.
+
+        Returns: The validator, or None if no schema is set or none matches the document.
+
+        """
+
+        if not self.is_schema_set():
+            return None
+        schema = self.__select_schema(doc)
+        return None if type(schema) is str else schema.validator
+
+
+    def __json_path(self, path):
+
+        """
+
+        Format the path of a value in a document as a JSON path.
+
+        Parameters:
+            path (iterable): Keys and indexes leading to the value, e.g. a jsonschema
+                error's absolute_path.
+
+        Returns: str, e.g. "$.project.samples[2].id".
+
+        """
+
+        return "$" + "".join(f"[{part}]" if type(part) is int else f".{part}" for part in path)
+
+
+    def _content_hash(self, doc):
+
+        """
+
+        Compute a hash of a document's content that doesn't depend on key order.
+
+        Parameters:
+            doc (dict): Metadata document. Its _id and content hash fields are left out.
+
+        Returns: str. Hex digest of the sha256 hash.
+
+        """
+
+        content = {key: value for key, value in doc.items()
+            if key not in ("_id", self.hash_key)}
+        text = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+    def _bulk_write_failures(self, e, batch_length, duplicate_status):
+
+        """
+
+        Map the details of a BulkWriteError from an unordered write back to the documents
+        that caused them.
+
+        Parameters:
+            e (pymongo.errors.BulkWriteError): The error raised by insert_many or bulk_write.
+            batch_length (int): Number of documents sent in the call.
+            duplicate_status (IngestStatus): Status of documents rejected with a duplicate
+                key error, DUPLICATE or, in upsert mode, UNCHANGED.
+
+        Returns:
+            dict: Maps the index of each failed document in the batch to its IngestResult,
+                of duplicate_status or failed.
+
+        """
+
+        failures = {}
+
+        # With an unordered write, every document not listed in writeErrors was written.
+        for write_error in e.details.get("writeErrors", []):
+            if write_error.get("code") in DUPLICATE_KEY_ERROR_CODES:
+                result = IngestResult(duplicate_status, "insert")
+            else:
+                result = IngestResult(IngestStatus.FAILED, "insert",
+                    ("Error: Cannot ingest document, received error ", write_error.get("errmsg"), "."))
+            failures[write_error["index"]] = result
+
+        # A write concern error means the documents may not be durably stored.
+        concern_errors = e.details.get("writeConcernErrors", [])
+        if concern_errors:
+            result = IngestResult(IngestStatus.FAILED, "insert",
+                ("Error: Cannot ingest document, write concern error ",
+                concern_errors[0].get("errmsg"), "."))
+            for index in range(batch_length):
+                failures.setdefault(index, result)
+
+        return failures
+
+
+    def __bulk_write_with_retries(self, send, batch_length, duplicate_status, ids=None):
+
+        """
+
+        Make an unordered bulk write, retrying the documents that failed with a retryable
+        error as the retry policy allows.
+
+        Parameters:
+            send (callable): Called as send(positions) to write the documents at those
+                positions in the batch, with insert_many or bulk_write.
+            batch_length (int): Number of documents in the batch.
+            duplicate_status (IngestStatus): Status of documents rejected with a duplicate
+                key error.
+            ids (list): The _id of each document. If given, a document sent more than once
+                and rejected as a duplicate is checked for, as an earlier attempt may have
+                written it before failing.
+
+        Returns:
+            dict: Maps the index of each document in the batch that wasn't written to its
+                IngestResult, as in _bulk_write_failures.
+
+        """
+
+        failures = {}
+        pending = list(range(batch_length))
+        resent = set() # Positions of documents sent more than once
+        attempt = 0
+        while pending:
+            result, e, attempts = self.__call_with_retries(send, pending)
+            attempt += attempts
+            if attempts > 1:
+                resent.update(pending)
+
+            # Position of the document in the batch -> its result, for those to retry. A
+            # failure of the whole write is one result, shared by every document in it.
+            retry = {}
+            if e is None:
+                if not result.acknowledged:
+                    failures.update(dict.fromkeys(pending, IngestResult(IngestStatus.FAILED,
+                        "insert", "Error: Cannot ingest document, reason unknown.")))
+
+            elif isinstance(e, pymongo.errors.BulkWriteError):
+                retryable = self.__retryable_write_errors(e, len(pending))
+                for index, failure in self._bulk_write_failures(e, len(pending),
+                    duplicate_status).items():
+                    if index in retryable:
+                        retry[pending[index]] = failure
+                    else:
+                        failures[pending[index]] = failure
+
+            else:
+                failures.update(dict.fromkeys(pending, IngestResult(IngestStatus.FAILED,
+                    "insert", ("Error: Cannot ingest document, received exception ", e, "."))))
+
+            if retry:
+                self.retry_policy.record_failure()
+                if attempt > self.retry_policy.retries:
+                    failures.update(retry)
+                    break
+                time.sleep(self.retry_policy.delay(attempt - 1))
+                resent.update(retry)
+            pending = sorted(retry)
+
+        if ids is not None:
+            duplicates = [index for index, failure in failures.items()
+                if index in resent and failure.status is duplicate_status]
+            if duplicates:
+                written = self.__written_earlier([ids[index] for index in duplicates])
+                for index in duplicates:
+                    if ids[index] in written:
+                        del failures[index]
+
+        return failures
+
+
+    def __call_with_retries(self, write, *args, **kwargs):
+
+        """
+
+        Make a write, retrying it as the retry policy allows if it fails with a retryable
+        error, and waiting first if the circuit breaker is open.
+
+        Parameters:
+            write (callable): The collection method to call, e.g. insert_one.
+            args, kwargs: Its arguments.
+
+        Returns:
+            (result, error, attempts) tuple. result is what write returned, or None if it
+            failed. error is None, or the exception the last attempt raised. attempts is the
+            number of times write was called.
+
+        """
+
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            try:
+                policy.wait_for_server()
+                result = write(*args, **kwargs)
+
+            except CircuitOpenError as e:
+                return None, e, attempt
+
+            except Exception as e:
+                if not policy.is_retryable(e):
+                    # An error from the server, e.g. a duplicate key, shows it is up.
+                    if isinstance(e, pymongo.errors.OperationFailure):
+                        policy.record_success()
+                    return None, e, attempt + 1
+
+                policy.record_failure()
+                if attempt >= policy.retries:
+                    return None, e, attempt + 1
+                time.sleep(policy.delay(attempt))
+                attempt += 1
+                continue
+
+            policy.record_success()
+            return result, None, attempt + 1
+
+
+    def __retryable_write_errors(self, e, batch_length):
+
+        """
+
+        Find the documents of a bulk write that failed with a retryable error.
+
+        Parameters:
+            e (pymongo.errors.BulkWriteError): The error raised by insert_many or bulk_write.
+            batch_length (int): Number of documents sent in the call.
+
+        Returns:
+            set: Indexes in the batch of the documents that may be written if sent again.
+
+        """
+
+        codes = self.retry_policy.RETRYABLE_ERROR_CODES
+        retryable = {write_error["index"] for write_error in e.details.get("writeErrors", [])
+            if write_error.get("code") in codes}
+
+        # If the write concern failed because the primary stepped down, the documents
+        # without write errors may not have been written.
+        if any(error.get("code") in codes for error in e.details.get("writeConcernErrors", [])):
+            failed = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+            retryable.update(index for index in range(batch_length) if index not in failed)
+
+        return retryable
+
+
+    def __written_earlier(self, ids):
+
+        """
+
+        Find which of a set of documents are in the collection, after a retry rejected them
+        as duplicates.
+
+        Parameters:
+            ids (list): _ids of the documents.
+
+        Returns:
+            set: The _ids that are in the collection.
+
+        """
+
+        try:
+            return {doc["_id"] for doc in self.collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+        except Exception:
+            return set()
+
+
+    def __existing_keys(self, values):
+
+        """
+
+        Find which index_keys values are in the collection, with a single query for the ones
+        not already known. See set_skip_existing.
+
+        Parameters:
+            values (list): index_keys values of a batch of documents. Values that can't be
+                looked up, e.g. None, are ignored.
+
+        Returns:
+            set: The values that are in the collection. If the query fails, only the known
+                ones, so the documents are validated and inserted as usual.
+
+        """
+
+        values = {value for value in values if self.__is_key(value)}
+        unknown = list(values.difference(self.known_keys))
+        if unknown:
+            try:
+                found = [doc[self.index_keys] for doc in self.collection.find(
+                    {self.index_keys: {"$in": unknown}}, {self.index_keys: 1, "_id": 0})]
+            except Exception:
+                found = []
+            self.__remember_keys(found)
+        return values.intersection(self.known_keys)
+
+
+    def __stored_hashes(self, values):
+
+        """
+
+        Fetch the content hashes stored for index_keys values, with a single query that
+        projects only the key and the hash. Used by upsert mode to skip unchanged documents
+        without sending them.
+
+        Parameters:
+            values (list): index_keys values of a batch of documents. Values that can't be
+                looked up, e.g. None, are ignored.
+
+        Returns:
+            dict: Maps each value found in the collection to its stored hash. If the query
+                fails, an empty dict, so every document is sent and the upsert filter
+                decides.
+
+        """
+
+        values = list({value for value in values if self.__is_key(value)})
+        if not values:
+            return {}
+        try:
+            return {doc[self.index_keys]: doc.get(self.hash_key) for doc in self.collection.find(
+                {self.index_keys: {"$in": values}}, {self.index_keys: 1, self.hash_key: 1, "_id": 0})}
+        except Exception:
+            return {}
+
+
+    def __is_stored(self, doc, stored_hashes):
+
+        """
+
+        Tell whether a document is stored with the same content, per __stored_hashes.
+
+        Parameters:
+            doc (dict): Document to send, with its content hash set, see _ready_to_write.
+            stored_hashes (dict): As returned by __stored_hashes.
+
+        Returns: bool.
+
+        """
+
+        value = doc.get(self.index_keys)
+        if not self.__is_key(value) or value not in stored_hashes:
+            return False
+        return stored_hashes[value] is not None and stored_hashes[value] == doc.get(self.hash_key)
+
+
+    def __is_key(self, value):
+
+        """
+
+        Tell whether a value can be looked up and remembered as an index_keys value.
+
+        Parameters:
+            value: The value.
+
+        Returns: bool. True for strings and numbers.
+
+        """
+
+        return type(value) in (str, int, float)
+
+
+    def __remember_keys(self, values):
+
+        """
+
+        Remember index_keys values as being in the collection, up to MAX_KNOWN_KEYS of them.
+
+        Parameters:
+            values (iterable): The values.
+
+        Returns: None
+
+        """
+
+        if len(self.known_keys) >= MAX_KNOWN_KEYS:
+            self.known_keys.clear()
+        self.known_keys.update(value for value in values if self.__is_key(value))
+
+
+    def _prepare(self, doc):
+
+        """
+
+        Load, key correct and validate a document so that it is ready to be inserted.
+
+        Parameters:
+            doc (str, dict or ValidationResult):
+                If dict, metadata document to be prepared.
+                If str, absolute path to json file containing document.
+                If ValidationResult, a document already prepared by prepare_document.
+
+        Returns:
+            (doc, failure) tuple. On success doc is the prepared document as a dict and
+            failure is None. On failure doc is None and failure is an IngestResult.
+
+        """
+
+        # A document prepared by prepare_document only needs preparing again if the schema
+        # changed since.
+        if type(doc) is ValidationResult:
+            if doc.error:
+                return None, self.__as_result(doc.error)
+            if doc.validator is self.__validator_for(doc.doc):
+                return doc.doc, None
+            doc = doc.doc
+
+        doc, failure = self.__load_and_correct(doc)
+        if failure:
+            return None, failure
+        return self.__validate(doc)
+
+
+    def __load_and_correct(self, doc):
+
+        """
+
+        Load and key correct a document, the first steps of _prepare.
+
+        Parameters:
+            doc (str or dict):
+                If dict, metadata document to be prepared.
+                If str, absolute path to json file containing document.
+
+        Returns:
+            (doc, failure) tuple, as for _prepare.
+
+        """
+
+        # Time each stage if instrumentation is on.
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        # If given a file, try to open and load it as json.
+        if type(doc) is str:
+            doc, size, error = self._load_json_file(doc)
+            if error:
+                if stats is not None:
+                    stats.add_count("load_errors")
+                return None, IngestResult(IngestStatus.FAILED, "load", error)
+            if stats is not None:
+                stats.add_bytes(size)
+                start = self.__stage_done("load", start)
+
+        # A json file, or a caller, may give an array or other value rather
+        # than a document; fail just this one instead of raising.
+        if not isinstance(doc, dict):
+            if stats is not None:
+                stats.add_count("load_errors")
+            return None, IngestResult(IngestStatus.FAILED, "load", "Error: document is not a json object.")
+
+        # Fix the archivedPath key if needed. doc will be an updated document
+        # or error message
+        doc = self.__correct_archived_path_key(doc)
+        if stats is not None:
+            start = self.__stage_done("correct", start)
+        if type(doc) is str and doc.startswith("Error"):
+            if stats is not None:
+                stats.add_count("correction_errors")
+            return None, IngestResult(IngestStatus.FAILED, "correct", doc)
+
+        return doc, None
+
+
+    def __validate(self, doc):
+
+        """
+
+        Validate a loaded, key corrected document, the last step of _prepare.
+
+        Parameters:
+            doc (dict): Metadata document, as returned by __load_and_correct.
+
+        Returns:
+            (doc, failure) tuple, as for _prepare.
+
+        """
+
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        # Validation gives None on success, the parts of the error message otherwise.
+        try:
+            failure = self.__validation_failure(doc) if self.is_schema_set() else None
+            if stats is not None:
+                self.__stage_done("validate", start)
+            if failure:
+                if stats is not None:
+                    stats.add_count("validation_failures")
+                return None, IngestResult(IngestStatus.FAILED, "validate",
+                    ("Could not valiate doc, error was ",) + failure)
+        except Exception as e:
+            if stats is not None:
+                stats.add_count("validation_failures")
+            return None, IngestResult(IngestStatus.FAILED, "validate",
+                ("Could not valiate doc, received exception ", e))
+
+        return doc, None
+
+
+    def _ready_to_write(self, doc):
+
+        """
+
+        Make the document to send for a prepared document: its fields dropped or compressed
+        by the field transform, if set, and in upsert mode its content hash added. This is
+        done as each write is built, not when the document is prepared, so the prepared
+        document stays as validated, to be validated again if the schema changes, or kept
+        whole in the dead letters if the write fails.
+
+        Parameters:
+            doc (dict): Prepared document, as returned by _prepare. It is not changed.
+
+        Returns:
+            dict: The document to send. The prepared document itself if there is nothing to
+                change.
+
+        """
+
+        if self.field_transform is not None:
+            doc = self.field_transform.apply(doc)
+        if self.upsert:
+            doc = dict(doc)
+            doc[self.hash_key] = self._content_hash(doc)
+        return doc
+
+
+    def _load_json_file(self, filename):
+
+        """
+
+        Load a json file with the current json loader. This is the one path every method
+        uses to load documents from files. While a ledger is in use, the file's content hash
+        is taken from the bytes read and kept in file_hashes for the ledger to record.
+
+        Parameters:
+            filename (str): Absolute path to json file.
+
+        Returns:
+            (doc, size, error) tuple. On success doc is the loaded json, size the file size
+            in bytes and error None. On failure doc and size are None and error is the error
+            message string.
+
+        """
+
+        try:
+            if self.file_hashes is None:
+                doc, size = self.json_loader.load_file(filename)
+            else:
+                doc, size, self.file_hashes[filename] = self.json_loader.load_file(filename,
+                    digest=True)
+        except Exception as e:
+            return None, None, f"Error: could not load {filename} as json"
+
+        return doc, size, None
+
+
+    def __stage_done(self, stage, start):
+
+        """
+
+        Record the time spent in a stage of preparing a document.
+
+        Parameters:
+            stage (str): One of IngestionStats.STAGES.
+            start (float): time.perf_counter() when the stage started.
+
+        Returns: float. time.perf_counter() now, i.e. the start of the next stage.
+
+        """
+
+        now = time.perf_counter()
+        self.stats.add_time(stage, now - start)
+        return now
+
+
+    def __correct_archived_path_key(self, doc): 
+
+        """
+        Correct outdated or wrong archived_path key.
+
+        We want metadata to have a field named 'archived_path', but in some older data it is 
+        instead written as 'archiveFolderPath' or 'archivedFolderPath' (note the letter 'd').
+        In faculty (derived) data, it might also have a hyphen, incorrect case, or other error. 
+        This method will insert the correct key and delete the old one. If the document has
+        no field for the archived path, an error is returned. The aliases tried can be set
+        with set_key_aliases or the config file.
+
+        Parameters:
+            doc (dict): Metadata document as dict.
+
+        Returns: Updated metadata document as dict, or string beginning with "Error" if no
+            archived_path is found.
+        """
+
+        # If the metadata has one of the older or incorrect archivedPath keys, change it to the 
+        # correct one by moving its value to the correct key. See KeyAliases.
+        resolved = self.key_aliases.resolve(doc)
+        if type(resolved) is str:
+            return resolved
+
+        doc, alias = resolved
+        if alias is not None and self.stats is not None:
+            self.stats.add_alias(alias)
+
+        return doc
+     
+
+    def _set_key_aliases_from_config(self, mongo_section):
+
+        """
+
+        Set the archived path aliases from a config file section.
+
+        The archived_path_aliases field is a comma separated list of aliases, and the
+        archived_path_pattern field a regular expression, or "none" for no pattern. Either
+        may be left out to use the default.
+
+        Parameters:
+            mongo_section (dict): The mongodb section of the config file.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        aliases = mongo_section.get("archived_path_aliases")
+        if aliases is not None:
+            aliases = [alias.strip() for alias in aliases.split(",") if alias.strip()]
+
+        pattern = mongo_section.get("archived_path_pattern", KeyAliases.DEFAULT_PATTERN)
+        if pattern.strip().lower() in ["", "none"]:
+            pattern = None
+
+        return self.set_key_aliases(aliases, pattern)
+
+
+    def _set_field_transform_from_config(self, mongo_section):
+
+        """
+
+        Set the fields dropped or compressed before storing from a config file section.
+
+        The drop_fields and compress_fields fields are comma separated lists of keys or
+        dotted paths. compress_min_bytes and compress_level, if given, set FieldTransform's
+        min_bytes and level.
+
+        Parameters:
+            mongo_section (dict): The mongodb section of the config file.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        settings = {}
+        for name in ["drop", "compress"]:
+            fields = mongo_section.get(f"{name}_fields", "")
+            settings[name] = [field.strip() for field in fields.split(",") if field.strip()]
+        try:
+            for name in ["min_bytes", "level"]:
+                if f"compress_{name}" in mongo_section:
+                    settings[name] = int(mongo_section[f"compress_{name}"])
+            self.field_transform = FieldTransform(**settings)
+        except ValueError as e:
+            return f"Error: invalid field compression settings in config file, {str(e)}."
+
+        return None
+
+
+    def _client_options_from_config(self, mongo_section):
+
+        """
+
+        Get the MongoClient options from the CLIENT_OPTIONS fields of a config file section,
+        and its compressors field, a comma separated list of COMPRESSORS in order of
+        preference. Compressors whose module is not installed are left out.
+
+        Parameters:
+            mongo_section (dict): The mongodb section of the config file.
+
+        Returns:
+            dict of options, or error message string beginning with "Error:".
+
+        """
+
+        options = {}
+        for name in CLIENT_OPTIONS:
+            if name in mongo_section:
+                try:
+                    options[name] = int(mongo_section[name])
+                except ValueError:
+                    return f"Error: {name} in config file must be an integer, not {mongo_section[name]}."
+
+        if "compressors" in mongo_section:
+            compressors = [name.strip().lower() for name in mongo_section["compressors"].split(",")
+                if name.strip()]
+            for name in compressors:
+                if name not in COMPRESSORS:
+                    return (f"Error: unknown compressor {name} in config file, must be one of "
+                        f"{', '.join(COMPRESSORS)}.")
+            compressors = [name for name in compressors
+                if importlib.util.find_spec(COMPRESSORS[name]) is not None]
+            if compressors:
+                options["compressors"] = ",".join(compressors)
+
+        return options
+
+
+    def __set_retry_policy_from_config(self, mongo_section):
+
+        """
+
+        Set the retry policy from the RETRY_OPTIONS fields of a config file section, if it
+        has any. Fields left out keep RetryPolicy's defaults.
+
+        Parameters:
+            mongo_section (dict): The mongodb section of the config file.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        settings = {}
+        for name, (parameter, factor) in RETRY_OPTIONS.items():
+            if name in mongo_section:
+                try:
+                    value = int(mongo_section[name])
+                except ValueError:
+                    return f"Error: {name} in config file must be an integer, not {mongo_section[name]}."
+                settings[parameter] = value * factor
+
+        if settings:
+            self.retry_policy = RetryPolicy(**settings)
+
+        return None
+
+
+    def _write_concern_from_config(self, mongo_section):
+
+        """
+
+        Get the write concern set by the w, j and wtimeout fields of a config file section.
+
+        w is a number of servers or a tag such as "majority", j is whether to wait for the
+        journal, and wtimeout is how long to wait for w servers, in milliseconds.
+
+        Parameters:
+            mongo_section (dict): The mongodb section of the config file.
+
+        Returns:
+            pymongo.WriteConcern, or None if the section sets none of the fields.
+            Or
+            str: An error message beginning with "Error:".
+
+        """
+
+        settings = {}
+        try:
+            if "w" in mongo_section:
+                w = mongo_section["w"]
+                settings["w"] = int(w) if w.isdigit() else w
+            if "j" in mongo_section:
+                settings["j"] = mongo_section.getboolean("j")
+            if "wtimeout" in mongo_section:
+                settings["wtimeout"] = int(mongo_section["wtimeout"])
+            if not settings:
+                return None
+            return pymongo.WriteConcern(**settings)
+        except Exception as e:
+            return f"Error: invalid write concern in config file, received exception {str(e)}."
+
+
+    def __validator_class(self, schema):
+
+        """
+
+        Get the jsonschema validator class for the draft named in a schema's "$schema"
+        keyword, or Draft 7 if it names none.
+
+        Parameters:
+            schema (dict): json schema.
+
+        Returns: jsonschema validator class.
+
+        """
+
+        return jsonschema.validators.validator_for(schema, default=jsonschema.Draft7Validator)
+
+
+    def __parse_config_file(self, filename, cache=True):
+
+        """
+
+        Parse a config or secrets file, reusing the result while the file is unchanged.
+
+        Parameters:
+            filename (str): Absolute path to the file.
+            cache (bool): Whether to keep the parsed file for reuse. False for secrets files.
+
+        Returns: configparser.ConfigParser. Empty if the file does not exist.
+
+        Raises: configparser.Error if the file is not in config file format.
+
+        """
+
+        if not cache:
+            parsed = configparser.ConfigParser()
+            parsed.read(filename)
+            return parsed
+
+        try:
+            key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns)
+        except OSError:
+            key = None
+
+        if key:
+            with _parsed_config_files_lock:
+                parsed = _parsed_config_files.get(key)
+                if parsed is not None:
+                    _parsed_config_files.move_to_end(key)
+                    return parsed
+
+        parsed = configparser.ConfigParser()
+        parsed.read(filename)
+        if key:
+            with _parsed_config_files_lock:
+                # Drop earlier versions of the file, which will not be read again.
+                for stale in [old for old in _parsed_config_files if old[0] == key[0]]:
+                    del _parsed_config_files[stale]
+                _parsed_config_files[key] = parsed
+                while len(_parsed_config_files) > MAX_PARSED_CONFIG_FILES:
+                    _parsed_config_files.popitem(last=False)
+
+        return parsed
+
+
+    def _read_config_file(self, mode, config_filename):
+
+        """
+
+        Read either a given config file or look for one in the user's home directory.
+
+        Parameters:
+            config_filename (str) : Absolute path to config file. If None, will look in home dir.
+
+        Returns:
+            mongo_config (dict) : dict with config values
+            Or
+            mongo_config (str) : An error message beginning with "Error"
+
+        """
+
+        # If no config given, use default in user's home directory
+        if not config_filename:
+            # Use the default config file that should be located in this directory
+            src_dir = str(Path.home())
+            config_filename = os.path.join(src_dir, "ingester_config.cfg")
+
+        # Open config file
+        try:
+            user_config = self.__parse_config_file(config_filename)
+        except Exception as e:
+            return f"Error: cannot read config file {config_filename}, received exception {str(e)}."
+
+        # Confirm it has the rquested dev, test, or prod "mongodb" section
+        mode = "mongodb" + '_' + mode
+        try:
+            mongo_config = user_config[mode]
+        except Exception as e:
+            return f"Error: no {mode} section in config file {config_filename}."
+
+        # Get the index_keys or return an error if not found.
+        if "index_keys" not in mongo_config:
+            return f"Error: no index_keys in {mode} section of config file {config_filename}."
+
+        return mongo_config
+
+        
+    def _read_secrets_file(self, mode, secrets_filename):
+
+        """
+
+        Read either a given secrets file or look for one in the user's home directory.
+
+        Parameters:
+            secrets_filename (str) : Absolute path to config file. If None, will look in home dir.
+
+        Returns:
+            password (str) : The password if successful, or an error message beginning with "Error".
+
+        """
+
+        # If no secrets file was given, use the default in the user's home directory
+        if not secrets_filename:
+            home_dir = str(Path.home())
+            secrets_filename = os.path.join(home_dir, "ingester_secrets.cfg")
 
         if not os.path.exists(secrets_filename):
             return f"Error: secrets file {secrets_filename} does not exist."
 
         try:
-            secrets_config = configparser.ConfigParser()
-            secrets_config.read(secrets_filename)
+            secrets_config = self.__parse_config_file(secrets_filename, cache=False)
         except Exception as e:
             return f"Error: cannot read secrets file {secrets_filename}, received exception {str(e)}."
 
@@ -415,8 +2774,87 @@ class MetadataMongoIngester:
 
         password = mongo_section["password"]
         return password
-      
-        
-        
 
-    
+
+"""
+PROCESS POOL WORKERS
+"""
+
+# The ingester used by a worker process of ingest_directory. It is a copy of the calling
+# ingester, made by _init_pool_worker, and is only used to prepare documents.
+_pool_ingester = None
+
+
+def _init_pool_worker(ingester):
+
+    """
+
+    Initialize a worker process of ingest_directory.
+
+    Parameters:
+        ingester (MetadataMongoIngester): Unpickled copy of the calling ingester.
+
+    Returns: None
+
+    """
+
+    global _pool_ingester
+    _pool_ingester = ingester
+    if _pool_ingester.stats is not None:
+        _pool_ingester.stats.reset()
+
+
+def _prepare_chunk_in_pool_worker(filenames):
+
+    """
+
+    Prepare a chunk of json files in a worker process of ingest_directory.
+
+    Parameters:
+        filenames (list of str or dict): Absolute paths to json files containing documents,
+            or, with set_skip_existing, the documents loaded and looked up by the calling
+            process.
+
+    Returns:
+        list: A (doc, failure, stats, file_hash) tuple for each file, as returned by
+            _prepare_in_pool_worker.
+
+    """
+
+    return [_prepare_in_pool_worker(filename) for filename in filenames]
+
+
+def _prepare_in_pool_worker(filename):
+
+    """
+
+    Load, key correct and validate a json file in a worker process of ingest_directory.
+
+    Parameters:
+        filename (str or dict): Absolute path to json file containing document, or the
+            document, already loaded.
+
+    Returns:
+        (doc, failure, stats, file_hash) tuple. doc and failure are as returned by
+        MetadataMongoIngester._prepare; a failure's message is put together when it is
+        pickled. If instrumentation is on, stats is a snapshot of the numbers recorded for
+        this file, for the calling ingester to merge. Otherwise it is None. If the calling
+        ingester has a ledger, file_hash is the file's entry for its file_hashes, or None if
+        the file could not be read.
+
+    """
+
+    doc, failure = _pool_ingester._prepare(filename)
+
+    file_hash = None
+    if _pool_ingester.file_hashes is not None:
+        file_hash = _pool_ingester.file_hashes.pop(filename, None)
+
+    stats = _pool_ingester.stats
+    if stats is None:
+        return doc, failure, None, file_hash
+
+    snapshot = stats.snapshot()
+    stats.reset()
+    return doc, failure, snapshot, file_hash
+
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+    Ingest documents into several collections at once, loading and validating each document only once.
+
+"""
+
+import queue
+import threading
+
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+
+class MultiTargetIngester:
+
+    """
+
+    Ingest documents into several collections at once, loading and validating each document only once.
+
+    A target is a MetadataMongoIngester connected to one collection, e.g. the test and prod
+    collections when promoting a delivery, or one collection per group. The documents are
+    loaded, key corrected and validated once, by the preparing ingester, with its schema or
+    schema registry. Each target then has its own writer thread, which inserts (or, if the
+    target is in upsert mode, upserts) the documents routed to it in batches, dropping or
+    compressing fields as its own config file section sets, with drop_fields and
+    compress_fields. A slow or failing target doesn't hold up the others by more than
+    max_queued_batches batches, and each target reports its own results.
+
+    """
+
+    def __init__(self, ingester=None, route=None, max_queued_batches=2):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            ingester (MetadataMongoIngester): Ingester that prepares the documents. Its
+                schema and key aliases are used; it needs no connection. If None, a new
+                ingester, with no schema, is used.
+            route (callable): If given, called as route(doc) with each prepared document,
+                returning the names of the targets it is written to. If None, or it returns
+                None, documents are written to every target.
+            max_queued_batches (int): Maximum number of batches waiting for each target.
+
+        Returns: None
+
+        """
+
+        self.ingester = ingester or MetadataMongoIngester()
+        self.max_queued_batches = max_queued_batches
+        self.route = route
+        self.targets = {} # Target name -> MetadataMongoIngester
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def add_target(self, name, mode="dev", config_filename=None, secrets_filename=None,
+        collection_name=None, upsert=False):
+
+        """
+
+        Connect a new target.
+
+        Parameters:
+            name (str): Name of the target, used in the results and by route.
+            mode (str): Section of the config and secrets files to use, as in
+                MetadataMongoIngester.open_connection.
+            config_filename (str): Absolute path to a config file. If None, the default one.
+            secrets_filename (str): Absolute path to a secrets file. If None, the default one.
+            collection_name (str): Collection to use instead of the one in the config file.
+            upsert (bool): If True, the target replaces stored documents that have changed.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        if name in self.targets:
+            return f"Error: there is already a target named {name}."
+
+        target = MetadataMongoIngester()
+        error = target.open_connection(mode, config_filename, secrets_filename, collection_name)
+        if error:
+            target.close()
+            return error
+        target.set_upsert(upsert)
+        self.targets[name] = target
+        return None
+
+
+    def close(self):
+
+        """
+
+        Close the connections of every target.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        for target in self.targets.values():
+            target.close()
+
+
+    def ingest_documents(self, docs, batch_size=1000, dead_letters=None):
+
+        """
+
+        Ingest documents into every target they are routed to.
+
+        Parameters:
+            docs (iterable of str or dict):
+                Metadata documents as dicts, or absolute paths to json files containing them.
+            batch_size (int): Maximum number of documents sent to a target in a single call.
+            dead_letters (dict): If given, target name -> DeadLetters, to record the
+                documents that target rejected in.
+
+        Returns:
+            dict: Target name -> list of one result per input document, in input order, as
+                returned by MetadataMongoIngester.ingest_documents. Documents not routed to
+                a target are "Not routed, skipped" in its list.
+            Or
+            str: An error message beginning with "Error:" if there are no targets, a setting
+                is not valid, or a writer stopped on an unexpected exception.
+
+        """
+
+        if not self.targets:
+            return "Error: no targets to ingest into."
+        if type(batch_size) is not int or batch_size < 1:
+            return f"Error: batch_size must be a positive integer, not {batch_size}."
+        if type(self.max_queued_batches) is not int or self.max_queued_batches < 1:
+            return ("Error: max_queued_batches must be a positive integer, not "
+                f"{self.max_queued_batches}.")
+        dead_letters = dead_letters or {}
+
+        paths = {} # Index -> file name, of the documents given as files
+        results = {name: {} for name in self.targets}
+        failures = [] # Unexpected exceptions that stopped a writer
+        queues = {name: queue.Queue(self.max_queued_batches) for name in self.targets}
+        writers = [threading.Thread(target=self.__write, args=(name, queues[name],
+            results[name], batch_size, dead_letters.get(name), paths, failures))
+            for name in self.targets]
+
+        for writer in writers:
+            writer.start()
+        try:
+            count = self.__prepare(docs, batch_size, queues, results, paths)
+        finally:
+            for batch_queue in queues.values():
+                batch_queue.put(None)
+            for writer in writers:
+                writer.join()
+
+        if failures:
+            name, e = failures[0]
+            return f"Error: writing to target {name} stopped, received exception {str(e)}."
+
+        return {name: [target_results[index] for index in range(count)]
+            for name, target_results in results.items()}
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __prepare(self, docs, batch_size, queues, results, paths):
+
+        """
+
+        Load, key correct and validate the documents, handing them to the writers in batches.
+
+        Parameters:
+            docs (iterable of str or dict): The documents to ingest.
+            batch_size (int): Number of documents per batch.
+            queues (dict): Target name -> queue.Queue of batches for its writer.
+            results (dict): Target name -> dict of results, to mark unrouted documents in.
+            paths (dict): Index -> file name, filled in for the documents given as files.
+
+        Returns: int. The number of documents.
+
+        """
+
+        ingester = self.ingester
+        not_routed = IngestResult(IngestStatus.NOT_ROUTED).as_string()
+        batches = {name: [] for name in self.targets}
+        count = 0
+        for index, given in enumerate(docs):
+            count += 1
+            if type(given) is str:
+                paths[index] = given
+            doc, failure = ingester._prepare(given)
+
+            names = self.targets
+            if failure is None and self.route is not None:
+                routed = self.route(doc)
+                if routed is not None:
+                    names = set(routed)
+                    unknown = names.difference(self.targets)
+                    if unknown:
+                        failure = IngestResult(IngestStatus.FAILED, "correct",
+                            f"Error: no target named {sorted(unknown)[0]}, cannot ingest.")
+                        names = self.targets
+
+            for name in self.targets:
+                if name not in names:
+                    results[name][index] = not_routed
+                    continue
+                # Each target gets its own copy, as writing adds _id to the document. A
+                # failed document is passed on as given, for the dead letters.
+                batches[name].append((index, given if failure else dict(doc), failure))
+                if len(batches[name]) >= batch_size:
+                    queues[name].put(batches[name])
+                    batches[name] = []
+
+        for name, batch in batches.items():
+            if batch:
+                queues[name].put(batch)
+        return count
+
+
+    def __write(self, name, batch_queue, results, batch_size, dead_letters, paths, failures):
+
+        """
+
+        Write the batches handed to one target until there are no more.
+
+        Parameters:
+            name (str): Name of the target.
+            batch_queue (queue.Queue): Batches of (index, doc, failure) tuples, then None.
+            results (dict): Index -> result, filled in for each document.
+            batch_size (int): Maximum number of documents per write.
+            dead_letters (DeadLetters): If given, rejected documents are recorded in it.
+            paths (dict): Index -> file name, of the documents given as files.
+            failures (list): (name, exception) tuples, added to if writing stops.
+
+        Returns: None
+
+        """
+
+        target = self.targets[name]
+        where = lambda index: {"source": paths.get(index), "position": index}
+        stopped = False
+        while True:
+            batch = batch_queue.get()
+            if batch is None:
+                return
+            if stopped:
+                # This target stopped; keep taking its batches so the others aren't held up.
+                continue
+
+            try:
+                written = target._write_results(iter(batch), batch_size, dead_letters, where)
+                for index, result in written:
+                    results[index] = result.as_string()
+            except Exception as e:
+                failures.append((name, e))
+                stopped = True
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+    Decide when and how long to wait before retrying a failed write, and pause writes while the server is down.
+
+"""
+
+import random
+import threading
+import time
+
+import pymongo
+
+
+class CircuitOpenError(Exception):
+
+    """ Raised instead of writing when the server has been down longer than the policy waits. """
+
+
+class RetryPolicy:
+
+    """
+
+    Decide when and how long to wait before retrying a failed write, and pause writes while the server is down.
+
+    Writes that fail with a network error, a primary election, or another error the server
+    labels as retryable are retried up to retries times, waiting longer each time: backoff
+    seconds, then twice that, and so on up to max_backoff, with random jitter so that
+    writers don't retry in step. Other errors are not retried.
+
+    After breaker_threshold writes in a row fail with a retryable error, the circuit
+    breaker opens and writes wait. Every breaker_reset seconds one write is let through to
+    try the server. If it succeeds the breaker closes and the waiting writes go ahead; if
+    not, the wait starts again. Once the server has been down for max_pause seconds, writes
+    fail with CircuitOpenError instead of waiting, except for the one every breaker_reset
+    seconds that checks whether the server is back.
+
+    """
+
+    # Server error codes for errors that a retried write may not hit, e.g. a step down.
+    RETRYABLE_ERROR_CODES = frozenset([6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602,
+        13435, 13436])
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=5.0, breaker_threshold=5,
+        breaker_reset=10.0, max_pause=60.0):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            retries (int): Maximum number of times a write is retried. 0 turns retries off.
+            backoff (float): Seconds to wait before the first retry.
+            max_backoff (float): Longest wait between retries, in seconds.
+            breaker_threshold (int): Number of writes in a row failing with a retryable
+                error that opens the circuit breaker. 0 turns the breaker off.
+            breaker_reset (float): Seconds writes wait while the breaker is open, before the
+                server is tried again.
+            max_pause (float): Seconds of the server being down after which writes fail
+                instead of waiting.
+
+        Returns: None
+
+        """
+
+        self.backoff = backoff
+        self.breaker_reset = breaker_reset
+        self.breaker_threshold = breaker_threshold
+        self.condition = threading.Condition()
+        self.down_since = None # When the breaker opened, if it is open
+        self.failures = 0 # Writes in a row that failed with a retryable error
+        self.max_backoff = max_backoff
+        self.max_pause = max_pause
+        self.opened_at = None # When the breaker opened or the server was last tried
+        self.retries = retries
+
+
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle. The condition can't be pickled, and is made again by
+        __setstate__.
+
+        Parameters: None
+
+        Returns: dict of data members.
+
+        """
+
+        state = self.__dict__.copy()
+        del state["condition"]
+        return state
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore the state of an unpickled copy.
+
+        Parameters:
+            state (dict): As returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.__dict__.update(state)
+        self.condition = threading.Condition()
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def delay(self, attempt):
+
+        """
+
+        Get how long to wait before a retry.
+
+        Parameters:
+            attempt (int): Number of the attempt that failed, from 0.
+
+        Returns: float. Seconds to wait, between half and all of the exponential backoff.
+
+        """
+
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    def is_retryable(self, e):
+
+        """
+
+        Tell whether a write that raised an exception may succeed if tried again.
+
+        Parameters:
+            e (Exception): The exception raised by the write.
+
+        Returns: bool.
+
+        """
+
+        if isinstance(e, pymongo.errors.ConnectionFailure):
+            return True
+        if isinstance(e, pymongo.errors.PyMongoError) and e.has_error_label("RetryableWriteError"):
+            return True
+        return isinstance(e, pymongo.errors.OperationFailure) and e.code in self.RETRYABLE_ERROR_CODES
+
+
+    def record_failure(self):
+
+        """
+
+        Note that a write failed with a retryable error, opening the breaker if there have
+        been breaker_threshold in a row.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        with self.condition:
+            self.failures += 1
+            if self.breaker_threshold and self.failures >= self.breaker_threshold:
+                self.opened_at = time.monotonic()
+                if self.down_since is None:
+                    self.down_since = self.opened_at
+
+
+    def record_success(self):
+
+        """
+
+        Note that the server answered a write, closing the breaker.
+
+        Parameters: None
+
+        Returns: None
+
+        """
+
+        with self.condition:
+            self.failures = 0
+            self.opened_at = None
+            self.down_since = None
+            self.condition.notify_all()
+
+
+    def wait_for_server(self):
+
+        """
+
+        Wait while the breaker is open, before writing.
+
+        Parameters: None
+
+        Returns: None
+
+        Raises: CircuitOpenError if the server has been down longer than max_pause.
+
+        """
+
+        with self.condition:
+            while self.opened_at is not None:
+                now = time.monotonic()
+                wait = self.opened_at + self.breaker_reset - now
+                if wait <= 0:
+                    # Let this write through to try the server. The others wait for it.
+                    self.opened_at = now
+                    return
+                if now + wait - self.down_since > self.max_pause:
+                    raise CircuitOpenError("server unavailable for "
+                        f"{now - self.down_since:.0f} seconds, circuit breaker open")
+                self.condition.wait(wait)
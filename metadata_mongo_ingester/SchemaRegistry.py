@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""
+    Hold several compiled json schemas and pick the one each metadata document is validated against.
+
+"""
+
+import json
+import os
+import threading
+import time
+
+import jsonschema
+
+
+class SchemaRegistry:
+
+    """
+
+    Hold several compiled json schemas and pick the one each metadata document is validated against.
+
+    Each schema file is loaded, checked and compiled once, when added. A document is routed
+    to a schema by its discriminator value: the value of the first discriminator key it
+    has, e.g. its "$schema" or "project.Version" field, or the value returned by a
+    discriminator function. A schema matches the values it was added with, and its own "$id"
+    (or draft 4 "id"). Documents matching no schema are validated against the default
+    schema, if one is set, and rejected otherwise.
+
+    Schema files are checked for changes at most once every check_interval seconds. A
+    changed file is compiled again; if it is no longer a valid schema, the last good
+    version is kept.
+
+    """
+
+    DEFAULT_DISCRIMINATORS = ("$schema",)
+
+    def __init__(self, discriminators=DEFAULT_DISCRIMINATORS, check_interval=1.0):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            discriminators (list of str, or callable): Keys, or dotted paths to nested keys,
+                whose value selects a document's schema, tried in order. Or a function
+                called as discriminators(doc) that returns the value, or None.
+            check_interval (float): Seconds between checks of a schema file for changes.
+                If None, files are never reloaded.
+
+        Returns: None
+
+        """
+
+        if callable(discriminators):
+            self.discriminators = discriminators
+        else:
+            self.discriminators = [tuple(key.split(".")) for key in discriminators]
+        self.check_interval = check_interval
+        self.default = None # File name of the schema for unmatched documents
+        self.lock = threading.Lock()
+        self.routes = {} # Discriminator value -> schema file name
+        self.schemas = {} # Schema file name -> _CompiledSchema
+
+
+    def __getstate__(self):
+
+        """
+
+        Get the state to pickle, e.g. when copying an ingester into worker processes. The
+        lock and compiled validators can't be pickled, and are made again by __setstate__.
+
+        Parameters: None
+
+        Returns: dict of data members.
+
+        """
+
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["schemas"] = {filename: (compiled.schema, compiled.mtime)
+            for filename, compiled in self.schemas.items()}
+        return state
+
+
+    def __setstate__(self, state):
+
+        """
+
+        Restore a pickled registry, compiling its schemas again.
+
+        Parameters:
+            state (dict): As returned by __getstate__.
+
+        Returns: None
+
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.schemas = {filename: _CompiledSchema(filename, schema, mtime)
+            for filename, (schema, mtime) in state["schemas"].items()}
+
+
+    """
+    PUBLIC METHODS
+    """
+
+
+    def add(self, schema_filename, values=None, default=False):
+
+        """
+
+        Load, check and compile a schema file, and route documents to it.
+
+        Parameters:
+            schema_filename (str): Absolute path to json schema file.
+            values (list): Discriminator values of the documents to validate against this
+                schema, in addition to the schema's own "$id" or "id".
+            default (bool): If True, documents matching no schema are validated against
+                this one.
+
+        Returns:
+            None if successful, or error message string beginning with "Error:".
+
+        """
+
+        filename = os.path.abspath(schema_filename)
+        compiled = self.__compile(filename)
+        if type(compiled) is str:
+            return compiled
+
+        own_id = compiled.schema.get("$id", compiled.schema.get("id"))
+        values = list(values or []) + ([own_id] if type(own_id) is str else [])
+        for value in values:
+            route = self.routes.get(self.__route_key(value))
+            if route is not None and route != filename:
+                return f"Error: discriminator value {value} already routes to schema {route}."
+
+        with self.lock:
+            self.schemas[filename] = compiled
+            for value in values:
+                self.routes[self.__route_key(value)] = filename
+            if default:
+                self.default = filename
+
+        return None
+
+
+    def select(self, doc):
+
+        """
+
+        Get the compiled schema a document is to be validated against, reloading it first if
+        its file has changed.
+
+        Parameters:
+            doc (dict): Metadata document.
+
+        Returns:
+            _CompiledSchema: With "schema", "validator", "required_keys" and "filename".
+            Or
+            str: An error message beginning with "Error:" if no schema matches.
+
+        """
+
+        value = self.__discriminator_value(doc)
+        filename = self.routes.get(self.__route_key(value), self.default)
+        if filename is None:
+            if value is None:
+                return "Error: document has no schema discriminator and no default schema is set."
+            return f"Error: no schema for discriminator value {value}."
+
+        compiled = self.schemas[filename]
+        if self.check_interval is not None and (time.monotonic() - compiled.checked_at >=
+            self.check_interval):
+            compiled = self.__reload_if_changed(compiled)
+        return compiled
+
+
+    """
+    PRIVATE METHODS
+    """
+
+
+    def __compile(self, filename, mtime=None):
+
+        """
+
+        Load, check and compile a schema file.
+
+        Parameters:
+            filename (str): Absolute path to json schema file.
+            mtime (int): Modification time of the file, in ns, if already known.
+
+        Returns:
+            _CompiledSchema, or error message string beginning with "Error:".
+
+        """
+
+        try:
+            if mtime is None:
+                mtime = os.stat(filename).st_mtime_ns
+            with open(filename, 'r') as f:
+                schema = json.load(f)
+            if not isinstance(schema, dict):
+                raise ValueError("schema is not a json object")
+            return _CompiledSchema(filename, schema, mtime, check=True)
+        except Exception as e:
+            return f"Error: could not set schema {filename}, received exception {str(e)}."
+
+
+    def __discriminator_value(self, doc):
+
+        """
+
+        Get a document's discriminator value.
+
+        Parameters:
+            doc (dict): Metadata document.
+
+        Returns: The value, or None if the document has none.
+
+        """
+
+        if callable(self.discriminators):
+            return self.discriminators(doc)
+
+        for parts in self.discriminators:
+            value = doc
+            for part in parts:
+                if not isinstance(value, dict) or part not in value:
+                    break
+                value = value[part]
+            else:
+                return value
+        return None
+
+
+    def __reload_if_changed(self, compiled):
+
+        """
+
+        Compile a schema file again if it changed since it was compiled.
+
+        Parameters:
+            compiled (_CompiledSchema): The schema as last compiled.
+
+        Returns: _CompiledSchema. The new version, or compiled if the file didn't change or
+            can't be compiled.
+
+        """
+
+        with self.lock:
+            # Another thread may have reloaded it while this one waited.
+            current = self.schemas[compiled.filename]
+            if current is not compiled:
+                return current
+
+            compiled.checked_at = time.monotonic()
+            try:
+                mtime = os.stat(compiled.filename).st_mtime_ns
+            except OSError:
+                return compiled
+            if mtime == compiled.mtime:
+                return compiled
+
+            reloaded = self.__compile(compiled.filename, mtime)
+            if type(reloaded) is str:
+                # Keep the last good version, and don't try this version of the file again.
+                compiled.mtime = mtime
+                return compiled
+            self.schemas[compiled.filename] = reloaded
+            return reloaded
+
+
+    def __route_key(self, value):
+
+        """
+
+        Get the key a discriminator value is routed by. Values are compared as strings, so
+        a Version of 1 matches "1". Lists and objects match nothing.
+
+        Parameters:
+            value: Discriminator value.
+
+        Returns: str, or None.
+
+        """
+
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        return str(value)
+
+
+class _CompiledSchema:
+
+    """
+
+    A json schema and its compiled validator, as held by SchemaRegistry.
+
+    """
+
+    def __init__(self, filename, schema, mtime, check=False):
+
+        """
+
+        Compile a schema.
+
+        Parameters:
+            filename (str): Absolute path to the json schema file.
+            schema (dict): The loaded schema.
+            mtime (int): Modification time of the file when loaded, in ns.
+            check (bool): If True, check the schema is valid first.
+
+        Returns: None
+
+        Raises: jsonschema.exceptions.SchemaError if check is True and the schema is not valid.
+
+        """
+
+        # Use the validator class for the draft named in "$schema", as set_schema does.
+        validator_class = jsonschema.validators.validator_for(schema,
+            default=jsonschema.Draft7Validator)
+        if check:
+            validator_class.check_schema(schema)
+
+        self.checked_at = time.monotonic() # When the file was last checked for changes
+        self.filename = filename
+        self.mtime = mtime
+        required = schema.get("required", [])
+        self.required_keys = tuple(key for key in required if type(key) is str)
+        self.schema = schema
+        self.validator = validator_class(schema)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+    Hold a metadata document that has been loaded, key corrected and validated, ready to ingest.
+
+"""
+
+
+class ValidationResult:
+
+    """
+
+    Hold a metadata document that has been loaded, key corrected and validated, ready to ingest.
+
+    Returned by MetadataMongoIngester.prepare_document. Passing it to ingest_document or
+    ingest_documents inserts the prepared document without loading or validating it again,
+    as long as the ingester's schema has not changed since. A result is true if the
+    document is valid, false if not.
+
+    """
+
+    def __init__(self, doc, error, source=None, validator=None):
+
+        """
+
+        Initialize data members.
+
+        Parameters:
+            doc (dict): The prepared document, or None if preparing it failed.
+            error (str): The error message if preparing the document failed, or None.
+            source (str): Absolute path to the json file the document came from, if any.
+            validator: The compiled schema validator the document was checked with, or None
+                if no schema was set. Used to tell whether the schema changed since.
+
+        Returns: None
+
+        """
+
+        self.doc = doc
+        self.error = error
+        self.source = source
+        self.validator = validator
+
+
+    def __bool__(self):
+        return self.error is None
+
+
+    def __repr__(self):
+        status = "valid" if self.error is None else f"error={self.error[:80]!r}"
+        source = f" source={self.source!r}" if self.source else ""
+        return f"<ValidationResult {status}{source}>"
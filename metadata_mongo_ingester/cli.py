@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+
+"""
+    Command line entry points to ingest a directory of metadata documents into a MongoDB collection, to replay the ones rejected, and to backfill from several nodes.
+
+"""
+
+import argparse
+import os
+import sys
+
+from metadata_mongo_ingester.BackfillCoordinator import BackfillCoordinator
+from metadata_mongo_ingester.DeadLetters import DeadLetters
+from metadata_mongo_ingester.DirectoryWatcher import DirectoryWatcher
+from metadata_mongo_ingester.IngestionLedger import IngestionLedger
+from metadata_mongo_ingester.IngestResult import IngestStatus
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from metadata_mongo_ingester.SchemaRegistry import SchemaRegistry
+
+
+def main(argv=None):
+
+    """
+
+    Ingest every matching json file beneath a directory, or every document in an NDJSON or
+    json array file. Installed as the metadata-mongo-ingest console script.
+
+    Parameters:
+        argv (list of str): Command line arguments. If None, sys.argv is used.
+
+    Returns:
+        int: Exit status. 0 if every file was ingested or skipped, 1 otherwise.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="metadata-mongo-ingest",
+        description="Validate metadata json files and ingest them into a MongoDB collection.")
+    parser.add_argument("path",
+        help="Directory to search for metadata json files, or an NDJSON or json array file.")
+    parser.add_argument("--glob", default="**/*.json",
+        help="Pattern, relative to the directory, of the files to ingest. Default: %(default)s")
+    parser.add_argument("--format", default=None, choices=["ndjson", "array"],
+        help="Format of a file given as path. Default: tell from the file contents.")
+    parser.add_argument("--workers", type=int, default=None,
+        help="Number of worker processes. Default: one per CPU.")
+    add_ingester_arguments(parser)
+    parser.add_argument("--ledger", default=None,
+        help="SQLite file recording the files ingested, so unchanged files are skipped on "
+        "later runs and an interrupted run can be resumed. Default: no ledger.")
+    parser.add_argument("--watch", action="store_true",
+        help="Keep running, ingesting new or changed files as they appear in the directory, "
+        "until interrupted.")
+    parser.add_argument("--settle-time", type=float, default=2.0,
+        help="With --watch, seconds a file must go unchanged before it is ingested. "
+        "Default: %(default)s")
+    parser.add_argument("--build-indexes", default="background",
+        choices=["background", "after", "no"],
+        help="When to build the secondary indexes listed in the config file and annotated in "
+        "the schema: while ingesting, after ingesting, which is faster for a large load, or "
+        "not at all. Default: %(default)s")
+    args = parser.parse_args(argv)
+
+    mmi = open_ingester(args)
+    if mmi is None:
+        return 1
+
+    index_planner = mmi.build_indexes() if args.build_indexes == "background" else None
+    status = ingest(mmi, args)
+    if args.build_indexes == "after":
+        index_planner = mmi.build_indexes(background=False)
+    if index_planner is not None and report_index_builds(index_planner):
+        return 1
+    return status
+
+
+def ingest(mmi, args):
+
+    """
+
+    Ingest the directory or file given on the command line, or watch the directory.
+
+    Parameters:
+        mmi (MetadataMongoIngester): Connected ingester.
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        int: Exit status. 0 if every file was ingested or skipped, 1 otherwise.
+
+    """
+
+    dead_letters = DeadLetters(args.dead_letters) if args.dead_letters else None
+    try:
+        if os.path.isfile(args.path):
+            return ingest_file(mmi, args, dead_letters)
+        if args.watch:
+            return watch(mmi, args, dead_letters)
+
+        ledger = IngestionLedger(args.ledger) if args.ledger else None
+        try:
+            results = mmi.ingest_directory(args.path, args.glob, workers=args.workers,
+                batch_size=args.batch_size, ledger=ledger, dead_letters=dead_letters,
+                structured=True)
+        finally:
+            if ledger:
+                ledger.close()
+    finally:
+        if dead_letters:
+            dead_letters.close()
+    if type(results) is str:
+        print(results, file=sys.stderr)
+        return 1
+
+    ingested = skipped = failed = 0
+    for filename, result in results.items():
+        if result.failed:
+            failed += 1
+            print(f"{filename}: {result.message}", file=sys.stderr)
+        elif result.skipped:
+            skipped += 1
+        else:
+            ingested += 1
+
+    print(f"{ingested} ingested, {skipped} skipped, {failed} failed.")
+    return 1 if failed else 0
+
+
+def replay(argv=None):
+
+    """
+
+    Ingest the documents recorded in a dead letter file again, e.g. after fixing the schema
+    or the data. Installed as the metadata-mongo-replay console script.
+
+    Parameters:
+        argv (list of str): Command line arguments. If None, sys.argv is used.
+
+    Returns:
+        int: Exit status. 0 if every document was ingested or skipped, 1 otherwise.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="metadata-mongo-replay",
+        description="Ingest the documents recorded in a dead letter file again.")
+    parser.add_argument("path", help="Dead letter NDJSON file written by metadata-mongo-ingest.")
+    add_ingester_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.path):
+        print(f"Error: {args.path} is not a file.", file=sys.stderr)
+        return 1
+    if args.dead_letters and os.path.abspath(args.dead_letters) == os.path.abspath(args.path):
+        print("Error: --dead-letters must be a different file from the one replayed.",
+            file=sys.stderr)
+        return 1
+
+    mmi = open_ingester(args)
+    if mmi is None:
+        return 1
+
+    new_dead_letters = DeadLetters(args.dead_letters) if args.dead_letters else None
+    try:
+        with DeadLetters(args.path) as dead_letters:
+            results = mmi.replay_dead_letters(dead_letters, args.batch_size, new_dead_letters,
+                structured=True)
+    finally:
+        if new_dead_letters:
+            new_dead_letters.close()
+    if type(results) is str:
+        print(results, file=sys.stderr)
+        return 1
+
+    ingested = skipped = failed = 0
+    for record, result in results:
+        if result.skipped:
+            skipped += 1
+        elif not result.failed:
+            ingested += 1
+        else:
+            failed += 1
+            where = record.get("source") or "document"
+            if record.get("offset") is not None:
+                where += f" offset {record['offset']}"
+            elif record.get("position") is not None:
+                where += f" position {record['position']}"
+            print(f"{where}: {result.message}", file=sys.stderr)
+
+    print(f"{ingested} ingested, {skipped} skipped, {failed} failed.")
+    return 1 if failed else 0
+
+
+def backfill(argv=None):
+
+    """
+
+    Plan a backfill into shards in a state collection, work through its shards, or show its
+    progress. Run "work" on as many nodes as wanted, with the same backfill name. Installed
+    as the metadata-mongo-backfill console script.
+
+    Parameters:
+        argv (list of str): Command line arguments. If None, sys.argv is used.
+
+    Returns:
+        int: Exit status. 0 on success, 1 on error or if any file failed.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="metadata-mongo-backfill",
+        description="Split a backfill into shards that several workers ingest and checkpoint.")
+    parser.add_argument("name",
+        help="Name of the backfill: the collection, in the config file's database, that holds "
+        "its plan and leases.")
+    add_connection_arguments(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan = commands.add_parser("plan", help="Split the files to ingest into shards.")
+    plan.add_argument("path",
+        help="Directory to search for metadata json files, or a manifest file listing one "
+        "json file per line.")
+    plan.add_argument("--glob", default="**/*.json",
+        help="Pattern, relative to a directory, of the files to ingest. Default: %(default)s")
+    plan.add_argument("--shard-size", type=int, default=1000,
+        help="Number of files per shard. Default: %(default)s")
+
+    work = commands.add_parser("work", help="Claim and ingest shards until none are left.")
+    add_ingester_arguments(work, connection=False)
+    work.add_argument("--checkpoint-size", type=int, default=100,
+        help="Number of files ingested between checkpoints. Default: %(default)s")
+    work.add_argument("--lease", type=float, default=600.0,
+        help="Seconds a claim on a shard lasts without a checkpoint. Default: %(default)s")
+    work.add_argument("--no-build-indexes", dest="build_indexes", action="store_false",
+        help="Don't build the secondary indexes listed in the config file and annotated in "
+        "the schema when the backfill is complete.")
+
+    commands.add_parser("status", help="Show the progress of the backfill and its failures.")
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        mmi = open_ingester(args)
+        if mmi is None:
+            return 1
+    else:
+        mmi = MetadataMongoIngester()
+        error = mmi.open_connection(args.mode, args.config, args.secrets)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+
+    state = mmi.get_collection().database[args.name]
+    with BackfillCoordinator(state, getattr(args, "lease", 600.0)) as coordinator:
+        if args.command == "plan":
+            error = coordinator.plan(args.path, args.glob, args.shard_size)
+            if error:
+                print(error, file=sys.stderr)
+                return 1
+
+        elif args.command == "work":
+            dead_letters = DeadLetters(args.dead_letters) if args.dead_letters else None
+            try:
+                summary = coordinator.run_worker(mmi, batch_size=args.checkpoint_size,
+                    dead_letters=dead_letters)
+            finally:
+                if dead_letters:
+                    dead_letters.close()
+            if type(summary) is str:
+                print(summary, file=sys.stderr)
+                return 1
+            print(f"{summary['shards']} shards finished: {summary['ingested']} ingested, "
+                f"{summary['skipped']} skipped, {summary['failed']} failed.")
+
+            # Build the secondary indexes once the whole backfill is in, so they don't slow
+            # it down. If several workers finish at once, the server builds each index once.
+            status = coordinator.get_status()
+            if args.build_indexes and status["pending"] == status["claimed"] == 0:
+                if report_index_builds(mmi.build_indexes(background=False)):
+                    return 1
+            return 1 if summary["failed"] else 0
+
+        status = coordinator.get_status()
+        if args.command == "status":
+            for path, result in coordinator.get_failures():
+                print(f"{path}: {result}", file=sys.stderr)
+        print(f"{status['files']} files in {status['pending'] + status['claimed'] + status['done']} "
+            f"shards: {status['done']} done, {status['claimed']} claimed, {status['pending']} "
+            f"pending. {status['ingested']} ingested, {status['skipped']} skipped, "
+            f"{status['failed']} failed.")
+    return 1 if status["failed"] else 0
+
+
+def report_index_builds(index_planner):
+
+    """
+
+    Wait for the secondary indexes to be built, and print how long each took.
+
+    Parameters:
+        index_planner (IndexPlanner or str): As returned by build_indexes.
+
+    Returns:
+        int: 0 if every index was built, 1 otherwise.
+
+    """
+
+    if type(index_planner) is str:
+        print(index_planner, file=sys.stderr)
+        return 1
+
+    failed = 0
+    for report in index_planner.wait():
+        if report["error"]:
+            failed += 1
+            print(report["error"], file=sys.stderr)
+        else:
+            print(f"Built index {report['name']} on {report['keys']} in {report['seconds']:.1f} s.")
+    return 1 if failed else 0
+
+
+def add_connection_arguments(parser):
+
+    """
+
+    Add the arguments that pick the database to connect to, shared by the console scripts.
+
+    Parameters:
+        parser (argparse.ArgumentParser): Parser to add them to.
+
+    Returns: None
+
+    """
+
+    parser.add_argument("--mode", default="dev", choices=["dev", "test", "prod"],
+        help="Section of the config and secrets files to use. Default: %(default)s")
+    parser.add_argument("--config", default=None,
+        help="Config file. Default: ingester_config.cfg in your home directory.")
+    parser.add_argument("--secrets", default=None,
+        help="Secrets file. Default: ingester_secrets.cfg in your home directory.")
+
+
+def add_ingester_arguments(parser, connection=True):
+
+    """
+
+    Add the arguments that set up the ingester, shared by the console scripts.
+
+    Parameters:
+        parser (argparse.ArgumentParser): Parser to add them to.
+        connection (bool): If False, leave out the connection arguments, e.g. because a
+            parent parser already has them.
+
+    Returns: None
+
+    """
+
+    parser.add_argument("--batch-size", type=int, default=1000,
+        help="Maximum number of documents per insert. Default: %(default)s")
+    if connection:
+        add_connection_arguments(parser)
+    parser.add_argument("--schema", default=None,
+        help="json schema to validate documents against. With --route-schema, the schema "
+        "for documents no route matches. Default: no validation.")
+    parser.add_argument("--route-schema", action="append", default=[], metavar="VALUE=SCHEMA",
+        help="Validate documents whose discriminator is VALUE against the json schema SCHEMA. "
+        "Documents whose discriminator is a schema's own id are routed to it too. May be "
+        "given more than once.")
+    parser.add_argument("--discriminator", action="append", default=None, metavar="KEY",
+        help="Key, or dotted path, whose value picks a document's schema for --route-schema. "
+        "May be given more than once; the first one a document has is used. "
+        "Default: $schema")
+    parser.add_argument("--max-errors", type=int, default=None,
+        help="Report up to this many validation errors per document, one short line each, "
+        "instead of the most relevant error in full. Default: the most relevant error.")
+    parser.add_argument("--precheck-required", action="store_true",
+        help="Reject documents missing the schema's required top level keys before full "
+        "validation.")
+    parser.add_argument("--upsert", action="store_true",
+        help="Replace stored documents whose content has changed, instead of skipping them.")
+    parser.add_argument("--skip-existing", action="store_true",
+        help="Look up each batch's keys first, and skip documents already in the collection "
+        "without validating them. Ignored with --upsert.")
+    parser.add_argument("--dead-letters", default=None,
+        help="NDJSON file to record rejected documents in, with the reason and stage they "
+        "failed at, for metadata-mongo-replay. Default: don't record them.")
+
+
+def open_ingester(args):
+
+    """
+
+    Make an ingester, connect it and set its schema and upsert mode from the arguments,
+    printing any error.
+
+    Parameters:
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns: MetadataMongoIngester, or None on error.
+
+    """
+
+    mmi = MetadataMongoIngester()
+
+    error = mmi.open_connection(args.mode, args.config, args.secrets)
+    if error:
+        print(error, file=sys.stderr)
+        return None
+
+    if args.route_schema:
+        error = set_schema_registry(mmi, args)
+    else:
+        error = mmi.set_schema(args.schema)
+    if error:
+        print(error, file=sys.stderr)
+        return None
+
+    error = mmi.set_validation_mode(args.max_errors, args.precheck_required)
+    if error:
+        print(error, file=sys.stderr)
+        return None
+
+    mmi.set_upsert(args.upsert)
+    mmi.set_skip_existing(args.skip_existing)
+    return mmi
+
+
+def set_schema_registry(mmi, args):
+
+    """
+
+    Give the ingester a schema registry with the schemas routed by --route-schema, and
+    --schema as the default.
+
+    Parameters:
+        mmi (MetadataMongoIngester): Ingester to set the registry of.
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        None if successful, or error message string beginning with "Error:".
+
+    """
+
+    registry = SchemaRegistry(args.discriminator or SchemaRegistry.DEFAULT_DISCRIMINATORS)
+    routes = {}
+    for route in args.route_schema:
+        value, separator, schema_filename = route.partition("=")
+        if not separator or not schema_filename:
+            return f"Error: --route-schema must be VALUE=SCHEMA, not {route}."
+        routes.setdefault(schema_filename, []).append(value)
+
+    for schema_filename, values in routes.items():
+        error = registry.add(schema_filename, values)
+        if error:
+            return error
+    if args.schema:
+        error = registry.add(args.schema, default=True)
+        if error:
+            return error
+
+    mmi.set_schema_registry(registry)
+    return None
+
+
+def watch(mmi, args, dead_letters=None):
+
+    """
+
+    Ingest new or changed files in a directory as they appear, printing the results of each
+    batch, until interrupted.
+
+    Parameters:
+        mmi (MetadataMongoIngester): Ingester with an open connection.
+        args (argparse.Namespace): Parsed command line arguments.
+        dead_letters (DeadLetters): If given, rejected documents are recorded in it.
+
+    Returns:
+        int: Exit status. 0 if interrupted, 1 on error.
+
+    """
+
+    def report(results):
+        for filename, result in results.items():
+            if result.failed:
+                print(f"{filename}: {result.message}", file=sys.stderr)
+        ingested = sum(result.status is IngestStatus.INGESTED for result in results.values())
+        print(f"{ingested} of {len(results)} new or changed files ingested.")
+
+    ledger = IngestionLedger(args.ledger) if args.ledger else None
+    watcher = DirectoryWatcher(mmi, [args.path], args.glob, settle_time=args.settle_time,
+        batch_size=args.batch_size, ledger=ledger, dead_letters=dead_letters, structured=True)
+    try:
+        error = watcher.run(on_results=report)
+    except KeyboardInterrupt:
+        error = None
+    finally:
+        watcher.close()
+        if ledger:
+            ledger.close()
+    if error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+
+def ingest_file(mmi, args, dead_letters=None):
+
+    """
+
+    Stream the documents in an NDJSON or json array file into the collection, printing
+    progress as it goes.
+
+    Parameters:
+        mmi (MetadataMongoIngester): Ingester with an open connection.
+        args (argparse.Namespace): Parsed command line arguments.
+        dead_letters (DeadLetters): If given, rejected documents are recorded in it.
+
+    Returns:
+        int: Exit status. 0 if every document was ingested or skipped, 1 otherwise.
+
+    """
+
+    def progress(documents, bytes_read):
+        print(f"{documents} documents read, {bytes_read} bytes", file=sys.stderr)
+
+    summary = mmi.ingest_stream(args.path, args.format, batch_size=args.batch_size,
+        progress=progress, dead_letters=dead_letters)
+    if type(summary) is str:
+        print(summary, file=sys.stderr)
+        return 1
+
+    for offset, error in summary["errors"]:
+        print(f"{args.path} offset {offset}: {error}", file=sys.stderr)
+
+    print(f"{summary['ingested']} ingested, {summary['duplicates']} skipped, "
+        f"{summary['failed']} failed.")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
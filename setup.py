@@ -19,7 +19,18 @@ setuptools.setup(
         "pymongo",
         "pytest",
     ],
+    extras_require={
+        "fast": ["orjson"],
+        "compression": ["zstandard", "python-snappy"],
+    },
     url="https://github.com/TheJacksonLaboratory/metadata_mongo_ingester", 
     packages=setuptools.find_packages(),
-    python_requires='>=3.6',
+    entry_points={
+        "console_scripts": [
+            "metadata-mongo-ingest = metadata_mongo_ingester.cli:main",
+            "metadata-mongo-replay = metadata_mongo_ingester.cli:replay",
+            "metadata-mongo-backfill = metadata_mongo_ingester.cli:backfill",
+        ],
+    },
+    python_requires='>=3.7',
 )
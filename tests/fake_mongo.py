@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+'''
+In-process stand-in for a pymongo collection, so tests can run without a mongodb server, and
+helpers to make ingesters that write to one and documents to ingest.
+'''
+
+import asyncio
+import copy
+import json
+from multiprocessing.managers import BaseManager
+import os
+from pathlib import Path
+import threading
+
+import bson
+import pymongo
+
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+
+# The test configs, schemas and documents are beneath the directory of this file.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+configs_dir = Path(tests_dir, "configs")
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+good_schema = os.path.join(schemas_dir, "good_gt-schema.json")
+
+
+class FakeInsertOneResult:
+
+    """ Mimic pymongo.results.InsertOneResult. """
+
+    def __init__(self, inserted_id):
+        self.acknowledged = True
+        self.inserted_id = inserted_id
+
+
+class FakeInsertManyResult:
+
+    """ Mimic pymongo.results.InsertManyResult. """
+
+    def __init__(self, inserted_ids):
+        self.acknowledged = True
+        self.inserted_ids = inserted_ids
+
+
+class FakeUpdateResult:
+
+    """ Mimic pymongo.results.UpdateResult. """
+
+    def __init__(self, matched_count, upserted_id):
+        self.acknowledged = True
+        self.matched_count = matched_count
+        self.upserted_id = upserted_id
+
+
+class FakeBulkWriteResult:
+
+    """ Mimic pymongo.results.BulkWriteResult. """
+
+    def __init__(self):
+        self.acknowledged = True
+
+
+class FakeCollection:
+
+    """
+
+    Keep documents in a list and enforce unique indexes the way mongodb does.
+
+    Only the parts of the pymongo collection API used by the ingester and the backfill
+    coordinator are implemented. Exceptions added to faults, as (when, exception) tuples, are
+    raised by the next write calls, "before" or "after" making the write, to mimic a server
+    failing. Updates hold a lock, so they are atomic across threads as on a server.
+
+    """
+
+    def __init__(self, name="fake_collection", database=None):
+        self.name = name
+        self.database = database
+        self.docs = []
+        self.unique_keys = [] # List of lists of field names
+        self.unique_values = {} # Tuple of field names -> set of key values stored
+        self.bulk_write_calls = 0
+        self.create_index_calls = 0
+        self.faults = []
+        self.find_calls = 0
+        self.indexes = {} # Index name -> create_index options
+        self.insert_many_calls = 0
+        self.lock = threading.Lock()
+        self.replace_requests = 0 # Documents sent by replace_one and bulk_write
+        self.write_concern = None
+
+
+    def create_index(self, keys, unique=False, **kwargs):
+        self.create_index_calls += 1
+        if unique:
+            fields = [key for key, direction in keys]
+            if fields not in self.unique_keys:
+                self.unique_keys.append(fields)
+                self.unique_values[tuple(fields)] = {self.__key_value(doc, fields) for doc in self.docs}
+        name = kwargs.get("name") or "_".join(f"{key}_{direction}" for key, direction in keys)
+        self.indexes[name] = dict(kwargs, unique=unique)
+        return name
+
+
+    def count_documents(self, filter):
+        return len(list(self.find(filter)))
+
+
+    def find(self, filter=None, projection=None):
+        self.find_calls += 1
+        return self.__find(filter, projection)
+
+
+    def find_one(self, filter=None, projection=None):
+        return next(self.__find(filter, projection), None)
+
+
+    def find_one_and_update(self, filter, update, sort=None, return_document=False):
+        with self.lock:
+            matched = [doc for doc in self.docs if self.__matches(doc, filter)]
+            for key, direction in reversed(sort or []):
+                matched.sort(key=lambda doc: doc[key], reverse=direction < 0)
+            if not matched:
+                return None
+            before = copy.deepcopy(matched[0])
+            self.__update(matched[0], update)
+            return copy.deepcopy(matched[0]) if return_document else before
+
+
+    def update_one(self, filter, update):
+        with self.lock:
+            for doc in self.docs:
+                if self.__matches(doc, filter):
+                    self.__update(doc, update)
+                    return FakeUpdateResult(1, None)
+            return FakeUpdateResult(0, None)
+
+
+    def insert_one(self, doc):
+        self.__fault("before")
+        error = self.__insert(doc)
+        self.__fault("after")
+        if error:
+            raise pymongo.errors.DuplicateKeyError(error["errmsg"], error["code"])
+        return FakeInsertOneResult(doc["_id"])
+
+
+    def insert_many(self, docs, ordered=True):
+        self.insert_many_calls += 1
+        self.__fault("before")
+        docs = list(docs)
+        inserted_ids = []
+        write_errors = []
+        for index, doc in enumerate(docs):
+            error = self.__insert(doc)
+            if error:
+                error["index"] = index
+                write_errors.append(error)
+                if ordered:
+                    break
+            else:
+                inserted_ids.append(doc["_id"])
+        self.__fault("after")
+
+        if write_errors:
+            raise pymongo.errors.BulkWriteError({
+                "writeErrors": write_errors,
+                "writeConcernErrors": [],
+                "nInserted": len(inserted_ids),
+            })
+        return FakeInsertManyResult(inserted_ids)
+
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self.replace_requests += 1
+        self.__fault("before")
+        error, result = self.__replace(filter, replacement, upsert)
+        if error:
+            raise pymongo.errors.DuplicateKeyError(error["errmsg"], error["code"])
+        return result
+
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_write_calls += 1
+        self.replace_requests += len(requests)
+        self.__fault("before")
+        write_errors = []
+        for index, request in enumerate(requests):
+            assert isinstance(request, pymongo.ReplaceOne)
+            error, result = self.__replace(request._filter, request._doc, request._upsert)
+            if error:
+                error["index"] = index
+                write_errors.append(error)
+                if ordered:
+                    break
+
+        if write_errors:
+            raise pymongo.errors.BulkWriteError({"writeErrors": write_errors,
+                "writeConcernErrors": []})
+        return FakeBulkWriteResult()
+
+
+    def with_options(self, write_concern=None):
+        self.write_concern = write_concern
+        return self
+
+
+    def __find(self, filter, projection):
+        for doc in self.docs:
+            if self.__matches(doc, filter or {}):
+                yield copy.deepcopy(doc)
+
+
+    def __fault(self, when):
+        if self.faults and self.faults[0][0] == when:
+            raise self.faults.pop(0)[1]
+
+
+    def __replace(self, filter, replacement, upsert):
+        for position, doc in enumerate(self.docs):
+            if self.__matches(doc, filter):
+                new_doc = copy.deepcopy(replacement)
+                new_doc["_id"] = doc["_id"]
+                del self.docs[position]
+                self.__unindex(doc)
+                error = self.__insert(new_doc)
+                if error:
+                    self.docs.insert(position, doc)
+                    self.__index(doc)
+                    return error, None
+                return None, FakeUpdateResult(1, None)
+
+        if not upsert:
+            return None, FakeUpdateResult(0, None)
+
+        new_doc = {field: value for field, value in filter.items() if not isinstance(value, dict)}
+        new_doc.update(copy.deepcopy(replacement))
+        error = self.__insert(new_doc)
+        return error, None if error else FakeUpdateResult(0, new_doc["_id"])
+
+
+    def __insert(self, doc):
+        doc.setdefault("_id", bson.ObjectId())
+        for fields in [["_id"]] + self.unique_keys:
+            if self.__key_value(doc, fields) in self.unique_values.setdefault(tuple(fields), set()):
+                key_value = {field: self.__get(doc, field) for field in fields}
+                return {"code": 11000, "errmsg": f"E11000 duplicate key error dup key: {key_value}",
+                    "keyValue": key_value}
+        self.docs.append(copy.deepcopy(doc))
+        self.__index(doc)
+        return None
+
+
+    def __index(self, doc):
+        for fields in [["_id"]] + self.unique_keys:
+            self.unique_values.setdefault(tuple(fields), set()).add(self.__key_value(doc, fields))
+
+
+    def __unindex(self, doc):
+        for fields in [["_id"]] + self.unique_keys:
+            self.unique_values[tuple(fields)].discard(self.__key_value(doc, fields))
+
+
+    def __key_value(self, doc, fields):
+        return repr([self.__get(doc, field) for field in fields])
+
+
+    def __get(self, doc, field):
+        for part in field.split("."):
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(part)
+        return doc
+
+
+    def __update(self, doc, update):
+        for field, value in update.get("$set", {}).items():
+            doc[field] = copy.deepcopy(value)
+        for field, value in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + value
+        for field, value in update.get("$push", {}).items():
+            doc.setdefault(field, []).extend(copy.deepcopy(value["$each"]))
+            if "$slice" in value:
+                doc[field] = doc[field][:value["$slice"]]
+
+
+    def __matches(self, doc, filter):
+        for field, condition in filter.items():
+            if field == "$or":
+                if not any(self.__matches(doc, clause) for clause in condition):
+                    return False
+                continue
+            value = self.__get(doc, field)
+            if isinstance(condition, dict) and "$exists" in condition:
+                if (field in doc) != condition["$exists"]:
+                    return False
+            elif isinstance(condition, dict) and "$lt" in condition:
+                if value is None or not value < condition["$lt"]:
+                    return False
+            elif isinstance(condition, dict) and "$in" in condition:
+                if value not in condition["$in"]:
+                    return False
+            elif isinstance(condition, dict) and "$ne" in condition:
+                if value == condition["$ne"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+
+class SharedFakeCollection(FakeCollection):
+
+    """
+
+    A FakeCollection that separate local processes share through a FakeCollectionManager,
+    as worker nodes share a mongodb server. find gives a list, as the proxies can't send a
+    generator back.
+
+    """
+
+    def find(self, filter=None, projection=None):
+        return list(super().find(filter, projection))
+
+
+class FakeCollectionManager(BaseManager):
+
+    """ Serve SharedFakeCollections from a process of their own, to the processes given
+    proxies to them. """
+
+
+FakeCollectionManager.register("SharedFakeCollection", SharedFakeCollection)
+
+
+class AsyncFakeCollection:
+
+    """
+
+    Mimic an asyncio mongodb collection on top of FakeCollection.
+
+    Each insert call yields to the event loop for delay seconds, and the largest number of
+    insert calls in progress at once is recorded in max_in_flight.
+
+    """
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sync = FakeCollection()
+
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        return self.sync.create_index(keys, unique=unique, **kwargs)
+
+
+    async def insert_one(self, doc):
+        return await self.__call(self.sync.insert_one, doc)
+
+
+    async def insert_many(self, docs, ordered=True):
+        return await self.__call(self.sync.insert_many, docs, ordered=ordered)
+
+
+    async def __call(self, method, *args, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            return method(*args, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+
+def make_ingester(schema=None, upsert=False, skip_existing=False, stats=None):
+
+    """
+
+    Make an ingester that writes to an in-process fake collection, with a unique index on
+    archived_path, as open_connection makes with the test config files.
+
+    Parameters:
+        schema (str): Absolute path to a json schema file to set, e.g. good_schema. If
+            None, documents are not validated.
+        upsert (bool): If True, turn upsert mode on.
+        skip_existing (bool): If True, look up keys before validating, see set_skip_existing.
+        stats (IngestionStats): If given, record stats into it.
+
+    Returns: MetadataMongoIngester.
+
+    """
+
+    mmi = MetadataMongoIngester()
+    mmi.collection = FakeCollection()
+    mmi.collection.create_index([("archived_path", 1)], unique=True)
+    mmi.index_keys = "archived_path"
+    if schema:
+        mmi.set_schema(schema)
+    mmi.set_upsert(upsert)
+    mmi.set_skip_existing(skip_existing)
+    mmi.set_stats(stats)
+    return mmi
+
+
+def load_doc(archived_path, name="good_gt_metadata.json"):
+
+    """ Load a test document, the good one by default, and give it a new archived path. """
+
+    with open(os.path.join(test_docs_dir, name), 'r') as f:
+        doc = json.load(f)
+    doc["archived_path"] = archived_path
+    return doc
+
+
+def write_docs(directory, count):
+
+    """ Write count copies of the good test document, each with its own archived path, as
+    doc_<i>.json files in directory, and return their names. """
+
+    filenames = []
+    for i in range(count):
+        filename = Path(directory, f"doc_{i}.json")
+        filename.write_text(json.dumps(load_doc(f"/archive/path_{i}")))
+        filenames.append(str(filename))
+    return filenames
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingesting documents with the asyncio ingester
+'''
+
+import asyncio
+import os
+
+from metadata_mongo_ingester.AsyncMetadataMongoIngester import AsyncMetadataMongoIngester
+from tests.fake_mongo import (AsyncFakeCollection, configs_dir, good_schema, load_doc,
+    test_docs_dir)
+
+
+def make_ingester(max_in_flight=8):
+
+    """ Make an asyncio ingester with the good schema that writes to a fake collection. """
+
+    ammi = AsyncMetadataMongoIngester(max_in_flight=max_in_flight)
+    ammi.collection = AsyncFakeCollection()
+    ammi.collection.sync.create_index([("archived_path", 1)], unique=True)
+    ammi.set_schema(good_schema)
+    return ammi
+
+
+class TestAsyncIngestion:
+
+    """ Test that documents can be ingested from asyncio code. """
+
+    def test_good_doc_file_ingests(self):
+
+        """ Given a good document file, confirm ingestion and then a duplicate key. """
+
+        async def ingest_twice():
+            async with make_ingester() as ammi:
+                doc_filename = os.path.join(test_docs_dir, "good_gt_metadata.json")
+                return [await ammi.ingest_document(doc_filename) for i in range(2)]
+
+        assert asyncio.run(ingest_twice()) == [None, "Duplicate key, skipped"]
+
+
+    def test_bad_doc_fails_validation(self):
+
+        """ Given a document missing a PI, confirm it is rejected before insertion. """
+
+        async def ingest_bad():
+            async with make_ingester() as ammi:
+                doc_filename = os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json")
+                return await ammi.ingest_document(doc_filename), ammi.collection.sync.docs
+
+        val, docs = asyncio.run(ingest_bad())
+        assert val.startswith("Could not valiate doc")
+        assert docs == []
+
+
+    def test_batches_respect_in_flight_cap(self):
+
+        """ Given many batches and a cap of two, confirm no more than two inserts run at once. """
+
+        async def ingest_batches():
+            async with make_ingester(max_in_flight=2) as ammi:
+                docs = [load_doc(f"/archive/path_{i % 9}") for i in range(12)]
+                return await ammi.ingest_documents(docs, batch_size=2), ammi.collection.max_in_flight
+
+        val, max_in_flight = asyncio.run(ingest_batches())
+        assert val[:9] == [None] * 9
+        assert val[9:] == ["Duplicate key, skipped"] * 3
+        assert max_in_flight == 2
+
+
+    def test_context_manager_closes_client(self):
+
+        """ Given an ingester with a client, confirm leaving async with awaits the client's close. """
+
+        class Client:
+            closed = False
+            async def close(self):
+                Client.closed = True
+
+        async def use_and_leave():
+            async with make_ingester() as ammi:
+                ammi.db_connection = Client()
+            return ammi
+
+        ammi = asyncio.run(use_and_leave())
+        assert Client.closed
+        assert ammi.db_connection is None
+        assert ammi.collection is None
+
+
+    def test_bad_config_fails(self):
+
+        """ Given a config file missing the requested section, confirm failure. """
+
+        config_filename = os.path.join(configs_dir, "bad_config_no_mongodb_section.cfg")
+        val = asyncio.run(AsyncMetadataMongoIngester().open_connection(config_filename=config_filename))
+        assert val.startswith("Error: no mongodb_dev section in config file")
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for sharded, resumable backfills claimed by several workers
+'''
+
+import json
+import multiprocessing
+from pathlib import Path
+
+import pymongo
+import pytest
+
+from metadata_mongo_ingester import cli
+from metadata_mongo_ingester import BackfillCoordinator as coordinator_module
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.BackfillCoordinator import BackfillCoordinator
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+from tests.fake_mongo import FakeCollection, FakeCollectionManager, make_ingester
+from tests.test_connection_pool import FakeClient
+
+
+def write_docs(tmp_path, count):
+
+    """ Write count small metadata docs beneath tmp_path/docs, returning their file names. """
+
+    filenames = []
+    for index in range(count):
+        filename = Path(tmp_path, "docs", f"group{index % 3}", f"doc{index:03}.json")
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text(json.dumps({"archived_path": f"/archive/{index}"}))
+        filenames.append(str(filename))
+    return sorted(filenames)
+
+
+def run_worker_process(state, metadata, worker_id, summaries):
+
+    """ Run a backfill worker in its own process, with its own coordinator and ingester, as
+    on another node, both using collections shared by a FakeCollectionManager. """
+
+    mmi = make_ingester()
+    mmi.collection = metadata
+    with BackfillCoordinator(state) as coordinator:
+        summaries.put(coordinator.run_worker(mmi, worker_id, batch_size=2))
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch):
+
+    """ Write config and secrets files for the dev section, and use the fake client. """
+
+    monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+    monkeypatch.setattr(ingester_module, "_clients", {})
+    monkeypatch.setattr(ingester_module, "_created_indexes", set())
+    FakeClient.made = []
+
+    config_filename = Path(tmp_path, "ingester_config.cfg")
+    config_filename.write_text("[mongodb_dev]\naddress = localhost\nauthSource = ds_testing\n"
+        "collection = metadata\ndatabase = ds_dev\nindex_keys = archived_path\nport = 27017\n"
+        "username = ds_testing\n")
+    secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+    secrets_filename.write_text("[mongodb_dev]\npassword = a\n")
+    return ["--config", str(config_filename), "--secrets", str(secrets_filename)]
+
+
+class TestBackfill:
+
+    """ Test that backfills are split into shards that workers claim, checkpoint and resume. """
+
+    def test_plan_is_deterministic(self, tmp_path):
+
+        """ Plan a directory twice, confirm the same shards, and that a different plan fails. """
+
+        filenames = write_docs(tmp_path, 5)
+        with BackfillCoordinator(FakeCollection("backfill")) as coordinator:
+            assert coordinator.plan(str(Path(tmp_path, "docs")), shard_size=2) == None
+            assert coordinator.plan(filenames[::-1], shard_size=2) == None
+            assert coordinator.plan(filenames[:4], shard_size=2) == ("Error: backfill "
+                "backfill already holds the plan of a different set of files.")
+            assert coordinator.get_status() == {"pending": 3, "claimed": 0, "done": 0,
+                "files": 5, "ingested": 0, "skipped": 0, "failed": 0}
+            assert coordinator.claim("a")[:2] == (0, filenames[:2])
+
+
+    def test_manifest_file(self, tmp_path):
+
+        """ Plan from a manifest file, confirm the files it lists are sharded. """
+
+        filenames = write_docs(tmp_path, 3)
+        manifest = Path(tmp_path, "manifest.txt")
+        manifest.write_text("\n".join(filenames) + "\n\n")
+        with BackfillCoordinator(FakeCollection()) as coordinator:
+            assert coordinator.plan(str(manifest), shard_size=10) == None
+            assert coordinator.claim("a")[:2] == (0, filenames)
+
+
+    def test_worker_ingests_every_shard(self, tmp_path):
+
+        """ Run one worker, confirm every file is ingested and failures are listed. """
+
+        write_docs(tmp_path, 5)
+        Path(tmp_path, "docs", "bad.json").write_text("{not json")
+        mmi = make_ingester()
+        with BackfillCoordinator(FakeCollection()) as coordinator:
+            coordinator.plan(str(Path(tmp_path, "docs")), shard_size=2)
+            summary = coordinator.run_worker(mmi, "a", batch_size=1)
+            assert summary == {"shards": 3, "ingested": 5, "skipped": 0, "failed": 1}
+            assert coordinator.get_status()["done"] == 3
+            assert [path for path, result in coordinator.get_failures()] == \
+                [str(Path(tmp_path, "docs", "bad.json"))]
+        assert len(mmi.collection.docs) == 5
+
+
+    def test_failures_are_capped(self, tmp_path, monkeypatch):
+
+        """ Checkpoint more failures with long messages than a shard keeps, confirm only the
+        first are kept, cut short, and all are counted. """
+
+        monkeypatch.setattr(coordinator_module, "MAX_SHARD_FAILURES", 3)
+        filenames = write_docs(tmp_path, 5)
+        with BackfillCoordinator(FakeCollection()) as coordinator:
+            coordinator.plan(filenames, shard_size=5)
+            shard, files, worker_id = coordinator.claim("a")
+            for start in (0, 2):
+                results = {path: IngestResult(IngestStatus.FAILED, "validate",
+                    "Could not valiate doc, error was " + "x" * 10000)
+                    for path in files[start:start + 2]}
+                assert coordinator.checkpoint(shard, "a", start + 2, results) == None
+
+            failures = coordinator.get_failures()
+            assert [path for path, result in failures] == filenames[:3]
+            assert all(len(result) == ingester_module.MAX_ERROR_MESSAGE_LENGTH
+                for path, result in failures)
+            assert coordinator.get_status()["failed"] == 4
+
+
+    def test_expired_lease_resumed_from_checkpoint(self, tmp_path):
+
+        """ Let a worker's lease run out mid shard, confirm another resumes after its checkpoint. """
+
+        filenames = write_docs(tmp_path, 4)
+        mmi = make_ingester()
+        with BackfillCoordinator(FakeCollection(), lease_seconds=0) as coordinator:
+            coordinator.plan(filenames, shard_size=4)
+
+            # Worker a ingests and checkpoints the first file, then dies.
+            shard, files, worker_id = coordinator.claim("a")
+            results = mmi.ingest_documents(files[:1], structured=True)
+            assert coordinator.checkpoint(shard, "a", 1, dict(zip(files[:1], results))) == None
+
+            # Worker b takes the shard over and ingests only the rest.
+            coordinator.lease_seconds = 600
+            summary = coordinator.run_worker(mmi, "b")
+            assert summary == {"shards": 1, "ingested": 3, "skipped": 0, "failed": 0}
+            assert coordinator.checkpoint(shard, "a", 2, {}) == \
+                "Error: worker a no longer holds the lease on shard 0."
+        assert len(mmi.collection.docs) == 4
+
+
+    def test_released_shard_claimed_again(self, tmp_path):
+
+        """ Release a claimed shard, confirm it can be claimed straight away. """
+
+        filenames = write_docs(tmp_path, 2)
+        with BackfillCoordinator(FakeCollection()) as coordinator:
+            coordinator.plan(filenames)
+            assert coordinator.claim("a")[0] == 0
+            assert coordinator.claim("b") == None
+            assert coordinator.release(0, "a") == None
+            assert coordinator.claim("b")[0] == 0
+
+
+    def test_interrupted_plan_finished(self, tmp_path):
+
+        """ Fail planning after the plan document is stored, confirm planning again adds the shards. """
+
+        filenames = write_docs(tmp_path, 4)
+        state = FakeCollection()
+        state.faults = [("after", RuntimeError("node died"))]
+        with BackfillCoordinator(state) as coordinator:
+            with pytest.raises(RuntimeError):
+                coordinator.plan(filenames, shard_size=2)
+            assert coordinator.get_status()["pending"] == 0
+            assert coordinator.plan(filenames, shard_size=2) == None
+            assert coordinator.get_status()["pending"] == 2
+
+
+    def test_command_line_plans_and_works(self, tmp_path, config_files, capsys):
+
+        """ Plan, work and check a backfill from the console script, confirm its state is in the database. """
+
+        write_docs(tmp_path, 5)
+        docs = str(Path(tmp_path, "docs"))
+        assert cli.backfill(["backfill_1", *config_files, "plan", docs, "--shard-size", "2"]) == 0
+        assert cli.backfill(["backfill_1", *config_files, "work", "--no-build-indexes"]) == 0
+        assert cli.backfill(["backfill_1", *config_files, "status"]) == 0
+
+        out, err = capsys.readouterr()
+        assert "3 shards finished: 5 ingested, 0 skipped, 0 failed." in out
+        assert "5 files in 3 shards: 3 done, 0 claimed, 0 pending." in out
+        collections = FakeClient.made[0].collections
+        assert len(collections[("ds_dev", "metadata")].docs) == 5
+        assert len(collections[("ds_dev", "backfill_1")].docs) == 4
+
+
+    def test_worker_processes_share_the_shards(self, tmp_path):
+
+        """ Run three worker processes, confirm each shard is claimed and ingested exactly once
+        between them. """
+
+        write_docs(tmp_path, 30)
+        context = multiprocessing.get_context("spawn")
+        with FakeCollectionManager(ctx=context) as manager:
+            state = manager.SharedFakeCollection("backfill")
+            metadata = manager.SharedFakeCollection("metadata")
+            metadata.create_index([("archived_path", 1)], unique=True)
+            with BackfillCoordinator(state) as coordinator:
+                coordinator.plan(str(Path(tmp_path, "docs")), shard_size=3)
+
+            summaries = context.Queue()
+            workers = [context.Process(target=run_worker_process, args=(state, metadata,
+                f"worker{index}", summaries)) for index in range(3)]
+            for worker in workers:
+                worker.start()
+            results = [summaries.get(timeout=60) for worker in workers]
+            for worker in workers:
+                worker.join()
+
+            assert sum(summary["shards"] for summary in results) == 10
+            assert sum(summary["ingested"] for summary in results) == 30
+            assert metadata.count_documents({}) == 30
+            with BackfillCoordinator(state) as coordinator:
+                assert coordinator.get_status()["done"] == 10
+            assert sum(shard["claims"] for shard in state.find({"status": "done"})) == 10
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingesting documents in batches
+'''
+
+import os
+
+from tests.fake_mongo import good_schema, load_doc, make_ingester, test_docs_dir
+
+
+class TestBulkIngestion:
+
+    """ Test that documents can be ingested in batches with per-document results. """
+
+    def test_good_docs_ingest_in_batches(self):
+
+        """ Given several good documents, confirm they are all ingested with few round trips. """
+
+        mmi = make_ingester(good_schema)
+        docs = [load_doc(f"/archive/path_{i}") for i in range(5)]
+        val = mmi.ingest_documents(docs, batch_size=2)
+        assert val == [None] * 5
+        assert len(mmi.collection.docs) == 5
+        assert mmi.collection.insert_many_calls == 3
+
+
+    def test_mixed_docs_report_per_document_results(self):
+
+        """ Given good, duplicate, and bad documents, confirm each gets its own result in order. """
+
+        mmi = make_ingester(good_schema)
+        mmi.ingest_documents([load_doc("/archive/existing")])
+        docs = [
+            load_doc("/archive/new"),
+            load_doc("/archive/existing"),
+            os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json"),
+            os.path.join(test_docs_dir, "bad_gt_metadata_missing_archived_path.json"),
+            "/no/such/file.json",
+        ]
+        val = mmi.ingest_documents(docs)
+        assert val[0] == None
+        assert val[1] == "Duplicate key, skipped"
+        assert val[2].startswith("Could not valiate doc")
+        assert val[3].startswith("Error: no archived_path key")
+        assert val[4].startswith("Error: could not load")
+        assert len(mmi.collection.docs) == 2
+
+
+    def test_bad_batch_size_fails(self):
+
+        """ Given a batch size of zero, confirm failure. """
+
+        val = make_ingester(good_schema).ingest_documents([], batch_size=0)
+        assert val.startswith("Error: batch_size must be")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for capped, compact validation errors and the required keys pre-check
+'''
+
+import json
+import os
+from pathlib import Path
+
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+
+# NOTE: pytest skips classes with constructors, so the test class can't have an
+# __init__ method. But we can initialize things before the class, as shown here.
+
+# Get the directory this script has been called from. Use it to find the root directory
+# for the tests, and confirm the schemas dir and test docs dir is beneath it.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+assert Path.is_dir(schemas_dir)
+assert Path.is_dir(test_docs_dir)
+
+good_schema = os.path.join(schemas_dir, "good_gt-schema.json")
+bad_doc = os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json")
+
+
+def write_schema(tmp_path):
+
+    """ Write a small schema requiring two top level keys and a list of integers. """
+
+    schema = {"type": "object", "required": ["archived_path", "project"],
+        "properties": {"counts": {"type": "array", "items": {"type": "integer"}}}}
+    filename = str(Path(tmp_path, "schema.json"))
+    with open(filename, 'w') as f:
+        json.dump(schema, f)
+    return filename
+
+
+class TestCompactValidation:
+
+    """ Test that validation errors are capped and reported compactly. """
+
+    def test_validate_errors(self):
+
+        """ Given a doc missing PI, confirm one compact record with its JSON path. """
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(good_schema)
+        assert mmi.validate_errors(bad_doc) == [{"path": "$.project", "validator": "required",
+            "message": "'PI' is a required property"}]
+        assert mmi.validate_errors(os.path.join(test_docs_dir, "good_gt_metadata.json")) == []
+
+
+    def test_errors_are_capped(self, tmp_path):
+
+        """ Given a doc with many errors, confirm only max_errors are reported, with paths. """
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(write_schema(tmp_path))
+        doc = {"archived_path": "/a", "project": {}, "counts": ["x"] * 50}
+        errors = mmi.validate_errors(doc, max_errors=3)
+        assert [error["path"] for error in errors] == ["$.counts[0]", "$.counts[1]", "$.counts[2]"]
+        assert errors[0]["validator"] == "type"
+
+
+    def test_compact_mode(self, tmp_path):
+
+        """ Set compact mode, confirm validate's message is short and says errors were capped. """
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(write_schema(tmp_path))
+        assert mmi.set_validation_mode(max_errors=2) == None
+        val = mmi.validate({"archived_path": "/a", "project": {}, "counts": ["x"] * 50})
+        assert val == ("Error: document validation failed, at least 2 errors: "
+            "$.counts[0]: 'x' is not of type 'integer' (type); "
+            "$.counts[1]: 'x' is not of type 'integer' (type)")
+        assert mmi.validate({"archived_path": "/a", "project": {}}) == None
+
+
+    def test_precheck_required(self, tmp_path):
+
+        """ Turn on the pre-check, confirm a doc missing required keys is rejected before full validation. """
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(write_schema(tmp_path))
+        mmi.set_validation_mode(precheck_required=True)
+
+        # Full validation would fail on "counts"; the pre-check stops first.
+        val = mmi.validate({"counts": ["x"]})
+        assert val == ("Error: document validation failed, 2 errors: "
+            "$: 'archived_path' is a required property (required); "
+            "$: 'project' is a required property (required)")
+
+        # With the required keys present, full validation reports as usual.
+        val = mmi.validate({"archived_path": "/a", "project": {}, "counts": ["x"]})
+        assert val.startswith("Error: document validation failed, received exception")
+
+
+    def test_bad_max_errors(self):
+
+        """ Given a max_errors that isn't a positive integer, confirm an error. """
+
+        val = MetadataMongoIngester().set_validation_mode(max_errors=0)
+        assert val == "Error: max_errors must be a positive integer or None, not 0."
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for sharing MongoClients between ingesters
+'''
+
+from collections import OrderedDict
+import os
+from pathlib import Path
+
+import pymongo
+import pytest
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+
+
+class FakeClient:
+
+    """ Mimic pymongo.MongoClient, recording how it was made and handing out fake collections. """
+
+    made = []
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.closed = False
+        self.collections = {}
+        FakeClient.made.append(self)
+
+    def __getitem__(self, database):
+        return FakeDatabase(self, database)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDatabase:
+
+    """ Mimic a pymongo database, handing out one fake collection per name. """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, collection):
+        key = (self.name, collection)
+        if key not in self.client.collections:
+            self.client.collections[key] = FakeCollection(collection, self)
+        return self.client.collections[key]
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch):
+
+    """ Write a config file with pool settings and a secrets file, and use the fake client. """
+
+    monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+    monkeypatch.setattr(ingester_module, "_clients", {})
+    monkeypatch.setattr(ingester_module, "_created_indexes", set())
+    FakeClient.made = []
+
+    config_filename = Path(tmp_path, "ingester_config.cfg")
+    config_filename.write_text("""
+[mongodb_dev]
+address = localhost
+authSource = ds_testing
+collection = metadata
+database = ds_testing
+index_keys = archived_path
+port = 27017
+username = ds_testing
+maxPoolSize = 25
+serverSelectionTimeoutMS = 5000
+""")
+    secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+    secrets_filename.write_text("[mongodb_dev]\npassword = not_a_real_password\n")
+    return str(config_filename), str(secrets_filename)
+
+
+class TestConnectionPool:
+
+    """ Test that ingesters share clients and create indexes once per process. """
+
+    def test_ingesters_share_one_client(self, config_files):
+
+        """ Given two ingesters with the same config, confirm one client and one index build. """
+
+        config_filename, secrets_filename = config_files
+        first = MetadataMongoIngester()
+        second = MetadataMongoIngester()
+        assert first.open_connection("dev", config_filename, secrets_filename) == None
+        assert second.open_connection("dev", config_filename, secrets_filename) == None
+        assert len(FakeClient.made) == 1
+        assert first.get_connection() is second.get_connection()
+        assert first.get_collection().create_index_calls == 1
+
+
+    def test_pool_settings_are_passed_to_client(self, config_files):
+
+        """ Given pool settings in the config file, confirm they are passed to the client as ints. """
+
+        config_filename, secrets_filename = config_files
+        MetadataMongoIngester().open_connection("dev", config_filename, secrets_filename)
+        kwargs = FakeClient.made[0].kwargs
+        assert kwargs["maxPoolSize"] == 25
+        assert kwargs["serverSelectionTimeoutMS"] == 5000
+
+
+    def test_client_closes_with_last_ingester(self, config_files):
+
+        """ Given two ingesters sharing a client, confirm it is closed only when both are. """
+
+        config_filename, secrets_filename = config_files
+        with MetadataMongoIngester() as first:
+            first.open_connection("dev", config_filename, secrets_filename)
+            with MetadataMongoIngester() as second:
+                second.open_connection("dev", config_filename, secrets_filename)
+            assert second.get_collection() == None
+            assert FakeClient.made[0].closed == False
+        assert FakeClient.made[0].closed == True
+
+
+class TestParsedConfigCache:
+
+    """ Test the process-wide cache of parsed config files. """
+
+    def test_secrets_are_not_cached(self, config_files, monkeypatch):
+
+        """ Given a connection opened from files, confirm only the config file is kept. """
+
+        monkeypatch.setattr(ingester_module, "_parsed_config_files", OrderedDict())
+        config_filename, secrets_filename = config_files
+        assert MetadataMongoIngester().open_connection("dev", config_filename, secrets_filename) == None
+        assert [key[0] for key in ingester_module._parsed_config_files] == [config_filename]
+
+
+    def test_changed_file_replaces_cached_one(self, config_files, monkeypatch):
+
+        """ Given a config file changed after it was read, confirm the new version replaces it. """
+
+        monkeypatch.setattr(ingester_module, "_parsed_config_files", OrderedDict())
+        config_filename, secrets_filename = config_files
+        ingester = MetadataMongoIngester()
+        assert ingester._read_config_file("dev", config_filename)["maxPoolSize"] == "25"
+        text = Path(config_filename).read_text().replace("maxPoolSize = 25", "maxPoolSize = 30")
+        Path(config_filename).write_text(text)
+        mtime_ns = os.stat(config_filename).st_mtime_ns + 1
+        os.utime(config_filename, ns=(mtime_ns, mtime_ns))
+        assert ingester._read_config_file("dev", config_filename)["maxPoolSize"] == "30"
+        assert list(ingester_module._parsed_config_files) == [(config_filename, mtime_ns)]
+
+
+    def test_cache_is_bounded(self, config_files, tmp_path, monkeypatch):
+
+        """ Given more config files than the cache holds, confirm the least recently used go. """
+
+        monkeypatch.setattr(ingester_module, "_parsed_config_files", OrderedDict())
+        monkeypatch.setattr(ingester_module, "MAX_PARSED_CONFIG_FILES", 2)
+        config_filename, secrets_filename = config_files
+        ingester = MetadataMongoIngester()
+        filenames = []
+        for index in range(3):
+            filename = str(Path(tmp_path, f"config_{index}.cfg"))
+            Path(filename).write_text(Path(config_filename).read_text())
+            filenames.append(filename)
+        ingester._read_config_file("dev", filenames[0])
+        ingester._read_config_file("dev", filenames[1])
+        ingester._read_config_file("dev", filenames[0])
+        ingester._read_config_file("dev", filenames[2])
+        cached = [key[0] for key in ingester_module._parsed_config_files]
+        assert cached == [filenames[0], filenames[2]]
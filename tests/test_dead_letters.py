@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for recording rejected documents and replaying them
+'''
+
+import json
+import os
+from pathlib import Path
+
+import pymongo
+
+from metadata_mongo_ingester import cli
+from metadata_mongo_ingester.DeadLetters import DeadLetters
+from metadata_mongo_ingester.FieldTransform import FieldTransform
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection, good_schema, load_doc, make_ingester, test_docs_dir
+
+
+class TestDeadLetters:
+
+    """ Test that rejected documents are recorded with their reason, stage and source. """
+
+    def test_records_each_stage(self, tmp_path):
+
+        """ Ingest documents failing at each stage, confirm each is recorded and skips aren't. """
+
+        mmi = make_ingester(good_schema)
+        mmi.ingest_document(load_doc("/archive/dup"))
+        missing_path = os.path.join(test_docs_dir, "bad_gt_metadata_missing_archived_path.json")
+        docs = [load_doc("/archive/a"),
+            load_doc("/archive/b", "bad_gt_metadata_missing_PI.json"),
+            missing_path, "/no/such/file.json",
+            load_doc("/archive/dup")]
+
+        with DeadLetters(str(Path(tmp_path, "dead.ndjson"))) as dead_letters:
+            val = mmi.ingest_documents(docs, dead_letters=dead_letters)
+            assert val[0] == None
+            assert val[4] == "Duplicate key, skipped"
+            records = list(dead_letters)
+
+        assert [(r["stage"], r["position"]) for r in records] == [("validate", 1),
+            ("correct", 2), ("load", 3)]
+        assert records[0]["doc"]["archived_path"] == "/archive/b"
+        assert records[0]["reason"] == val[1]
+        assert records[1]["source"] == missing_path
+        assert records[1]["doc"] == None
+
+
+    def test_records_insert_failures(self, tmp_path):
+
+        """ Fail an insert with a server error, confirm the document is recorded without its _id. """
+
+        mmi = make_ingester(good_schema)
+        mmi.collection.faults = [("before", pymongo.errors.OperationFailure("not authorized", 13))]
+        with DeadLetters(str(Path(tmp_path, "dead.ndjson"))) as dead_letters:
+            val = mmi.ingest_documents([load_doc("/archive/a")],
+                dead_letters=dead_letters)
+            records = list(dead_letters)
+
+        assert val[0].startswith("Error: Cannot ingest document")
+        assert len(records) == 1
+        assert records[0]["stage"] == "insert"
+        assert "_id" not in records[0]["doc"]
+
+
+    def test_directory_and_stream(self, tmp_path):
+
+        """ Ingest a directory with workers and an NDJSON file, confirm sources and offsets. """
+
+        Path(tmp_path, "docs").mkdir()
+        with open(Path(tmp_path, "docs", "good.json"), 'w') as f:
+            json.dump(load_doc("/archive/a"), f)
+        with open(Path(tmp_path, "docs", "bad.json"), 'w') as f:
+            f.write("{ not json")
+        stream = Path(tmp_path, "docs.ndjson")
+        stream.write_text(json.dumps(load_doc("/archive/b")) + "\n" +
+            "{ not json\n" + json.dumps(load_doc("/archive/c", "bad_gt_metadata_missing_PI.json")) + "\n")
+
+        mmi = make_ingester(good_schema)
+        with DeadLetters(str(Path(tmp_path, "dead.ndjson"))) as dead_letters:
+            mmi.ingest_directory(str(Path(tmp_path, "docs")), workers=2, dead_letters=dead_letters)
+            mmi.ingest_stream(str(stream), dead_letters=dead_letters)
+            records = list(dead_letters)
+
+        assert [(r["stage"], r["source"]) for r in records] == [
+            ("load", str(Path(tmp_path, "docs", "bad.json"))), ("load", str(stream)),
+            ("validate", str(stream))]
+        assert records[0]["position"] == None
+        assert records[0]["offset"] == None
+        assert records[1]["offset"] > 0
+        assert records[2]["doc"]["archived_path"] == "/archive/c"
+
+
+    def test_collection_sink(self):
+
+        """ Record dead letters in a collection, confirm they can be read back. """
+
+        dead_letters = DeadLetters(collection=FakeCollection())
+        make_ingester(good_schema).ingest_documents(["/no/such/file.json"], dead_letters=dead_letters)
+        assert [r["stage"] for r in dead_letters] == ["load"]
+
+
+class TestReplay:
+
+    """ Test that dead letters are ingested again after a fix. """
+
+    def test_replay_after_schema_fix(self, tmp_path):
+
+        """ Reject a document, drop the schema, confirm replaying ingests only it. """
+
+        mmi = make_ingester(good_schema)
+        dead_filename = str(Path(tmp_path, "dead.ndjson"))
+        with DeadLetters(dead_filename) as dead_letters:
+            mmi.ingest_documents([load_doc("/archive/a"),
+                load_doc("/archive/b", "bad_gt_metadata_missing_PI.json"), "/no/such/file.json"],
+                dead_letters=dead_letters)
+
+        mmi.set_schema(None)
+        with DeadLetters(dead_filename) as dead_letters, \
+            DeadLetters(str(Path(tmp_path, "still_dead.ndjson"))) as new_dead_letters:
+            results = mmi.replay_dead_letters(dead_letters, new_dead_letters=new_dead_letters)
+            still_dead = list(new_dead_letters)
+
+        assert [result for record, result in results][0] == None
+        assert results[1][1].startswith("Error: could not load")
+        assert [r["source"] for r in still_dead] == ["/no/such/file.json"]
+        assert len(mmi.collection.docs) == 2
+
+
+    def test_replay_compressed_insert_failure(self, tmp_path):
+
+        """ Fail the insert of a doc with a compressed field, confirm the dead letter holds
+        the whole doc and replaying it stores it compressed. """
+
+        mmi = make_ingester(good_schema)
+        mmi.set_field_transform(FieldTransform(compress=["project.samples"], min_bytes=1))
+        mmi.collection.faults = [("before", pymongo.errors.OperationFailure("not authorized", 13))]
+        dead_filename = str(Path(tmp_path, "dead.ndjson"))
+        with DeadLetters(dead_filename) as dead_letters:
+            val = mmi.ingest_documents([load_doc("/archive/a")], dead_letters=dead_letters)
+            records = list(dead_letters)
+
+        assert val[0].startswith("Error: Cannot ingest document")
+        assert records[0]["doc"] == load_doc("/archive/a")
+
+        with DeadLetters(dead_filename) as dead_letters:
+            results = mmi.replay_dead_letters(dead_letters)
+
+        assert [result for record, result in results] == [None]
+        assert mmi.collection.docs[0]["project"]["samples"]["compressed"] == "zlib+json"
+
+
+    def test_replay_command(self, tmp_path, capsys, monkeypatch):
+
+        """ Write dead letters from the command line, then replay them without the schema. """
+
+        Path(tmp_path, "docs").mkdir()
+        with open(Path(tmp_path, "docs", "bad.json"), 'w') as f:
+            json.dump(load_doc("/archive/b", "bad_gt_metadata_missing_PI.json"), f)
+        collection = FakeCollection()
+
+        def open_fake_connection(self, mode="dev", config_filename=None, secrets_filename=None):
+            self.collection = collection
+            return None
+
+        monkeypatch.setattr(MetadataMongoIngester, "open_connection", open_fake_connection)
+        dead_filename = str(Path(tmp_path, "dead.ndjson"))
+        assert cli.main([str(Path(tmp_path, "docs")), "--workers", "1", "--schema", good_schema,
+            "--dead-letters", dead_filename]) == 1
+        assert cli.replay([dead_filename]) == 0
+        out, err = capsys.readouterr()
+        assert "1 ingested, 0 skipped, 0 failed." in out
+        assert len(collection.docs) == 1
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingesting a directory of documents
+'''
+
+import json
+from pathlib import Path
+
+from metadata_mongo_ingester import cli
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection, good_schema, load_doc, make_ingester
+
+
+def make_archive_tree(root, count):
+
+    """ Write count good documents and one bad document into nested directories under root. """
+
+    for i in range(count):
+        subdir = Path(root, f"run_{i % 3}")
+        subdir.mkdir(exist_ok=True)
+        with open(Path(subdir, f"doc_{i}.json"), 'w') as f:
+            json.dump(load_doc(f"/archive/path_{i}"), f)
+    with open(Path(root, "bad.json"), 'w') as f:
+        f.write("{ not json")
+
+
+class InProcessExecutor:
+
+    """ Stand-in for ProcessPoolExecutor that runs each task when its result is asked for,
+    and records the most tasks submitted but not yet collected. """
+
+    def __init__(self, max_workers, initializer, initargs):
+        initializer(*initargs)
+        self.in_flight = 0
+        InProcessExecutor.most_in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, function, *args):
+        executor = self
+        executor.in_flight += 1
+        InProcessExecutor.most_in_flight = max(InProcessExecutor.most_in_flight, executor.in_flight)
+
+        class Task:
+            def result(self):
+                executor.in_flight -= 1
+                return function(*args)
+        return Task()
+
+
+class TestDirectoryIngestion:
+
+    """ Test that a directory tree of documents can be ingested. """
+
+    def test_directory_ingests_with_process_pool(self, tmp_path):
+
+        """ Given a tree of documents, confirm all good ones are ingested by a pool of workers. """
+
+        make_archive_tree(tmp_path, 7)
+        mmi = make_ingester(good_schema)
+        val = mmi.ingest_directory(str(tmp_path), workers=2, batch_size=3)
+        assert len(val) == 8
+        assert val[str(Path(tmp_path, "bad.json"))].startswith("Error: could not load")
+        assert sum(result is None for result in val.values()) == 7
+        assert len(mmi.collection.docs) == 7
+
+
+    def test_pool_submissions_are_bounded(self, tmp_path, monkeypatch):
+
+        """ Given many more files than workers, confirm only a few chunks are in flight at once. """
+
+        make_archive_tree(tmp_path, 200)
+        monkeypatch.setattr(ingester_module, "ProcessPoolExecutor", InProcessExecutor)
+        mmi = make_ingester(good_schema)
+        val = mmi.ingest_directory(str(tmp_path), workers=2, batch_size=10)
+        assert sum(result is None for result in val.values()) == 200
+        assert InProcessExecutor.most_in_flight == 2 * ingester_module.IN_FLIGHT_CHUNKS
+
+
+    def test_directory_ingests_without_pool(self, tmp_path):
+
+        """ Given one worker, confirm files are ingested in this process with the same results. """
+
+        make_archive_tree(tmp_path, 4)
+        mmi = make_ingester(good_schema)
+        mmi.ingest_directory(str(tmp_path), workers=1)
+        val = mmi.ingest_directory(str(tmp_path), workers=1)
+        assert sum(result == "Duplicate key, skipped" for result in val.values()) == 4
+
+
+    def test_non_object_files_fail_alone(self, tmp_path):
+
+        """ Given files holding an array and a number, confirm each fails and the rest are ingested. """
+
+        make_archive_tree(tmp_path, 3)
+        Path(tmp_path, "array.json").write_text("[1, 2]")
+        Path(tmp_path, "number.json").write_text("7")
+        for workers in (1, 2):
+            mmi = make_ingester(good_schema)
+            val = mmi.ingest_directory(str(tmp_path), workers=workers)
+            assert val[str(Path(tmp_path, "array.json"))] == "Error: document is not a json object."
+            assert val[str(Path(tmp_path, "number.json"))] == "Error: document is not a json object."
+            assert len(mmi.collection.docs) == 3
+
+
+    def test_non_object_documents_fail_alone(self):
+
+        """ Given a list among the documents, confirm it fails and the others are ingested. """
+
+        mmi = make_ingester(good_schema)
+        val = mmi.ingest_documents([load_doc("/archive/a"), ["not", "a", "doc"]])
+        assert val == [None, "Error: document is not a json object."]
+        assert len(mmi.collection.docs) == 1
+
+
+    def test_missing_directory_fails(self):
+
+        """ Given a directory that does not exist, confirm failure. """
+
+        val = make_ingester(good_schema).ingest_directory("/no/such/directory")
+        assert val.startswith("Error: /no/such/directory is not a directory")
+
+
+    def test_command_line_reports_failures(self, tmp_path, monkeypatch, capsys):
+
+        """ Given a tree with a bad file, confirm the console script reports it and fails. """
+
+        make_archive_tree(tmp_path, 2)
+
+        def open_fake_connection(self, mode="dev", config_filename=None, secrets_filename=None):
+            self.collection = FakeCollection()
+            return None
+
+        monkeypatch.setattr(MetadataMongoIngester, "open_connection", open_fake_connection)
+        val = cli.main([str(tmp_path), "--workers", "1"])
+        out, err = capsys.readouterr()
+        assert val == 1
+        assert "2 ingested, 0 skipped, 1 failed." in out
+        assert "bad.json" in err
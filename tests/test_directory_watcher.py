@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for watching directories and ingesting new or changed metadata files
+'''
+
+import json
+import threading
+import time
+
+import pytest
+
+from metadata_mongo_ingester.DirectoryWatcher import DirectoryWatcher
+from metadata_mongo_ingester.IngestResult import IngestStatus
+from tests.fake_mongo import make_ingester
+
+
+def write_doc(filename, archived_path):
+
+    """ Write a small metadata doc to a json file, making its directory if needed. """
+
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    filename.write_text(json.dumps({"archived_path": archived_path}))
+    return str(filename)
+
+
+def make_watcher(tmp_path, **kwargs):
+
+    """ Make a watcher over tmp_path that ingests files as soon as they are seen. """
+
+    settings = {"poll_interval": 0.01, "settle_time": 0, "batch_window": 0, "use_inotify": False}
+    settings.update(kwargs)
+    return DirectoryWatcher(make_ingester(), [str(tmp_path)], **settings)
+
+
+class TestDirectoryWatcher:
+
+    """ Test that new and changed files are ingested, once they have stopped changing. """
+
+    def test_new_files_ingested(self, tmp_path):
+
+        """ Start watching, add a file, confirm existing and new files are ingested once each. """
+
+        a = write_doc(tmp_path / "a.json", "/a")
+        with make_watcher(tmp_path) as watcher:
+            assert watcher.step() == {a: None}
+            assert watcher.step() == {}
+
+            b = write_doc(tmp_path / "sub" / "b.json", "/b")
+            (tmp_path / "notes.txt").write_text("not metadata")
+            assert watcher.step() == {b: None}
+            assert watcher.step() == {}
+        assert len(watcher.ingester.collection.docs) == 2
+
+
+    def test_existing_files_left_alone(self, tmp_path):
+
+        """ Start watching without ingesting existing files, confirm only new ones are. """
+
+        write_doc(tmp_path / "a.json", "/a")
+        with make_watcher(tmp_path, ingest_existing=False) as watcher:
+            assert watcher.step() == {}
+            b = write_doc(tmp_path / "b.json", "/b")
+            assert watcher.step() == {b: None}
+
+
+    def test_structured_results(self, tmp_path):
+
+        """ Watch with structured results, confirm each file's status is given. """
+
+        a = write_doc(tmp_path / "a.json", "/a")
+        (tmp_path / "bad.json").write_text("{ not json")
+        with make_watcher(tmp_path, structured=True) as watcher:
+            results = watcher.step()
+        assert results[a].status is IngestStatus.INGESTED
+        assert results[str(tmp_path / "bad.json")].failed
+
+
+    def test_partial_file_waits_to_settle(self, tmp_path):
+
+        """ Write a file, confirm it is only ingested after it stops changing for settle_time. """
+
+        with make_watcher(tmp_path, settle_time=0.2) as watcher:
+            assert watcher.step() == {}
+            filename = tmp_path / "a.json"
+            filename.write_text('{"archived_path": ')
+            assert watcher.step() == {}
+
+            time.sleep(0.1)
+            filename.write_text('{"archived_path": "/a"}')
+            assert watcher.step() == {}
+
+            time.sleep(0.25)
+            assert watcher.step() == {str(filename): None}
+
+
+    def test_changed_file_upserted(self, tmp_path):
+
+        """ Change an ingested file, confirm it is ingested again, replacing it in upsert mode. """
+
+        filename = tmp_path / "a.json"
+        write_doc(filename, "/a")
+        with make_watcher(tmp_path) as watcher:
+            watcher.ingester.set_upsert()
+            watcher.step()
+            filename.write_text(json.dumps({"archived_path": "/a", "n": 2, "padding": "x"}))
+            assert watcher.step() == {str(filename): None}
+        assert watcher.ingester.collection.docs[0]["n"] == 2
+
+
+    def test_batch_window(self, tmp_path):
+
+        """ Add files within a batch window, confirm they are ingested together when it closes. """
+
+        with make_watcher(tmp_path, batch_window=0.2) as watcher:
+            watcher.step()
+            a = write_doc(tmp_path / "a.json", "/a")
+            assert watcher.step() == {}
+            b = write_doc(tmp_path / "b.json", "/b")
+            assert watcher.step() == {}
+            time.sleep(0.25)
+            assert watcher.step() == {a: None, b: None}
+        assert watcher.ingester.collection.insert_many_calls == 1
+
+
+    def test_inotify(self, tmp_path):
+
+        """ Watch with inotify, confirm a file in a new subdirectory is seen. """
+
+        with make_watcher(tmp_path, use_inotify=True, poll_interval=1.0) as watcher:
+            watcher.step()
+            if watcher.inotify is None:
+                pytest.skip("inotify is not available")
+            filename = write_doc(tmp_path / "new" / "deeper" / "a.json", "/a")
+            results = {}
+            for _ in range(5):
+                results.update(watcher.step())
+                if results:
+                    break
+            assert results == {filename: None}
+
+
+    def test_run_until_stopped(self, tmp_path):
+
+        """ Run in a thread, add a file, confirm it is reported, then stop. """
+
+        stop = threading.Event()
+        batches = []
+        watcher = make_watcher(tmp_path)
+        thread = threading.Thread(target=watcher.run, args=(stop, batches.append))
+        thread.start()
+        filename = write_doc(tmp_path / "a.json", "/a")
+        for _ in range(100):
+            if batches:
+                break
+            time.sleep(0.01)
+        stop.set()
+        thread.join()
+        watcher.close()
+        assert batches == [{filename: None}]
+
+
+    def test_missing_directory_fails(self, tmp_path):
+
+        """ Watch a directory that doesn't exist, confirm an error. """
+
+        watcher = make_watcher(tmp_path / "missing")
+        assert watcher.run() == f"Error: {tmp_path / 'missing'} is not a directory."
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for wire compression settings and dropping or compressing bulky fields
+'''
+
+import importlib.util
+import os
+from pathlib import Path
+
+import bson
+import pymongo
+import pytest
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.FieldTransform import FieldTransform
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+from tests.test_connection_pool import FakeClient
+
+
+# NOTE: pytest skips classes with constructors, so the test class can't have an
+# __init__ method. But we can initialize things before the class, as shown here.
+
+# Get the directory this script has been called from. Use it to find the root directory
+# for the tests, and confirm the schemas dir and test docs dir is beneath it.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+assert Path.is_dir(schemas_dir)
+assert Path.is_dir(test_docs_dir)
+
+
+def bulky_doc():
+
+    """ Make a doc with a large, repetitive samples array. """
+
+    samples = [{"id": f"S{index}", "Fastq_Filenames": [f"S{index}_R1.fastq.gz",
+        f"S{index}_R2.fastq.gz"]} for index in range(200)]
+    return {"archived_path": "/a", "project": {"PI": "x", "samples": samples}, "notes": "n"}
+
+
+def write_config(tmp_path, monkeypatch, settings):
+
+    """ Write config and secrets files with extra settings, and use the fake client. """
+
+    monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+    monkeypatch.setattr(ingester_module, "_clients", {})
+    monkeypatch.setattr(ingester_module, "_created_indexes", set())
+    FakeClient.made = []
+
+    config_filename = Path(tmp_path, "ingester_config.cfg")
+    config_filename.write_text("""
+[mongodb_dev]
+address = localhost
+authSource = ds_testing
+collection = metadata
+database = ds_testing
+index_keys = archived_path
+port = 27017
+username = ds_testing
+""" + settings)
+    secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+    secrets_filename.write_text("[mongodb_dev]\npassword = not_a_real_password\n")
+    return str(config_filename), str(secrets_filename)
+
+
+class TestFieldTransform:
+
+    """ Test that configured fields are dropped or compressed, and can be expanded again. """
+
+    def test_drop_and_compress(self):
+
+        """ Transform a bulky doc, confirm the fields are dropped and compressed, and restored,
+        and that the doc given is left as it was. """
+
+        transform = FieldTransform(drop=["notes"], compress=["project.samples"])
+        given = bulky_doc()
+        doc = transform.apply(given)
+        assert given == bulky_doc()
+        assert "notes" not in doc
+        assert doc["project"]["samples"]["compressed"] == "zlib+json"
+        assert type(doc["project"]["samples"]["data"]) is bson.Binary
+        assert len(bson.encode(doc)) < len(bson.encode(bulky_doc())) / 5
+
+        expected = bulky_doc()
+        del expected["notes"]
+        assert transform.expand(doc) == expected
+
+
+    def test_small_and_missing_fields_left_alone(self):
+
+        """ Given fields smaller than min_bytes, or not in the doc, confirm nothing changes. """
+
+        transform = FieldTransform(compress=["project.PI", "runs", "archived_path.x"])
+        assert transform.apply(bulky_doc()) == bulky_doc()
+
+
+    def test_bad_level_fails(self):
+
+        """ Given a compression level zlib doesn't have, confirm a ValueError. """
+
+        with pytest.raises(ValueError):
+            FieldTransform(level=10)
+
+
+    def test_transform_after_validation(self):
+
+        """ Require a field the transform drops, confirm the doc validates and is stored without it. """
+
+        mmi = MetadataMongoIngester()
+        mmi.collection = FakeCollection()
+        mmi.index_keys = "archived_path"
+        mmi.set_schema(os.path.join(schemas_dir, "good_gt-schema.json"))
+        mmi.set_field_transform(FieldTransform(drop=["project.Notes"],
+            compress=["project.software"], min_bytes=1))
+
+        assert mmi.ingest_document(os.path.join(test_docs_dir, "good_gt_metadata.json")) == None
+        stored = mmi.collection.docs[0]
+        assert "Notes" not in stored["project"]
+        assert stored["project"]["software"]["compressed"] == "zlib+json"
+
+
+    def test_prepared_doc_validated_again_whole(self):
+
+        """ Prepare a doc, set the schema again, confirm the doc is validated uncompressed. """
+
+        mmi = MetadataMongoIngester()
+        mmi.collection = FakeCollection()
+        mmi.index_keys = "archived_path"
+        mmi.set_schema(os.path.join(schemas_dir, "good_gt-schema.json"))
+        mmi.set_field_transform(FieldTransform(compress=["project.samples"], min_bytes=1))
+
+        prepared = mmi.prepare_document(os.path.join(test_docs_dir, "good_gt_metadata.json"))
+        assert type(prepared.doc["project"]["samples"]) is list
+        mmi.set_schema(os.path.join(schemas_dir, "good_gt-schema.json"))
+        assert mmi.ingest_document(prepared) == None
+        assert mmi.collection.docs[0]["project"]["samples"]["compressed"] == "zlib+json"
+        assert type(prepared.doc["project"]["samples"]) is list
+
+
+    def test_unchanged_compressed_doc_skipped_in_upsert_mode(self):
+
+        """ Upsert the same bulky doc twice, confirm the second is unchanged. """
+
+        mmi = MetadataMongoIngester()
+        mmi.collection = FakeCollection()
+        mmi.collection.create_index([("archived_path", 1)], unique=True)
+        mmi.index_keys = "archived_path"
+        mmi.set_upsert()
+        mmi.set_field_transform(FieldTransform(compress=["project.samples"]))
+        assert mmi.ingest_document(bulky_doc()) == None
+        assert mmi.ingest_document(bulky_doc()) == "Unchanged, skipped"
+
+
+class TestCompressionConfig:
+
+    """ Test that compression settings in the config file reach the client and the ingester. """
+
+    def test_compressors_passed_to_client(self, tmp_path, monkeypatch):
+
+        """ List compressors, confirm the installed ones are passed to the client, in order. """
+
+        files = write_config(tmp_path, monkeypatch, "compressors = zstd, snappy, zlib\n"
+            "zlibCompressionLevel = 4\n")
+        assert MetadataMongoIngester().open_connection("dev", *files) == None
+        kwargs = FakeClient.made[0].kwargs
+        installed = [name for name, module in [("zstd", "zstandard"), ("snappy", "snappy"),
+            ("zlib", "zlib")] if importlib.util.find_spec(module)]
+        assert kwargs["compressors"] == ",".join(installed)
+        assert kwargs["zlibCompressionLevel"] == 4
+
+
+    def test_unknown_compressor_fails(self, tmp_path, monkeypatch):
+
+        """ List a compressor mongodb doesn't have, confirm an error. """
+
+        files = write_config(tmp_path, monkeypatch, "compressors = gzip\n")
+        assert MetadataMongoIngester().open_connection("dev", *files) == \
+            "Error: unknown compressor gzip in config file, must be one of zstd, snappy, zlib."
+
+
+    def test_field_settings(self, tmp_path, monkeypatch):
+
+        """ Name fields to drop and compress in the config file, confirm the transform is set. """
+
+        files = write_config(tmp_path, monkeypatch, "drop_fields = notes\n"
+            "compress_fields = project.samples, runs\ncompress_min_bytes = 10\n")
+        mmi = MetadataMongoIngester()
+        assert mmi.open_connection("dev", *files) == None
+        assert mmi.field_transform.drop == [("notes",)]
+        assert mmi.field_transform.compress == [("project", "samples"), ("runs",)]
+        assert mmi.field_transform.min_bytes == 10
+
+        files = write_config(tmp_path, monkeypatch, "compress_fields = runs\ncompress_level = 0\n")
+        assert MetadataMongoIngester().open_connection("dev", *files).startswith(
+            "Error: invalid field compression settings in config file")
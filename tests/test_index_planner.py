@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for planning secondary indexes from the config file and schema, and building them
+'''
+
+import json
+import pickle
+import threading
+from pathlib import Path
+
+import pymongo
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.IndexPlanner import IndexPlanner
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+from tests.test_connection_pool import FakeClient
+
+
+CONFIG_INDEXES = """
+    project.PI
+    project.Group, -project.PI
+    project.GT_Project_Name_ID {"partialFilterExpression": {"project.GT_Project_Name_ID": {"$exists": true}}}
+"""
+
+ANNOTATED_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "x-indexes": ["project.Group, -date", {"keys": ["project.PI", "-date"], "name": "by_pi"}],
+    "type": "object",
+    "properties": {
+        "archived_path": {"type": "string"},
+        "project": {
+            "type": "object",
+            "properties": {
+                "PI": {"type": "string"},
+                "samples": {"type": "array", "items": {"type": "object",
+                    "properties": {"id": {"type": "string", "x-index": True}}}},
+                "Lab": {"type": "string", "x-index": {"sparse": True}},
+            },
+        },
+    },
+}
+
+
+class SlowCollection(FakeCollection):
+
+    """ Fake collection whose index builds wait until released. """
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def create_index(self, keys, unique=False, **kwargs):
+        self.release.wait(5)
+        return super().create_index(keys, unique, **kwargs)
+
+
+def write_config(tmp_path, monkeypatch, indexes):
+
+    """ Write config and secrets files with an indexes field, and use the fake client. """
+
+    monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+    monkeypatch.setattr(ingester_module, "_clients", {})
+    monkeypatch.setattr(ingester_module, "_created_indexes", set())
+    FakeClient.made = []
+
+    config_filename = Path(tmp_path, "ingester_config.cfg")
+    config_filename.write_text("""
+[mongodb_dev]
+address = localhost
+authSource = ds_testing
+collection = metadata
+database = ds_testing
+index_keys = archived_path
+port = 27017
+username = ds_testing
+indexes =""" + indexes)
+    secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+    secrets_filename.write_text("[mongodb_dev]\npassword = not_a_real_password\n")
+    return str(config_filename), str(secrets_filename)
+
+
+class TestIndexPlanner:
+
+    """ Test that indexes are planned from config lines and schema annotations, and built. """
+
+    def test_config_lines(self):
+
+        """ Plan the indexes of a config field, confirm their keys and options. """
+
+        planner = IndexPlanner()
+        assert planner.add_from_config(CONFIG_INDEXES) == None
+        assert planner.indexes == [
+            ([("project.PI", 1)], {}),
+            ([("project.Group", 1), ("project.PI", -1)], {}),
+            ([("project.GT_Project_Name_ID", 1)], {"partialFilterExpression":
+                {"project.GT_Project_Name_ID": {"$exists": True}}}),
+        ]
+
+        # Planning an index again does nothing, unless its options differ.
+        assert planner.add("project.PI") == None
+        assert len(planner.indexes) == 3
+        assert planner.add("project.PI", unique=True) == \
+            "Error: index on project.PI is planned twice with different options."
+
+
+    def test_bad_config_lines_fail(self):
+
+        """ Give lines with bad options or fields, confirm errors. """
+
+        assert IndexPlanner().add_from_config("project.PI {unique: true}").startswith(
+            "Error: invalid options in index project.PI {unique: true}")
+        assert IndexPlanner().add_from_config("project.PI, , date") == \
+            "Error: invalid field '' in index project.PI, , date."
+        assert IndexPlanner().add_from_config("$where") == \
+            "Error: invalid field '$where' in index $where."
+
+
+    def test_schema_annotations(self):
+
+        """ Plan an annotated schema's indexes, confirm compound, nested and array ones. """
+
+        planner = IndexPlanner()
+        assert planner.add_from_schema(ANNOTATED_SCHEMA) == None
+        assert planner.indexes == [
+            ([("project.Group", 1), ("date", -1)], {}),
+            ([("project.PI", 1), ("date", -1)], {"name": "by_pi"}),
+            ([("project.samples.id", 1)], {}),
+            ([("project.Lab", 1)], {"sparse": True}),
+        ]
+        assert IndexPlanner().add_from_schema({"properties": {"a": {"x-index": "yes"}}}) == \
+            "Error: x-index on a must be true or an object of options."
+
+
+    def test_background_build_reports_timings(self):
+
+        """ Build in the background, confirm build returns at once and wait reports each index. """
+
+        collection = SlowCollection()
+        built = []
+        planner = IndexPlanner()
+        planner.add_from_config(CONFIG_INDEXES)
+        assert planner.build(collection, on_built=built.append) == None
+        assert planner.is_building()
+        assert planner.wait(0.01) == None
+        assert planner.build(collection) == "Error: indexes are already being built."
+
+        collection.release.set()
+        reports = planner.wait()
+        assert [report["name"] for report in reports] == ["project.PI_1",
+            "project.Group_1_project.PI_-1", "project.GT_Project_Name_ID_1"]
+        assert all(report["error"] is None and report["seconds"] >= 0 for report in reports)
+        assert built == reports
+        assert collection.indexes["project.GT_Project_Name_ID_1"]["partialFilterExpression"] == \
+            {"project.GT_Project_Name_ID": {"$exists": True}}
+
+
+    def test_failed_build_reported(self):
+
+        """ Fail an index build, confirm the error is reported and the others are built. """
+
+        collection = FakeCollection()
+        collection.create_index = lambda keys, **options: \
+            1 / 0 if keys[0][0] == "bad" else "ok"
+        planner = IndexPlanner()
+        planner.add("bad")
+        planner.add("good")
+        assert planner.build(collection, background=False) == None
+        reports = planner.wait()
+        assert reports[0]["error"] == \
+            "Error: could not create index on bad, received exception division by zero."
+        assert reports[1]["name"] == "ok" and reports[1]["error"] == None
+
+
+class TestIngesterIndexes:
+
+    """ Test that the ingester builds the indexes of its config file and schema. """
+
+    def test_build_config_and_schema_indexes(self, tmp_path, monkeypatch):
+
+        """ Connect with planned indexes and an annotated schema, confirm all are built. """
+
+        schema_filename = Path(tmp_path, "schema.json")
+        schema_filename.write_text(json.dumps(ANNOTATED_SCHEMA))
+        mmi = MetadataMongoIngester()
+        assert mmi.open_connection("dev", *write_config(tmp_path, monkeypatch,
+            CONFIG_INDEXES)) == None
+        assert mmi.set_schema(str(schema_filename)) == None
+
+        # Only the unique index is built when connecting.
+        assert list(mmi.collection.indexes) == ["archived_path_1"]
+
+        planner = mmi.build_indexes()
+        assert mmi.ingest_document({"archived_path": "/a", "project": {"PI": "x"}}) == None
+        assert [report["error"] for report in planner.wait()] == [None] * 7
+        assert sorted(mmi.collection.indexes) == ["archived_path_1", "by_pi",
+            "project.GT_Project_Name_ID_1", "project.Group_1_date_-1",
+            "project.Group_1_project.PI_-1", "project.Lab_1", "project.PI_1",
+            "project.samples.id_1"]
+
+        # The plan can be copied into worker processes.
+        assert pickle.loads(pickle.dumps(mmi)).index_planner.indexes == mmi.index_planner.indexes
+
+
+    def test_bad_config_fails(self, tmp_path, monkeypatch):
+
+        """ List an index with bad options, confirm open_connection fails. """
+
+        files = write_config(tmp_path, monkeypatch, ' project.PI {"unique": }')
+        assert MetadataMongoIngester().open_connection("dev", *files).startswith(
+            'Error: invalid options in index project.PI {"unique": }')
+        assert MetadataMongoIngester().build_indexes() == \
+            "Error: no open connection, cannot build indexes."
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for structured ingest results, and the string results made from them
+'''
+
+import os
+import pickle
+import threading
+from collections import Counter
+from pathlib import Path
+
+from metadata_mongo_ingester.DeadLetters import DeadLetters
+from metadata_mongo_ingester.IngestionLedger import IngestionLedger
+from metadata_mongo_ingester.IngestResult import IngestResult, IngestStatus
+from tests.fake_mongo import good_schema, make_ingester, test_docs_dir
+
+
+good_doc = os.path.join(test_docs_dir, "good_gt_metadata.json")
+missing_pi_doc = os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json")
+
+
+class CountedPart:
+
+    """ Message part that counts how often it is turned into a string. """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return "a long exception"
+
+
+class TestIngestResult:
+
+    """ Test the result type itself. """
+
+    def test_message_made_once_when_read(self):
+
+        """ Give a result message parts, confirm they are joined only when read, and once. """
+
+        part = CountedPart()
+        result = IngestResult(IngestStatus.FAILED, "insert", ("Error: got ", part, "."))
+        assert part.calls == 0
+        assert result.message == "Error: got a long exception."
+        assert result.as_string() == "Error: got a long exception."
+        assert part.calls == 1
+
+
+    def test_strings_round_trip(self):
+
+        """ Make results from each kind of string result, confirm they give the same string. """
+
+        for string in [None, "Duplicate key, skipped", "Unchanged, skipped",
+            "Already ingested, skipped", "Not routed, skipped", "Error: could not load x"]:
+            assert IngestResult.from_string(string).as_string() == string
+        assert IngestResult.from_string("Unchanged, skipped").status is IngestStatus.UNCHANGED
+        assert IngestResult.from_string("Unchanged, skipped").skipped
+        assert IngestResult.from_string("Error: x").failed
+
+
+    def test_pickle_keeps_message(self):
+
+        """ Pickle a result whose message parts can't be pickled, confirm its message survives. """
+
+        result = IngestResult(IngestStatus.FAILED, "validate", ("lock ", threading.Lock()))
+        copy = pickle.loads(pickle.dumps(result))
+        assert copy == result
+        assert copy.message.startswith("lock <unlocked _thread.lock")
+
+
+class TestStructuredIngestion:
+
+    """ Test that the ingest methods give structured results when asked, matching the strings. """
+
+    def test_ingest_documents(self):
+
+        """ Ingest good, duplicate and invalid documents, confirm statuses, stages and ids. """
+
+        docs = [good_doc, good_doc, missing_pi_doc, "/no/such/file.json"]
+        mmi = make_ingester(good_schema)
+        results = mmi.ingest_documents(docs, structured=True)
+        assert [(result.status, result.stage) for result in results] == [
+            (IngestStatus.INGESTED, "insert"), (IngestStatus.DUPLICATE, "insert"),
+            (IngestStatus.FAILED, "validate"), (IngestStatus.FAILED, "load")]
+        assert results[0].inserted_id == mmi.collection.docs[0]["_id"]
+        assert Counter(result.status for result in results)[IngestStatus.FAILED] == 2
+
+        # The validation error, which quotes the schema, is only made when read.
+        assert type(results[2]._message) is tuple
+        strings = make_ingester(good_schema).ingest_documents(docs)
+        assert [result.as_string() for result in results] == strings
+        assert strings[2].startswith("Could not valiate doc, error was Error: document "
+            "validation failed, received exception 'PI' is a required property")
+
+
+    def test_ingest_document_upsert(self):
+
+        """ Upsert a document twice, confirm it is ingested then unchanged. """
+
+        mmi = make_ingester(good_schema)
+        mmi.set_upsert()
+        assert mmi.ingest_document(good_doc, structured=True).status is IngestStatus.INGESTED
+        result = mmi.ingest_document(good_doc, structured=True)
+        assert (result.status, result.stage, result.inserted_id) == \
+            (IngestStatus.UNCHANGED, "insert", None)
+
+
+    def test_ingest_directory_with_ledger(self, tmp_path):
+
+        """ Ingest a directory twice with a ledger, in worker processes, confirm the results. """
+
+        docs_dir = Path(tmp_path, "docs")
+        docs_dir.mkdir()
+        Path(docs_dir, "good.json").write_text(Path(good_doc).read_text())
+        Path(docs_dir, "bad.json").write_text(Path(missing_pi_doc).read_text())
+
+        with IngestionLedger(str(Path(tmp_path, "ledger.db"))) as ledger:
+            mmi = make_ingester(good_schema)
+            results = mmi.ingest_directory(str(docs_dir), workers=2, ledger=ledger,
+                structured=True)
+            assert [(result.status, result.stage) for result in results.values()] == [
+                (IngestStatus.FAILED, "validate"), (IngestStatus.INGESTED, "insert")]
+
+            results = mmi.ingest_directory(str(docs_dir), workers=2, ledger=ledger,
+                structured=True)
+            assert results[str(Path(docs_dir, "good.json"))] == \
+                IngestResult(IngestStatus.ALREADY_INGESTED, "ledger")
+            assert results[str(Path(docs_dir, "bad.json"))].failed
+
+
+    def test_replay_keeps_stages(self, tmp_path):
+
+        """ Replay dead letters, confirm each result has the stage it failed at again. """
+
+        dead_letters = DeadLetters(str(Path(tmp_path, "dead.ndjson")))
+        mmi = make_ingester(good_schema)
+        mmi.ingest_documents([missing_pi_doc], dead_letters=dead_letters)
+        dead_letters.record("Error: lost", "insert", None, "/gone.json", offset=10)
+        dead_letters.close()
+
+        with DeadLetters(str(Path(tmp_path, "dead.ndjson"))) as dead_letters:
+            results = mmi.replay_dead_letters(dead_letters, structured=True)
+        assert [(result.status, result.stage) for record, result in results] == [
+            (IngestStatus.FAILED, "validate"), (IngestStatus.FAILED, "insert")]
+        assert results[1][1].message == "Error: nothing to replay, the document was not recorded."
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for loading json files with a pluggable parser
+'''
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from metadata_mongo_ingester.JsonLoader import JsonLoader
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+
+
+# NOTE: pytest skips classes with constructors, so the test class can't have an
+# __init__ method. But we can initialize things before the class, as shown here.
+
+# Get the directory this script has been called from. Use it to find the root directory
+# for the tests, and confirm the schemas dir and test docs dir is beneath it.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+assert Path.is_dir(schemas_dir)
+assert Path.is_dir(test_docs_dir)
+
+good_doc_filename = os.path.join(test_docs_dir, "good_gt_metadata.json")
+
+
+class TestJsonLoader:
+
+    """ Test that json files load the same with any parser, and that the ingester uses the loader. """
+
+    def test_stdlib_backend_loads_file(self):
+
+        """ Given the json backend, confirm a file loads as with json.load and its size is given. """
+
+        doc, size = JsonLoader("json").load_file(good_doc_filename)
+        with open(good_doc_filename) as f:
+            assert doc == json.load(f)
+        assert size == os.path.getsize(good_doc_filename)
+
+
+    def test_digest_of_bytes_read(self):
+
+        """ Ask for a digest, confirm it gives the file's time, size and content hash. """
+
+        doc, size, file_hash = JsonLoader("json").load_file(good_doc_filename, digest=True)
+        stat = os.stat(good_doc_filename)
+        with open(good_doc_filename, 'rb') as f:
+            assert file_hash == (stat.st_mtime_ns, size, hashlib.sha256(f.read()).hexdigest())
+
+
+    def test_custom_backend_falls_back_to_stdlib(self):
+
+        """ Given a parser that rejects the file, confirm the json module loads it instead. """
+
+        calls = []
+        def failing_parser(data):
+            calls.append(data)
+            raise ValueError("unsupported")
+
+        doc, size = JsonLoader(failing_parser).load_file(good_doc_filename)
+        assert len(calls) == 1
+        assert doc["archived_path"].startswith("/archive/GT")
+
+
+    def test_missing_backend_fails(self):
+
+        """ Given a parser name that is not known, confirm failure. """
+
+        with pytest.raises(ValueError):
+            JsonLoader("yaml")
+
+
+    def test_orjson_memory_maps_large_files(self):
+
+        """ Given orjson and a file over the mmap threshold, confirm it loads the same. """
+
+        pytest.importorskip("orjson")
+        doc, size = JsonLoader("orjson", mmap_threshold=0).load_file(good_doc_filename)
+        with open(good_doc_filename) as f:
+            assert doc == json.load(f)
+
+
+    def test_validate_and_ingest_share_the_loader(self):
+
+        """ Given a custom loader, confirm validate uses it for files. """
+
+        loaded = []
+        def recording_parser(data):
+            loaded.append(len(data))
+            return json.loads(data)
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(os.path.join(schemas_dir, "good_gt-schema.json"))
+        mmi.set_json_loader(JsonLoader(recording_parser))
+        assert mmi.validate(good_doc_filename) == None
+        assert mmi.validate("/no/such/file.json").startswith("Error: could not load")
+        assert loaded == [os.path.getsize(good_doc_filename)]
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for finding the archived path under outdated or wrong keys
+'''
+
+from pathlib import Path
+
+import pymongo
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from metadata_mongo_ingester.KeyAliases import KeyAliases
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+from tests.test_connection_pool import FakeClient
+
+
+class TestKeyAliases:
+
+    """ Test that the archived path is moved from an alias to archived_path. """
+
+    def test_good_key_left_alone(self):
+
+        """ Given a doc with archived_path, confirm it is unchanged and no alias is reported. """
+
+        doc = {"archived_path": "/a", "archivedPath": "/b"}
+        assert KeyAliases().resolve(doc) == ({"archived_path": "/a", "archivedPath": "/b"}, None)
+
+
+    def test_known_alias(self):
+
+        """ Given a doc with an older key, confirm the value is moved and the alias reported. """
+
+        doc, alias = KeyAliases().resolve({"archiveFolderPath": "/a", "project": {}})
+        assert doc == {"archived_path": "/a", "project": {}}
+        assert alias == "archiveFolderPath"
+
+
+    def test_pattern_alias(self):
+
+        """ Given a key only the pattern matches, confirm it is moved, and the decision cached. """
+
+        aliases = KeyAliases()
+        doc, alias = aliases.resolve({"Archive-Data-Path": "/a", "project": {}})
+        assert doc == {"archived_path": "/a", "project": {}}
+        assert alias == "Archive-Data-Path"
+        assert aliases.decisions == {"Archive-Data-Path": True}
+
+
+    def test_nested_alias(self):
+
+        """ Given a dotted alias, confirm the value is moved out of the nested document. """
+
+        aliases = KeyAliases(aliases=["project.archivedPath"])
+        doc, alias = aliases.resolve({"project": {"archivedPath": "/a", "PI": "x"}})
+        assert doc == {"project": {"PI": "x"}, "archived_path": "/a"}
+        assert alias == "project.archivedPath"
+
+
+    def test_no_alias(self):
+
+        """ Given a doc with no archived path, confirm an error. """
+
+        error = KeyAliases(pattern=None).resolve({"Archive-Data-Path": "/a"})
+        assert error == "Error: no archived_path key in document."
+
+
+    def test_not_a_document(self):
+
+        """ Given a list or a string instead of a document, confirm an error rather than an exception. """
+
+        key_aliases = KeyAliases()
+        assert key_aliases.resolve(["archivedPath"]) == "Error: document is not a json object."
+        assert key_aliases.resolve("archivedPath") == "Error: document is not a json object."
+
+
+    def test_ingester_reports_alias(self):
+
+        """ Ingest docs with older keys, confirm they're stored with archived_path and counted. """
+
+        mmi = MetadataMongoIngester()
+        mmi.collection = FakeCollection()
+        stats = IngestionStats()
+        mmi.set_stats(stats)
+        results = mmi.ingest_documents([{"archivedPath": "/a", "x": 1},
+            {"archivedFolderPath": "/b", "x": 2}, {"archivedPath": "/c", "x": 3}])
+        assert results == [None, None, None]
+        assert [doc["archived_path"] for doc in mmi.collection.docs] == ["/a", "/b", "/c"]
+        assert stats.aliases == {"archivedPath": 2, "archivedFolderPath": 1}
+        assert stats.counts["key_corrections"] == 3
+
+
+    def test_aliases_from_config(self, tmp_path, monkeypatch):
+
+        """ Open a connection with aliases in the config file, confirm only they are used. """
+
+        monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+        monkeypatch.setattr(ingester_module, "_clients", {})
+        monkeypatch.setattr(ingester_module, "_created_indexes", set())
+
+        config_filename = Path(tmp_path, "ingester_config.cfg")
+        config_filename.write_text("""
+[mongodb_dev]
+address = localhost
+authSource = ds_testing
+collection = metadata
+database = ds_testing
+index_keys = archived_path
+port = 27017
+username = ds_testing
+archived_path_aliases = folder, run.folder
+archived_path_pattern = none
+""")
+        secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+        secrets_filename.write_text("[mongodb_dev]\npassword = not_a_real_password\n")
+
+        mmi = MetadataMongoIngester()
+        assert mmi.open_connection("dev", str(config_filename), str(secrets_filename)) == None
+        assert mmi.ingest_document({"run": {"folder": "/a"}}) == None
+        assert mmi.ingest_document({"archivedPath": "/b"}) == "Error: no archived_path key in document."
+        mmi.close()
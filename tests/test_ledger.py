@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for skipping already ingested files with a ledger
+'''
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from metadata_mongo_ingester.IngestionLedger import IngestionLedger
+from tests.fake_mongo import make_ingester, write_docs
+
+
+class TestLedger:
+
+    """ Test that a ledger skips unchanged files and retries changed or failed ones. """
+
+    def test_rerun_skips_unchanged_files(self, tmp_path):
+
+        """ Given a second run over the same directory, confirm no file is read or written. """
+
+        write_docs(tmp_path, 3)
+        mmi = make_ingester()
+        with IngestionLedger(str(Path(tmp_path, "ledger.db"))) as ledger:
+            first = mmi.ingest_directory(str(tmp_path), workers=1, ledger=ledger)
+            second = mmi.ingest_directory(str(tmp_path), workers=1, ledger=ledger)
+        assert list(first.values()) == [None] * 3
+        assert list(second.values()) == ["Already ingested, skipped"] * 3
+        assert mmi.collection.insert_many_calls == 1
+
+
+    def test_changed_and_touched_files(self, tmp_path):
+
+        """ Given one edited and one touched file, confirm only the edited one is written again. """
+
+        filenames = write_docs(tmp_path, 2)
+        mmi = make_ingester()
+        ledger = IngestionLedger(str(Path(tmp_path, "ledger.db")))
+        mmi.ingest_documents(filenames, ledger=ledger)
+
+        os.utime(filenames[0], ns=(1, 1))
+        with open(filenames[1], 'r') as f:
+            doc = json.load(f)
+        doc["archived_path"] = "/archive/edited_path"
+        Path(filenames[1]).write_text(json.dumps(doc, indent=1))
+
+        val = mmi.ingest_documents(filenames, ledger=ledger)
+        assert val == ["Already ingested, skipped", None]
+
+
+    def test_files_read_once_per_ingest(self, tmp_path, monkeypatch):
+
+        """ Given new files, confirm recording them doesn't read them again. """
+
+        filenames = write_docs(tmp_path, 3)
+        opened = []
+        real_open = open
+        monkeypatch.setattr("builtins.open", lambda file, *args, **kwargs:
+            opened.append(str(file)) or real_open(file, *args, **kwargs))
+        with IngestionLedger(str(Path(tmp_path, "ledger.db"))) as ledger:
+            make_ingester().ingest_documents(filenames, ledger=ledger)
+        assert sorted(opened) == sorted(filenames)
+
+
+    def test_content_hash_recorded(self, tmp_path):
+
+        """ Ingest files with and without workers, confirm each is recorded with its hash. """
+
+        filenames = write_docs(tmp_path, 4)
+        with IngestionLedger(str(Path(tmp_path, "ledger.db"))) as ledger:
+            make_ingester().ingest_directory(str(tmp_path), workers=1, ledger=ledger)
+            Path(tmp_path, "more").mkdir()
+            more = write_docs(Path(tmp_path, "more"), 2)
+            make_ingester().ingest_directory(str(Path(tmp_path, "more")), workers=2,
+                ledger=ledger)
+            hashes = dict(ledger.db.execute("SELECT path, content_hash FROM files"))
+
+        for filename in filenames + more:
+            assert hashes[filename] == hashlib.sha256(Path(filename).read_bytes()).hexdigest()
+
+
+    def test_failed_file_is_retried_after_resume(self, tmp_path):
+
+        """ Given a file that failed, confirm a new ledger on the same file retries only it. """
+
+        filenames = write_docs(tmp_path, 2)
+        bad_filename = Path(tmp_path, "bad.json")
+        bad_filename.write_text("{ not json")
+        ledger_filename = str(Path(tmp_path, "ledger.db"))
+        mmi = make_ingester()
+        with IngestionLedger(ledger_filename) as ledger:
+            mmi.ingest_documents(filenames + [str(bad_filename)], ledger=ledger)
+
+        with IngestionLedger(ledger_filename) as ledger:
+            assert ledger.get_outcome(str(bad_filename)).startswith("Error: could not load")
+            val = mmi.ingest_documents(filenames + [str(bad_filename)], ledger=ledger)
+        assert val[:2] == ["Already ingested, skipped"] * 2
+        assert val[2].startswith("Error: could not load")
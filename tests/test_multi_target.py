@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingesting into several collections at once, validating each document once
+'''
+
+from pathlib import Path
+
+import pymongo
+import pytest
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.DeadLetters import DeadLetters
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from metadata_mongo_ingester.MultiTargetIngester import MultiTargetIngester
+from tests.test_connection_pool import FakeClient
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch):
+
+    """ Write config and secrets files with test and prod sections, and use the fake client. """
+
+    monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+    monkeypatch.setattr(ingester_module, "_clients", {})
+    monkeypatch.setattr(ingester_module, "_created_indexes", set())
+    FakeClient.made = []
+
+    section = """
+address = localhost
+authSource = ds_testing
+collection = metadata
+index_keys = archived_path
+port = 27017
+username = ds_testing
+"""
+    config_filename = Path(tmp_path, "ingester_config.cfg")
+    config_filename.write_text(f"[mongodb_test]{section}database = ds_test\n"
+        f"[mongodb_prod]{section}database = ds_prod\n")
+    secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+    secrets_filename.write_text("[mongodb_test]\npassword = a\n[mongodb_prod]\npassword = b\n")
+    return str(config_filename), str(secrets_filename)
+
+
+def collection(database, name="metadata"):
+
+    """ Get a fake collection the targets wrote to. """
+
+    return FakeClient.made[0].collections[(database, name)]
+
+
+class TestMultiTarget:
+
+    """ Test that documents are prepared once and written to every target. """
+
+    def test_promote_to_test_and_prod(self, config_files):
+
+        """ Ingest into test and prod together, confirm both get the docs, validated once. """
+
+        preparer = MetadataMongoIngester()
+        stats = IngestionStats()
+        preparer.set_stats(stats)
+        with MultiTargetIngester(preparer) as multi:
+            assert multi.add_target("test", "test", *config_files) == None
+            assert multi.add_target("prod", "prod", *config_files) == None
+            results = multi.ingest_documents([{"archived_path": "/a"}, {"archived_path": "/b"},
+                {"archived_path": "/a"}, {"project": {}}], batch_size=2)
+
+        assert results["test"] == results["prod"] == [None, None, "Duplicate key, skipped",
+            "Error: no archived_path key in document."]
+        assert [doc["archived_path"] for doc in collection("ds_test").docs] == ["/a", "/b"]
+        assert [doc["archived_path"] for doc in collection("ds_prod").docs] == ["/a", "/b"]
+        assert stats.counts["correction_errors"] == 1
+
+
+    def test_route_to_group_collections(self, config_files):
+
+        """ Route docs to per-group collections, confirm each goes only where it was routed. """
+
+        multi = MultiTargetIngester(route=lambda doc: [doc["group"]])
+        multi.add_target("lab-a", "test", *config_files, collection_name="lab_a")
+        multi.add_target("lab-b", "test", *config_files, collection_name="lab_b")
+        results = multi.ingest_documents([{"archived_path": "/a", "group": "lab-a"},
+            {"archived_path": "/b", "group": "lab-b"}, {"archived_path": "/c", "group": "lab-c"}])
+
+        assert results["lab-a"] == [None, "Not routed, skipped",
+            "Error: no target named lab-c, cannot ingest."]
+        assert results["lab-b"] == ["Not routed, skipped", None,
+            "Error: no target named lab-c, cannot ingest."]
+        assert [doc["archived_path"] for doc in collection("ds_test", "lab_a").docs] == ["/a"]
+        assert [doc["archived_path"] for doc in collection("ds_test", "lab_b").docs] == ["/b"]
+
+
+    def test_each_target_transforms_fields(self, config_files):
+
+        """ Compress a field for prod only, confirm test stores it whole and prod compressed. """
+
+        config_filename, secrets_filename = config_files
+        with open(config_filename, 'a') as f:
+            f.write("compress_fields = project.samples\ncompress_min_bytes = 1\n")
+
+        samples = [{"id": "S1"}, {"id": "S2"}]
+        with MultiTargetIngester() as multi:
+            multi.add_target("test", "test", config_filename, secrets_filename)
+            multi.add_target("prod", "prod", config_filename, secrets_filename)
+            results = multi.ingest_documents([{"archived_path": "/a",
+                "project": {"samples": samples}}])
+
+        assert results == {"test": [None], "prod": [None]}
+        assert collection("ds_test").docs[0]["project"]["samples"] == samples
+        assert collection("ds_prod").docs[0]["project"]["samples"]["compressed"] == "zlib+json"
+
+
+    def test_failing_target_doesnt_stop_others(self, config_files, tmp_path):
+
+        """ Make one target fail its writes, confirm the other is written and each has its own errors. """
+
+        multi = MultiTargetIngester()
+        multi.add_target("test", "test", *config_files)
+        multi.add_target("prod", "prod", *config_files)
+        multi.targets["prod"].set_retry_policy(None)
+        collection("ds_prod").faults = [("before", pymongo.errors.OperationFailure("no space"))]
+
+        with DeadLetters(str(Path(tmp_path, "prod.ndjson"))) as prod_dead_letters:
+            results = multi.ingest_documents([{"archived_path": "/a"}],
+                dead_letters={"prod": prod_dead_letters})
+            assert [record["stage"] for record in prod_dead_letters] == ["insert"]
+
+        assert results["test"] == [None]
+        assert results["prod"][0].startswith("Error: Cannot ingest document")
+        assert len(collection("ds_test").docs) == 1
+
+
+    def test_upsert_target(self, config_files):
+
+        """ Make one target upsert, confirm changed docs replace stored ones there only. """
+
+        multi = MultiTargetIngester()
+        multi.add_target("test", "test", *config_files, upsert=True)
+        multi.add_target("prod", "prod", *config_files)
+        multi.ingest_documents([{"archived_path": "/a", "n": 1}])
+        results = multi.ingest_documents([{"archived_path": "/a", "n": 2}])
+
+        assert results == {"test": [None], "prod": ["Duplicate key, skipped"]}
+        assert collection("ds_test").docs[0]["n"] == 2
+        assert collection("ds_prod").docs[0]["n"] == 1
+
+
+    def test_upsert_target_with_failed_docs(self, config_files, tmp_path):
+
+        """ Give an upsert target a bad file and a doc without a path, confirm each fails alone, unhashed. """
+
+        bad_filename = Path(tmp_path, "bad.json")
+        bad_filename.write_text("{ not json")
+        no_path = {"n": 1}
+
+        multi = MultiTargetIngester()
+        multi.add_target("test", "test", *config_files, upsert=True)
+        with DeadLetters(str(Path(tmp_path, "test.ndjson"))) as dead_letters:
+            results = multi.ingest_documents([str(bad_filename), no_path, {"archived_path": "/a"}],
+                dead_letters={"test": dead_letters})
+            records = list(dead_letters)
+
+        assert results["test"][0].startswith("Error: could not load")
+        assert results["test"][1].startswith("Error: no archived_path key")
+        assert results["test"][2] == None
+        assert [record["stage"] for record in records] == ["load", "correct"]
+        assert records[1]["doc"] == {"n": 1}
+        assert no_path == {"n": 1}
+
+
+    def test_no_targets_fails(self):
+
+        """ Ingest with no targets, confirm an error. """
+
+        assert MultiTargetIngester().ingest_documents([{}]) == "Error: no targets to ingest into."
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingesting documents through the bounded staged pipeline
+'''
+
+import os
+from pathlib import Path
+
+from metadata_mongo_ingester.IngestionPipeline import IngestionPipeline
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from tests.fake_mongo import good_schema, make_ingester, write_docs
+
+
+def write_doc_files(root, count):
+
+    """ Write count good document files and one bad one, and list them. """
+
+    filenames = write_docs(root, count)
+    filenames.append(str(Path(root, "bad.json")))
+    with open(filenames[-1], 'w') as f:
+        f.write("{ not json")
+    return filenames
+
+
+class TestPipeline:
+
+    """ Test that the pipeline ingests everything while keeping its queues within their limits. """
+
+    def test_pipeline_ingests_files(self, tmp_path):
+
+        """ Given good and bad files, confirm the good ones are ingested and the bad one reported. """
+
+        filenames = write_doc_files(tmp_path, 20)
+        mmi = make_ingester(good_schema)
+        pipeline = IngestionPipeline(mmi, read_threads=3, prepare_threads=2, batch_size=4)
+        results = {}
+        summary = pipeline.run(iter(filenames), on_result=results.__setitem__)
+        assert summary["ingested"] == 20
+        assert summary["failed"] == 1
+        assert summary["errors"][0][0] == filenames[-1]
+        assert summary["errors"][0][1].startswith("Error: could not load")
+        assert sorted(results) == sorted(filenames)
+        assert len(mmi.collection.docs) == 20
+
+
+    def test_queues_stay_within_limits(self, tmp_path):
+
+        """ Given small queue limits, confirm neither queue ever holds more than allowed. """
+
+        filenames = write_doc_files(tmp_path, 30)
+        size = os.path.getsize(filenames[0])
+        pipeline = IngestionPipeline(make_ingester(good_schema), read_threads=4, batch_size=2,
+            max_queued_docs=5, max_queued_bytes=3 * size)
+        summary = pipeline.run(filenames)
+        assert summary["ingested"] == 30
+        for queue in pipeline.queues:
+            assert queue.peak_items <= 3
+            assert queue.peak_bytes <= 3 * size
+
+
+    def test_pipeline_with_processes(self, tmp_path):
+
+        """ Prepare documents in worker processes, confirm they're ingested and stats merged. """
+
+        filenames = write_doc_files(tmp_path, 6)
+        mmi = make_ingester(good_schema)
+        stats = IngestionStats()
+        mmi.set_stats(stats)
+        summary = IngestionPipeline(mmi, prepare_processes=2, batch_size=4).run(filenames)
+        assert summary["ingested"] == 6
+        assert stats.counts["ingested"] == 6
+        assert stats.counts["load_errors"] == 1
+        assert stats.seconds["validate"] > 0
+
+
+    def test_bad_settings(self):
+
+        """ Given a queue limit that's not a positive integer, confirm an error. """
+
+        val = IngestionPipeline(make_ingester(good_schema), max_queued_docs=0).run([])
+        assert val == "Error: max_queued_docs must be a positive integer, not 0."
+
+
+    def test_failed_stage_stops_pipeline(self, tmp_path):
+
+        """ Given a result callback that raises, confirm the pipeline stops with an error. """
+
+        def fail(key, result):
+            raise ValueError("callback failed")
+
+        filenames = write_doc_files(tmp_path, 30)
+        pipeline = IngestionPipeline(make_ingester(good_schema), batch_size=1, max_queued_docs=2)
+        val = pipeline.run(filenames, on_result=fail)
+        assert val == "Error: ingestion pipeline stopped, received exception callback failed."
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for retrying failed writes, the circuit breaker and write concern settings
+'''
+
+import threading
+import time
+from pathlib import Path
+
+import pymongo
+
+from metadata_mongo_ingester import MetadataMongoIngester as ingester_module
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from metadata_mongo_ingester.RetryPolicy import CircuitOpenError, RetryPolicy
+from tests import fake_mongo
+from tests.test_connection_pool import FakeClient
+
+
+def make_ingester(**policy):
+
+    """ Make an ingester with a quick retry policy that writes to an in-process fake collection. """
+
+    mmi = fake_mongo.make_ingester()
+    policy.setdefault("backoff", 0.001)
+    mmi.set_retry_policy(RetryPolicy(**policy))
+    return mmi
+
+
+def network_error():
+
+    """ Make the error pymongo raises when the connection drops. """
+
+    return pymongo.errors.AutoReconnect("connection reset")
+
+
+class TestRetry:
+
+    """ Test that transient failures are retried and lasting ones reported. """
+
+    def test_single_write_retried(self):
+
+        """ Fail the first two inserts, confirm the document is written on the third. """
+
+        mmi = make_ingester()
+        mmi.collection.faults = [("before", network_error()), ("before", network_error())]
+        assert mmi.ingest_document({"archived_path": "/a"}) == None
+        assert len(mmi.collection.docs) == 1
+
+
+    def test_retries_run_out(self):
+
+        """ Fail more inserts than the policy retries, confirm an error. """
+
+        mmi = make_ingester(retries=1)
+        mmi.collection.faults = [("before", network_error())] * 2
+        val = mmi.ingest_document({"archived_path": "/a"})
+        assert val == "Error: Cannot ingest document, received exception connection reset."
+
+
+    def test_no_retries(self):
+
+        """ Turn retries off, confirm a single failure is reported. """
+
+        mmi = make_ingester()
+        mmi.set_retry_policy(None)
+        mmi.collection.faults = [("before", network_error())]
+        assert mmi.ingest_document({"archived_path": "/a"}).startswith("Error: Cannot ingest")
+
+
+    def test_write_made_before_failure_not_duplicate(self):
+
+        """ Drop the connection after a write, confirm the retry doesn't call it a duplicate. """
+
+        mmi = make_ingester()
+        mmi.collection.faults = [("after", network_error())]
+        assert mmi.ingest_document({"archived_path": "/a"}) == None
+        assert mmi.ingest_document({"archived_path": "/a"}) == "Duplicate key, skipped"
+
+
+    def test_bulk_write_retried(self):
+
+        """ Drop the connection after a batch is written, confirm real duplicates are still found. """
+
+        mmi = make_ingester()
+        assert mmi.ingest_document({"archived_path": "/0"}) == None
+        mmi.collection.faults = [("after", network_error())]
+        val = mmi.ingest_documents([{"archived_path": f"/{i}"} for i in range(4)])
+        assert val == ["Duplicate key, skipped", None, None, None]
+        assert mmi.collection.insert_many_calls == 2
+        assert len(mmi.collection.docs) == 4
+
+
+    def test_upsert_batch_retried(self):
+
+        """ Fail an upsert batch once, confirm it is written on the retry. """
+
+        mmi = make_ingester()
+        mmi.set_upsert()
+        mmi.collection.faults = [("before", network_error())]
+        val = mmi.ingest_documents([{"archived_path": f"/{i}"} for i in range(3)])
+        assert val == [None, None, None]
+        assert mmi.collection.bulk_write_calls == 2
+
+
+class TestCircuitBreaker:
+
+    """ Test that writes wait while the server is down, and give up after max_pause. """
+
+    def test_breaker_gives_up(self):
+
+        """ Fail enough writes to open the breaker, confirm writes then fail without trying. """
+
+        mmi = make_ingester(retries=0, breaker_threshold=2, breaker_reset=10, max_pause=1)
+        mmi.collection.faults = [("before", network_error())] * 2
+        mmi.ingest_document({"archived_path": "/a"})
+        mmi.ingest_document({"archived_path": "/b"})
+        val = mmi.ingest_document({"archived_path": "/c"})
+        assert val.startswith("Error: Cannot ingest document, received exception server unavailable")
+        assert mmi.collection.docs == []
+
+
+    def test_breaker_waits_for_server(self):
+
+        """ Open the breaker, confirm writes wait and then go ahead once the server is back. """
+
+        policy = RetryPolicy(breaker_threshold=1, breaker_reset=0.05, max_pause=5)
+        policy.record_failure()
+        start = time.monotonic()
+        policy.wait_for_server()
+        assert time.monotonic() - start >= 0.04
+
+        # Another write waits for the one trying the server, and goes when it succeeds.
+        waiter = threading.Thread(target=policy.wait_for_server)
+        waiter.start()
+        time.sleep(0.01)
+        assert waiter.is_alive()
+        policy.record_success()
+        waiter.join(1)
+        assert not waiter.is_alive()
+
+
+    def test_breaker_raises_after_max_pause(self):
+
+        """ Confirm waiting past max_pause raises CircuitOpenError. """
+
+        policy = RetryPolicy(breaker_threshold=1, breaker_reset=10, max_pause=1)
+        policy.record_failure()
+        try:
+            policy.wait_for_server()
+            assert False
+        except CircuitOpenError:
+            pass
+
+
+class TestWriteSettings:
+
+    """ Test that write concern and retry settings are read from the config file. """
+
+    def test_settings_from_config(self, tmp_path, monkeypatch):
+
+        """ Open a connection with write settings in the config file, confirm they are used. """
+
+        monkeypatch.setattr(pymongo, "MongoClient", FakeClient)
+        monkeypatch.setattr(ingester_module, "_clients", {})
+        monkeypatch.setattr(ingester_module, "_created_indexes", set())
+
+        config_filename = Path(tmp_path, "ingester_config.cfg")
+        config_filename.write_text("""
+[mongodb_dev]
+address = localhost
+authSource = ds_testing
+collection = metadata
+database = ds_testing
+index_keys = archived_path
+port = 27017
+username = ds_testing
+w = majority
+j = true
+wtimeout = 5000
+write_retries = 7
+retry_backoff_ms = 250
+""")
+        secrets_filename = Path(tmp_path, "ingester_secrets.cfg")
+        secrets_filename.write_text("[mongodb_dev]\npassword = not_a_real_password\n")
+
+        mmi = MetadataMongoIngester()
+        assert mmi.open_connection("dev", str(config_filename), str(secrets_filename)) == None
+        assert mmi.collection.write_concern.document == {"w": "majority", "j": True, "wtimeout": 5000}
+        assert mmi.retry_policy.retries == 7
+        assert mmi.retry_policy.backoff == 0.25
+        mmi.close()
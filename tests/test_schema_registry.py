@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for validating each document against the schema its discriminator selects
+'''
+
+import json
+import os
+import pickle
+from pathlib import Path
+
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from metadata_mongo_ingester.SchemaRegistry import SchemaRegistry
+from tests.fake_mongo import FakeCollection
+
+
+# NOTE: pytest skips classes with constructors, so the test class can't have an
+# __init__ method. But we can initialize things before the class, as shown here.
+
+# Get the directory this script has been called from. Use it to find the root directory
+# for the tests, and confirm the schemas dir and test docs dir is beneath it.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+assert Path.is_dir(schemas_dir)
+assert Path.is_dir(test_docs_dir)
+
+good_schema = os.path.join(schemas_dir, "good_gt-schema.json")
+good_schema_id = "http://ctgenometech01/QIFA/gt-delivery-schema-v1#"
+
+
+def load_doc(name="good_gt_metadata.json"):
+
+    """ Load one of the test docs. """
+
+    with open(os.path.join(test_docs_dir, name), 'r') as f:
+        return json.load(f)
+
+
+def write_schema(filename, required):
+
+    """ Write a schema requiring the given top level keys, and bump its modification time. """
+
+    with open(filename, 'w') as f:
+        json.dump({"type": "object", "required": required}, f)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    return str(filename)
+
+
+class TestSchemaRegistry:
+
+    """ Test that documents are routed to their schemas, and changed schemas are reloaded. """
+
+    def test_route_by_version(self, tmp_path):
+
+        """ Route by project.Version, confirm each doc is validated against its own schema. """
+
+        registry = SchemaRegistry(["project.Version"])
+        assert registry.add(good_schema, [1]) == None
+        assert registry.add(write_schema(tmp_path / "v2.json", ["faculty"]), ["2"]) == None
+
+        mmi = MetadataMongoIngester()
+        mmi.set_schema_registry(registry)
+        assert mmi.is_schema_set()
+
+        assert mmi.validate(load_doc()) == None
+        assert mmi.validate(load_doc("bad_gt_metadata_missing_PI.json")).startswith(
+            "Error: document validation failed")
+
+        doc = load_doc()
+        doc["project"]["Version"] = "2"
+        assert mmi.validate(doc).startswith("Error: document validation failed, received "
+            "exception 'faculty' is a required property")
+
+
+    def test_route_by_schema_id(self):
+
+        """ Route by $schema, confirm a doc naming the schema's own id is validated against it. """
+
+        registry = SchemaRegistry()
+        registry.add(good_schema)
+        assert registry.select({"$schema": good_schema_id}).filename == good_schema
+
+
+    def test_unmatched_documents(self, tmp_path):
+
+        """ Confirm a doc matching no schema is rejected, unless there is a default schema. """
+
+        registry = SchemaRegistry(["project.Version"])
+        registry.add(good_schema, ["1"])
+        assert registry.select({"project": {"Version": "9"}}) == \
+            "Error: no schema for discriminator value 9."
+        assert registry.select({}) == \
+            "Error: document has no schema discriminator and no default schema is set."
+
+        registry.add(write_schema(tmp_path / "default.json", []), default=True)
+        assert registry.select({}).filename == str(tmp_path / "default.json")
+
+
+    def test_conflicting_route_fails(self, tmp_path):
+
+        """ Route one value to two schemas, confirm an error. """
+
+        registry = SchemaRegistry(["Version"])
+        registry.add(good_schema, ["1"])
+        assert registry.add(write_schema(tmp_path / "other.json", []), ["1"]) == \
+            f"Error: discriminator value 1 already routes to schema {good_schema}."
+
+
+    def test_changed_schema_is_reloaded(self, tmp_path):
+
+        """ Change a schema file on disk, confirm the new version is used, and a broken one isn't. """
+
+        filename = write_schema(tmp_path / "schema.json", [])
+        registry = SchemaRegistry(lambda doc: "any", check_interval=0)
+        registry.add(filename, ["any"])
+        mmi = MetadataMongoIngester()
+        mmi.set_schema_registry(registry)
+
+        prepared = mmi.prepare_document({"archived_path": "/a"})
+        assert prepared
+
+        write_schema(filename, ["project"])
+        assert mmi.validate({"archived_path": "/a"}).startswith(
+            "Error: document validation failed, received exception 'project' is a required property")
+
+        # A document prepared against the old version is validated again.
+        mmi.collection = FakeCollection()
+        assert mmi.ingest_document(prepared).startswith("Could not valiate doc")
+
+        # A file that is no longer a valid schema leaves the last good version in use.
+        with open(filename, 'w') as f:
+            f.write("{not json")
+        assert registry.select({}).required_keys == ("project",)
+
+
+    def test_registry_pickles(self):
+
+        """ Pickle a registry, as when copied into worker processes, confirm it still validates. """
+
+        registry = SchemaRegistry(["project.Version"])
+        registry.add(good_schema, ["1"])
+        mmi = MetadataMongoIngester()
+        mmi.set_schema_registry(registry)
+
+        copy = pickle.loads(pickle.dumps(mmi))
+        assert copy.validate(load_doc()) == None
+        assert copy.validate(load_doc("bad_gt_metadata_missing_PI.json"))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for skipping documents already in the collection before validating them
+'''
+
+import json
+from pathlib import Path
+
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from tests.fake_mongo import good_schema, load_doc, make_ingester
+
+
+class TestSkipExisting:
+
+    """ Test that documents already in the collection are skipped without being validated. """
+
+    def test_existing_docs_skipped_before_validation(self):
+
+        """ Re-run a batch, confirm the stored docs are skipped with one lookup and not validated. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        assert mmi.ingest_documents([load_doc("/a"), load_doc("/b")]) == [None, None]
+
+        stats = IngestionStats()
+        mmi.set_stats(stats)
+        mmi.known_keys.clear()
+        mmi.collection.find_calls = 0
+        results = mmi.ingest_documents([load_doc("/a"), load_doc("/b"), load_doc("/c")])
+
+        assert results == ["Duplicate key, skipped", "Duplicate key, skipped", None]
+        assert mmi.collection.find_calls == 1
+        assert stats.counts["duplicates"] == 2
+        assert stats.counts["ingested"] == 1
+        assert stats.counts["validation_failures"] == 0
+
+
+    def test_invalid_existing_doc_skipped(self):
+
+        """ Given a stored key on a doc that would fail validation, confirm it is skipped, not failed. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        mmi.ingest_documents([load_doc("/a")])
+        assert mmi.ingest_documents([{"archived_path": "/a"}]) == ["Duplicate key, skipped"]
+
+
+    def test_known_keys_cached(self):
+
+        """ Ingest docs, confirm their keys are remembered and not looked up again. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        mmi.ingest_documents([load_doc("/a"), load_doc("/b")], batch_size=1)
+        assert mmi.known_keys == {"/a", "/b"}
+
+        mmi.collection.find_calls = 0
+        assert mmi.ingest_documents([load_doc("/a"), load_doc("/b")]) == \
+            ["Duplicate key, skipped", "Duplicate key, skipped"]
+        assert mmi.collection.find_calls == 0
+
+
+    def test_directory_with_workers(self, tmp_path):
+
+        """ Ingest a directory with worker processes, confirm stored docs are skipped before
+        the workers validate them, and only the new doc is written. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        assert mmi.ingest_documents([load_doc("/a")]) == [None]
+        mmi.known_keys.clear()
+
+        Path(tmp_path, "a.json").write_text(json.dumps({"archived_path": "/a"}))
+        Path(tmp_path, "b.json").write_text(json.dumps(load_doc("/b")))
+        insert_calls = mmi.collection.insert_many_calls
+        results = mmi.ingest_directory(str(tmp_path), workers=2)
+
+        assert list(results.values()) == ["Duplicate key, skipped", None]
+        assert mmi.collection.insert_many_calls == insert_calls + 1
+        assert [doc["archived_path"] for doc in mmi.collection.docs] == ["/a", "/b"]
+        assert mmi.known_keys == {"/a", "/b"}
+
+
+    def test_failed_lookup_falls_back(self):
+
+        """ Make the lookup fail, confirm the docs are validated and inserted as usual. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        mmi.ingest_documents([load_doc("/a")])
+        mmi.known_keys.clear()
+        mmi.collection.find = None
+        assert mmi.ingest_documents([load_doc("/a"), load_doc("/b")]) == \
+            ["Duplicate key, skipped", None]
+
+
+    def test_ignored_in_upsert_mode(self):
+
+        """ Turn on upsert mode, confirm a changed stored doc is replaced, not skipped. """
+
+        mmi = make_ingester(good_schema, skip_existing=True)
+        mmi.set_upsert()
+        mmi.ingest_documents([load_doc("/a")])
+        doc = load_doc("/a")
+        doc["project"]["Notes"] = "changed"
+        assert mmi.ingest_documents([doc]) == [None]
+        assert mmi.collection.docs[0]["project"]["Notes"] == "changed"
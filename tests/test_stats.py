@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for ingestion timings and counts
+'''
+
+import json
+import os
+from pathlib import Path
+
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from tests.fake_mongo import good_schema, make_ingester, test_docs_dir
+
+
+def sample_doc_files():
+
+    """ List a good, an invalid, and an unloadable document file, and the good one again. """
+
+    good = os.path.join(test_docs_dir, "good_gt_metadata.json")
+    return [good, os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json"),
+        "/no/such/file.json", good]
+
+
+class TestStats:
+
+    """ Test that stages are timed and outcomes counted, in this process and in workers. """
+
+    def test_counts_and_bytes(self):
+
+        """ Given good, bad, and duplicate documents, confirm each outcome and the bytes are counted. """
+
+        stats = IngestionStats()
+        mmi = make_ingester(good_schema, stats=stats)
+        mmi.ingest_documents(sample_doc_files())
+        assert stats.counts["ingested"] == 1
+        assert stats.counts["duplicates"] == 1
+        assert stats.counts["validation_failures"] == 1
+        assert stats.counts["load_errors"] == 1
+        expected_bytes = sum(os.path.getsize(filename) for filename in sample_doc_files()
+            if os.path.exists(filename))
+        assert stats.bytes_loaded == expected_bytes
+        assert all(stats.seconds[stage] > 0 for stage in IngestionStats.STAGES)
+
+
+    def test_hooks_receive_metrics(self):
+
+        """ Given a hook, confirm it receives every measurement. """
+
+        received = []
+        mmi = make_ingester(good_schema, stats=IngestionStats(hooks=[lambda metric, value: received.append(metric)]))
+        mmi.ingest_document(os.path.join(test_docs_dir, "good_gt_metadata.json"))
+        assert received[0] == "bytes.loaded"
+        assert "time.validate" in received
+        assert received[-1] == "count.ingested"
+
+
+    def test_worker_stats_are_merged(self, tmp_path):
+
+        """ Given a directory ingested by a process pool, confirm the workers' numbers are merged. """
+
+        with open(os.path.join(test_docs_dir, "good_gt_metadata.json"), 'r') as f:
+            doc = json.load(f)
+        for i in range(4):
+            doc["archived_path"] = f"/archive/path_{i}"
+            Path(tmp_path, f"doc_{i}.json").write_text(json.dumps(doc))
+
+        received = []
+        stats = IngestionStats(hooks=[lambda metric, value: received.append(metric)])
+        mmi = make_ingester(good_schema, stats=stats)
+        mmi.ingest_directory(str(tmp_path), workers=2)
+        assert stats.counts["ingested"] == 4
+        assert stats.seconds["validate"] > 0
+        assert stats.bytes_loaded == sum(f.stat().st_size for f in Path(tmp_path).iterdir())
+        assert received.count("bytes.loaded") == 4
+
+
+    def test_no_stats_by_default(self):
+
+        """ Given no stats, confirm ingestion works and nothing is recorded. """
+
+        mmi = make_ingester(good_schema, stats=None)
+        assert mmi.ingest_document(os.path.join(test_docs_dir, "good_gt_metadata.json")) == None
+        assert mmi.get_stats() == None
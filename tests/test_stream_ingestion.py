@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for streaming documents from NDJSON and json array files
+'''
+
+import json
+import os
+from pathlib import Path
+
+from metadata_mongo_ingester.JsonStreamReader import JsonStreamReader
+from metadata_mongo_ingester.MetadataMongoIngester import MetadataMongoIngester
+from tests.fake_mongo import FakeCollection
+
+
+# NOTE: pytest skips classes with constructors, so the test class can't have an
+# __init__ method. But we can initialize things before the class, as shown here.
+
+# Get the directory this script has been called from. Use it to find the root directory
+# for the tests, and confirm the schemas dir and test docs dir is beneath it.
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+schemas_dir = Path(tests_dir, "schemas")
+test_docs_dir = Path(tests_dir, "test_docs")
+assert Path.is_dir(schemas_dir)
+assert Path.is_dir(test_docs_dir)
+
+
+def good_docs(count):
+
+    """ Make count copies of the good test document, each with its own archived path. """
+
+    with open(os.path.join(test_docs_dir, "good_gt_metadata.json"), 'r') as f:
+        doc = json.load(f)
+    docs = []
+    for i in range(count):
+        doc["archived_path"] = f"/archive/path_{i}"
+        docs.append(json.loads(json.dumps(doc)))
+    return docs
+
+
+class TestStreamIngestion:
+
+    """ Test that documents can be read and ingested one at a time from large files. """
+
+    def test_array_reads_in_small_chunks(self, tmp_path):
+
+        """ Given a json array read a few bytes at a time, confirm every document and its offset. """
+
+        docs = good_docs(4)
+        filename = Path(tmp_path, "docs.json")
+        filename.write_text(json.dumps(docs, indent=2))
+        val = list(JsonStreamReader(str(filename), chunk_size=100))
+        assert [doc for offset, doc, error in val] == docs
+        text = filename.read_bytes()
+        assert all(text[offset:offset + 1] == b"{" for offset, doc, error in val)
+
+
+    def test_truncated_array_reports_offset(self, tmp_path):
+
+        """ Given a json array cut off in its second document, confirm the error and its offset. """
+
+        filename = Path(tmp_path, "docs.json")
+        filename.write_text('[{"a": 1}, {"b": ')
+        val = list(JsonStreamReader(str(filename)))
+        assert val[0] == (1, {"a": 1}, None)
+        assert val[1][0] == 11
+        assert val[1][2].startswith("Error: could not parse document at offset 11")
+
+
+    def test_ndjson_ingests_with_per_line_errors(self, tmp_path):
+
+        """ Given NDJSON with a bad line and an invalid document, confirm the rest are ingested. """
+
+        docs = good_docs(5)
+        del docs[3]["project"]["PI"]
+        lines = [json.dumps(doc) for doc in docs]
+        lines.insert(2, "{ not json")
+        filename = Path(tmp_path, "docs.ndjson")
+        filename.write_text("\n".join(lines) + "\n")
+
+        mmi = MetadataMongoIngester()
+        mmi.collection = FakeCollection()
+        mmi.set_schema(os.path.join(schemas_dir, "good_gt-schema.json"))
+        calls = []
+        val = mmi.ingest_stream(str(filename), batch_size=2, progress=lambda *args: calls.append(args),
+            progress_interval=2)
+
+        assert val["ingested"] == 4
+        assert val["failed"] == 2
+        bad_line_offset = sum(len(line) + 1 for line in lines[:2])
+        assert val["errors"][0][0] == bad_line_offset
+        assert val["errors"][0][1].startswith("Error: could not parse line 3")
+        assert val["errors"][1][1].startswith("Could not valiate doc")
+        assert calls[-1] == (6, filename.stat().st_size)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for upserting documents keyed on the index keys
+'''
+
+from tests.fake_mongo import load_doc, make_ingester
+
+
+def good_doc(archived_path, notes="DNF"):
+
+    """ Load the good test document and give it a new archived path and notes. """
+
+    doc = load_doc(archived_path)
+    doc["project"]["Notes"] = notes
+    return doc
+
+
+class TestUpsert:
+
+    """ Test that changed documents replace stored ones and unchanged ones are skipped. """
+
+    def test_unchanged_doc_is_skipped(self):
+
+        """ Given the same document twice, confirm it is written once and then skipped. """
+
+        mmi = make_ingester(upsert=True)
+        assert mmi.ingest_document(good_doc("/archive/a")) == None
+        assert mmi.ingest_document(good_doc("/archive/a")) == "Unchanged, skipped"
+        assert len(mmi.collection.docs) == 1
+        assert mmi.collection.replace_requests == 1
+
+
+    def test_changed_doc_replaces_stored_doc(self):
+
+        """ Given a document whose content changed, confirm it replaces the stored one. """
+
+        mmi = make_ingester(upsert=True)
+        mmi.ingest_document(good_doc("/archive/a"))
+        stored_id = mmi.collection.docs[0]["_id"]
+        assert mmi.ingest_document(good_doc("/archive/a", notes="corrected")) == None
+        assert len(mmi.collection.docs) == 1
+        assert mmi.collection.docs[0]["project"]["Notes"] == "corrected"
+        assert mmi.collection.docs[0]["_id"] == stored_id
+
+
+    def test_batch_sends_only_changed_docs(self):
+
+        """ Given a re-run with one changed document, confirm only it is written. """
+
+        mmi = make_ingester(upsert=True)
+        mmi.ingest_documents([good_doc(f"/archive/{i}") for i in range(4)])
+        docs = [good_doc(f"/archive/{i}") for i in range(4)] + [good_doc("/archive/new")]
+        docs[2] = good_doc("/archive/2", notes="corrected")
+        val = mmi.ingest_documents(docs, batch_size=10)
+        assert val == ["Unchanged, skipped", "Unchanged, skipped", None, "Unchanged, skipped", None]
+        assert mmi.collection.bulk_write_calls == 2
+        assert mmi.collection.replace_requests == 4 + 2
+        assert len(mmi.collection.docs) == 5
+
+
+    def test_unchanged_doc_skipped_when_lookup_fails(self, monkeypatch):
+
+        """ Given a failing hash lookup, confirm unchanged documents are sent but still not written. """
+
+        mmi = make_ingester(upsert=True)
+        mmi.ingest_documents([good_doc(f"/archive/{i}") for i in range(2)])
+
+        def fail(*args, **kwargs):
+            raise RuntimeError("lookup failed")
+
+        monkeypatch.setattr(mmi.collection, "find", fail)
+        val = mmi.ingest_documents([good_doc(f"/archive/{i}") for i in range(2)])
+        assert val == ["Unchanged, skipped", "Unchanged, skipped"]
+        assert mmi.collection.replace_requests == 2 + 2
+
+
+    def test_key_order_does_not_change_hash(self):
+
+        """ Given the same content with keys in another order, confirm it is unchanged. """
+
+        mmi = make_ingester(upsert=True)
+        mmi.ingest_document({"archived_path": "/archive/a", "x": 1, "y": 2})
+        assert mmi.ingest_document({"y": 2, "x": 1, "archived_path": "/archive/a"}) == "Unchanged, skipped"
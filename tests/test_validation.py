@@ -56,6 +56,16 @@ class TestValidation:
         assert val == None
 
 
+    def test_set_good_schema_uses_its_draft(self):
+
+        """ Given a draft-04 schema file, confirm a draft-04 validator is compiled for it. """
+
+        schema_filename = os.path.join(schemas_dir, "good_gt-schema.json")
+        mmi = MetadataMongoIngester()
+        mmi.set_schema(schema_filename)
+        assert type(mmi.validator).__name__ == "Draft4Validator"
+
+
     def test_set_and_unset_schema(self):
 
         """ Test that we can set a schema and unset it. """
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for preparing documents once and ingesting the prepared result
+'''
+
+import os
+
+from metadata_mongo_ingester.IngestionStats import IngestionStats
+from tests.fake_mongo import good_schema, make_ingester, test_docs_dir
+
+
+good_doc = os.path.join(test_docs_dir, "good_gt_metadata.json")
+bad_doc = os.path.join(test_docs_dir, "bad_gt_metadata_missing_PI.json")
+
+
+class TestValidationResult:
+
+    """ Test that a prepared document is ingested without being loaded or validated again. """
+
+    def test_prepare_good_doc(self):
+
+        """ Prepare the good test doc, confirm the result is valid and holds the doc. """
+
+        result = make_ingester(good_schema).prepare_document(good_doc)
+        assert result
+        assert result.error == None
+        assert result.source == good_doc
+        assert result.doc["archived_path"]
+
+
+    def test_prepare_bad_doc(self):
+
+        """ Prepare a doc missing a required key, confirm the result holds the error. """
+
+        mmi = make_ingester(good_schema)
+        result = mmi.prepare_document(bad_doc)
+        assert not result
+        assert result.doc == None
+        assert mmi.ingest_document(result) == result.error
+
+
+    def test_prepared_doc_not_validated_again(self):
+
+        """ Ingest a prepared doc, confirm it is not loaded or validated a second time. """
+
+        mmi = make_ingester(good_schema)
+        result = mmi.prepare_document(good_doc)
+        stats = IngestionStats()
+        mmi.set_stats(stats)
+        assert mmi.ingest_document(result) == None
+        assert stats.seconds["load"] == 0.0
+        assert stats.seconds["validate"] == 0.0
+        assert stats.counts["ingested"] == 1
+        assert len(mmi.collection.docs) == 1
+
+
+    def test_prepared_docs_ingested_in_bulk(self):
+
+        """ Check everything first, then ingest the prepared docs together. """
+
+        mmi = make_ingester(good_schema)
+        results = [mmi.prepare_document(doc) for doc in [good_doc, bad_doc]]
+        assert [bool(result) for result in results] == [True, False]
+        ingested = mmi.ingest_documents(results)
+        assert ingested[0] == None
+        assert ingested[1].startswith("Could not valiate doc")
+        assert len(mmi.collection.docs) == 1
+
+
+    def test_schema_change_validates_again(self):
+
+        """ Prepare a doc with no schema, set one, confirm the doc is validated on ingest. """
+
+        mmi = make_ingester(good_schema)
+        mmi.set_schema(None)
+        result = mmi.prepare_document(bad_doc)
+        assert result
+        mmi.set_schema(good_schema)
+        assert mmi.ingest_document(result).startswith("Could not valiate doc")
+        assert len(mmi.collection.docs) == 0